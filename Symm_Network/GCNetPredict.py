@@ -0,0 +1,54 @@
+import argparse
+
+import numpy as np
+import torch as pt
+import h5py
+
+# Relaxation vectors from a group convolution network exported with the "export" mode of GCNetRun.py.
+# Only the exported graph is needed, and none of the network or data modules.
+
+def loadPredictor(path, device="cpu"):
+    return pt.jit.load(path, map_location=device).eval()
+
+def predict(net, states, batch_size=512, device="cpu"):
+    """
+    Relaxation vectors of states, as computed by an exported network.
+    :param net: exported network (see loadPredictor).
+    :param states: states as stored in the data sets, with the species at each site - shape (Nsamples, Nsites).
+    Can be an HDF5 data set, which is then read batch by batch.
+    :param batch_size: no. of states run through the network together.
+    :return: relaxation vectors of each site - shape (Nsamples, no. of vectors per site, 3, Nsites).
+    """
+    yVecs = []
+    with pt.no_grad():
+        for start in range(0, states.shape[0], batch_size):
+            batch = pt.as_tensor(np.asarray(states[start : start + batch_size])).to(device)
+            yVecs.append(net(batch).cpu().numpy())
+    return np.concatenate(yVecs, axis=0)
+
+def main(args):
+    net = loadPredictor(args.NetPath, device=args.Device)
+    if args.StatePath.endswith(".npy"):
+        yVecs = predict(net, np.load(args.StatePath, mmap_mode="r"), batch_size=args.Batch_size,
+                        device=args.Device)
+    else:
+        with h5py.File(args.StatePath, "r") as fl:
+            yVecs = predict(net, fl[args.StateKey], batch_size=args.Batch_size, device=args.Device)
+
+    np.save(args.OutPath, yVecs)
+    print("Relaxation vectors of {} states saved to {}".format(yVecs.shape[0], args.OutPath))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute relaxation vectors with an exported network.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-np", "--NetPath", metavar="/path/to/network", type=str, help="Path to the exported network.")
+    parser.add_argument("-sp", "--StatePath", metavar="/path/to/states", type=str, help="Path to the states - either a .npy file or an HDF5 data set file.")
+    parser.add_argument("-sk", "--StateKey", metavar="string", type=str, default="InitStates", help="Data set of the states in an HDF5 file.")
+    parser.add_argument("-o", "--OutPath", metavar="/path/to/output", type=str, default="y_pred.npy", help="Path of the .npy file to save the relaxation vectors to.")
+    parser.add_argument("-bs", "--Batch_size", metavar="int", type=int, default=512, help="No. of states run through the network together.")
+    parser.add_argument("-dev", "--Device", metavar="string", type=str, default="cpu", help="Device to run the network on.")
+
+    args = parser.parse_args()
+    main(args)
@@ -1,5 +1,14 @@
 import os
+import time
+import copy
+import json
+import shutil
+import hashlib
+import queue
+import resource
+import threading
 import argparse
+import contextlib
 RunPath = os.getcwd() + "/"
 
 import numpy as np
@@ -7,7 +16,7 @@ import torch as pt
 import torch.nn as nn
 import h5py
 from tqdm import tqdm
-from SymmLayers import GCNet
+from SymmLayers import GCNet, msgPassNet, FrozenGCNet
 
 device=None
 if pt.cuda.is_available():
@@ -17,6 +26,144 @@ if pt.cuda.is_available():
 else:
     device = pt.device("cpu")
 
+# Floating point precisions the networks can be run in.
+# Transport coefficients are always accumulated in double precision.
+Precisions = {"fp64": pt.float64, "fp32": pt.float32, "bf16": pt.bfloat16}
+
+def storageType(dtype):
+    """
+    Returns the dtype in which the network parameters and input states are stored for a given precision.
+    bfloat16 is run as mixed precision: parameters are kept in float32 and only the forward pass
+    is autocast to bfloat16.
+    """
+    return pt.float32 if dtype == pt.bfloat16 else dtype
+
+def autocastContext(dtype):
+    return pt.autocast(device_type=device.type, dtype=pt.bfloat16, enabled=(dtype == pt.bfloat16))
+
+def batchStates(states, dtype):
+    # states are moved to the device in their compact dtype and cast there.
+    # species labels are moved to the device as they are, and expanded there by the network
+    if states.dim() == 2:
+        return states.to(device)
+    return states.to(device).to(storageType(dtype))
+
+def distInfo():
+    # rank of this process and no. of processes in a torch.distributed run - (0, 1) otherwise
+    if pt.distributed.is_available() and pt.distributed.is_initialized():
+        return pt.distributed.get_rank(), pt.distributed.get_world_size()
+    return 0, 1
+
+def shardRange(start, end, rank, world_size):
+    # contiguous share of the rows [start, end) computed by a rank - the shares differ by at most one row
+    N = end - start
+    return start + (N * rank) // world_size, start + (N * (rank + 1)) // world_size
+
+def takeRows(d, rows):
+    # rows of in-memory data - lazily expanded states are built for just those rows
+    batch = d[rows]
+    return batch[:] if isinstance(batch, JumpExpandedStates) else batch
+
+def dataBatches(start, end, batch_size, *data, rank=0, world_size=1, order=None):
+    # Batches of in-memory data along their rows. Data that is None stays None in every batch.
+    # In a distributed run, every rank gets its share of the rows of each batch.
+    # If an order of the rows is given (e.g. a shuffled index array), batch positions [start, end) of that
+    # order are gathered from the data instead of the rows themselves, so the data is never permuted as a whole.
+    for batch in range(start, end, batch_size):
+        shardStart, shardStop = shardRange(batch, min(batch + batch_size, end), rank, world_size)
+        if order is None:
+            yield tuple(None if d is None else d[shardStart : shardStop] for d in data)
+        else:
+            rows = order[shardStart : shardStop]
+            yield tuple(None if d is None else takeRows(d, rows) for d in data)
+
+class Prefetcher:
+    """
+    Stages the batches of an iterable of batches (see dataBatches and KMCDataset) on a background thread, up to
+    "depth" batches ahead of the one being computed. Every tensor of a batch is moved to the device in the dtype
+    it is stored in, and the states (items stateInds of a batch) are then cast there as in batchStates.
+    With a CUDA device, batches are copied from pinned memory on a separate stream, so that the copies overlap
+    with the computation. On the CPU, the expansion of the compact states into floating point overlaps with it.
+    """
+    def __init__(self, batches, dtype, depth=2, stateInds=(0, 1)):
+        """
+        :param batches: iterable of batch tuples. Items that are not tensors are passed on as they are.
+        :param dtype: precision the network is run in (see Precisions).
+        :param depth: max. no. of batches staged ahead of time.
+        :param stateInds: indices of the states in a batch.
+        """
+        self.batches = batches
+        self.dtype = dtype
+        self.depth = depth
+        self.stateInds = stateInds
+        self.pin = device.type == "cuda"
+
+    def __len__(self):
+        return len(self.batches)
+
+    def stage(self, batch):
+        staged = []
+        for ind, d in enumerate(batch):
+            if isinstance(d, pt.Tensor):
+                if self.pin:
+                    d = d.pin_memory()
+                d = d.to(device, non_blocking=self.pin)
+                if ind in self.stateInds:
+                    d = batchStates(d, self.dtype)
+            staged.append(d)
+        return tuple(staged)
+
+    def __iter__(self):
+        staged = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # give up if the batches are no longer consumed
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def work():
+            stream = pt.cuda.Stream() if self.pin else None
+            try:
+                for batch in self.batches:
+                    if stop.is_set():
+                        return
+                    if stream is None:
+                        put((self.stage(batch), None))
+                    else:
+                        with pt.cuda.stream(stream):
+                            batch = self.stage(batch)
+                            ready = pt.cuda.Event()
+                            ready.record(stream)
+                        put((batch, ready))
+                put((done, None))
+            except BaseException as e:
+                put((e, None))
+
+        worker = threading.Thread(target=work, daemon=True)
+        worker.start()
+        try:
+            while True:
+                batch, ready = staged.get()
+                if batch is done:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                if ready is not None:
+                    # wait for the copies, and keep their memory from being reused while the batch is in use
+                    pt.cuda.current_stream().wait_event(ready)
+                    for d in batch:
+                        if isinstance(d, pt.Tensor):
+                            d.record_stream(pt.cuda.current_stream())
+                yield batch
+        finally:
+            stop.set()
+            worker.join()
 
 def Load_crysDats(CrysDatPath):
     ## load the crystal data files
@@ -43,8 +190,12 @@ def Load_Data(DataPath):
 def makeOnSites(stateOccs, specsToTrain, VacSpec, sp_ch):
     OnSites = None
     NJumps = stateOccs.shape[0]
-    Nsites = stateOccs.shape[2]
+    Nsites = stateOccs.shape[-1]
     if specsToTrain != [VacSpec]:
+        if stateOccs.ndim == 2:
+            # species labels (see makeStateTensors)
+            return np.isin(stateOccs, [sp_ch[spec] for spec in specsToTrain]).astype(np.int8)
+
         OnSites = np.zeros((NJumps, Nsites), dtype=np.int8)
 
         for spec in specsToTrain:
@@ -52,7 +203,86 @@ def makeOnSites(stateOccs, specsToTrain, VacSpec, sp_ch):
 
     return OnSites
 
-def makeStateTensors(stateList, specsToTrain, VacSpec, JumpNewSites, AllJumps=False):
+def makeChannelLabels(sp_ch, NSpec, Nspecies):
+    # the species channel of each of the species 0 to Nspecies-1, with NSpec for the vacancy
+    chLabels = np.full(Nspecies, NSpec, dtype=np.int8)
+    for sp, ch in sp_ch.items():
+        chLabels[sp] = ch
+    return chLabels
+
+def makeStateLabels(stateList, sp_ch, NSpec):
+    # One int8 label per site - the species channel of the site, or NSpec for the vacancy.
+    # The networks expand these into occupancies on the fly (see GConvEmbed and msgPassNet).
+    chLabels = makeChannelLabels(sp_ch, NSpec, np.max(stateList) + 1)
+    stateLabels = chLabels[stateList]
+    # the vacancy site is always left empty, as in the occupancy tensors
+    stateLabels[:, 0] = NSpec
+    return stateLabels
+
+def makeOccupancies(stateLabels, NSpec):
+    # One-hot occupancies of species labels, one channel at a time. The vacancy label gets no channel.
+    stateOccs = np.zeros((stateLabels.shape[0], NSpec, stateLabels.shape[1]), dtype=np.int8)
+    for ch in range(NSpec):
+        stateOccs[:, ch, :] = stateLabels == ch
+    return stateOccs
+
+class JumpExpandedStates:
+    """
+    All-jump states built batch by batch from the base states, instead of being stored for every jump.
+    Row samp * Nj + jmp holds the base state samp, or, for exit states, its exit state after jump jmp, which
+    is the base state with its sites rearranged by JumpNewSites[jmp].
+    Slicing builds the states of the sliced rows as a tensor. Indexing with anything else (such as a
+    shuffling permutation) only selects the rows, and returns another JumpExpandedStates.
+    """
+    def __init__(self, baseStates, JumpNewSites, exits=False, rows=None):
+        """
+        :param baseStates: occupancies (Nsamples, NSpec, Nsites) or species labels (Nsamples, Nsites).
+        :param JumpNewSites: site permutation of each jump - shape (Nj, Nsites).
+        :param exits: whether the rows are exit states or the base states repeated for each jump.
+        :param rows: the all-jump rows held, in order. All of them if None.
+        """
+        self.baseStates = pt.as_tensor(baseStates)
+        self.JumpNewSites = pt.as_tensor(JumpNewSites).long()
+        self.exits = exits
+        self.rows = rows
+        self.Nj = self.JumpNewSites.shape[0]
+        Nrows = self.baseStates.shape[0] * self.Nj if rows is None else rows.shape[0]
+        self.shape = (Nrows,) + tuple(self.baseStates.shape[1:])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            rows = pt.arange(*idx.indices(self.shape[0])) if self.rows is None else self.rows[idx]
+            return self.makeStates(rows)
+
+        rows = pt.as_tensor(idx) if self.rows is None else self.rows[idx]
+        return JumpExpandedStates(self.baseStates, self.JumpNewSites, exits=self.exits, rows=rows)
+
+    def makeStates(self, rows):
+        states = self.baseStates[rows // self.Nj]
+        if not self.exits:
+            return states
+
+        # gather the sites of every state with the permutation of its jump
+        newSites = self.JumpNewSites[rows % self.Nj]
+        if states.dim() == 3:
+            newSites = newSites.unsqueeze(1).expand(-1, states.shape[1], -1)
+        return pt.gather(states, states.dim() - 1, newSites)
+
+def exitStates(states, JumpNewSites):
+    # Exit states of a batch of states (or on-site masks) after every jump, with the exit of state samp after
+    # jump jmp in row samp * Nj + jmp, as in JumpExpandedStates. The sites of all states are rearranged with one
+    # gather, on the device the states are on.
+    exits = states[..., JumpNewSites]
+    if states.dim() == 3:
+        # occupancies - (Nbatch, NSpec, Nj, Nsites) to (Nbatch, Nj, NSpec, Nsites)
+        exits = exits.transpose(1, 2)
+    return exits.reshape((-1,) + tuple(states.shape[1:]))
+
+def makeStateTensors(stateList, specsToTrain, VacSpec, JumpNewSites, AllJumps=False, labels=False, lazy=False):
     Nsamples = stateList.shape[0]
     Nj = JumpNewSites.shape[0]
     specs = np.unique(stateList[0])
@@ -69,18 +299,28 @@ def makeStateTensors(stateList, specsToTrain, VacSpec, JumpNewSites, AllJumps=Fa
         else:
             sp_ch[sp] = sp - 1
 
+    if AllJumps and lazy:
+        # Only the base states are stored, and the all-jump states are built batch by batch.
+        baseOccs, OnSites, sp_ch = makeStateTensors(stateList, specsToTrain, VacSpec, JumpNewSites, labels=labels)
+        stateOccs = JumpExpandedStates(baseOccs, JumpNewSites)
+        stateExits = JumpExpandedStates(baseOccs, JumpNewSites, exits=True)
+
+        Onsites_st1 = None
+        Onsites_st2 = None
+        if OnSites is not None:
+            Onsites_st1 = np.repeat(OnSites, Nj, axis=0)
+            Onsites_st2 = OnSites[:, JumpNewSites].reshape(Nsamples * Nj, Nsites)
+
+        return stateOccs, stateExits, Onsites_st1, Onsites_st2, sp_ch
+
+    # species labels of shape (Nsamples, Nsites), or (Nsamples * Nj, Nsites) for all jumps,
+    # converted to one-hot occupancies of shape (Nsamples(* Nj), NSpec, Nsites) if labels are not wanted
     if AllJumps:
-        stateOccs = np.zeros((Nsamples * Nj, NSpec, Nsites), dtype=np.int8)
-        stateExits = np.zeros((Nsamples * Nj, NSpec, Nsites), dtype=np.int8)
-        for stateInd in tqdm(range(Nsamples), position=0, leave=True):
-            state1 = stateList[stateInd]
-            for jmp in range(Nj):
-                state2 = state1[JumpNewSites[jmp]]
-                for site in range(1, Nsites):
-                    sp1 = state1[site]
-                    sp2 = state2[site]
-                    stateOccs[stateInd * Nj + jmp, sp_ch[sp1], site] = 1
-                    stateExits[stateInd * Nj + jmp, sp_ch[sp2], site] = 1
+        stateOccs = makeStateLabels(np.repeat(stateList, Nj, axis=0), sp_ch, NSpec)
+        stateExits = makeStateLabels(stateList[:, JumpNewSites].reshape(Nsamples * Nj, Nsites), sp_ch, NSpec)
+        if not labels:
+            stateOccs = makeOccupancies(stateOccs, NSpec)
+            stateExits = makeOccupancies(stateExits, NSpec)
 
         Onsites_st1 = makeOnSites(stateOccs, specsToTrain, VacSpec, sp_ch)
         Onsites_st2 = makeOnSites(stateExits, specsToTrain, VacSpec, sp_ch)
@@ -88,18 +328,23 @@ def makeStateTensors(stateList, specsToTrain, VacSpec, JumpNewSites, AllJumps=Fa
         return stateOccs, stateExits, Onsites_st1, Onsites_st2, sp_ch
 
     else:
-        stateOccs = np.zeros((Nsamples, NSpec, Nsites), dtype=np.int8)
-        for stateInd in tqdm(range(Nsamples), position=0, leave=True):
-            state1 = stateList[stateInd]
-            for site in range(1, Nsites):
-                sp1 = state1[site]
-                stateOccs[stateInd, sp_ch[sp1], site] = 1
+        stateOccs = makeStateLabels(stateList, sp_ch, NSpec)
+        if not labels:
+            stateOccs = makeOccupancies(stateOccs, NSpec)
 
         Onsites = makeOnSites(stateOccs, specsToTrain, VacSpec, sp_ch)
         return stateOccs, Onsites, sp_ch
 
+def makeSource2Dest(JumpNewSites):
+    # source2Dest[jump, site] is the site that the atom at "site" moves to in the state after "jump"
+    Nj, Nsites = JumpNewSites.shape
+    source2Dest = np.zeros_like(JumpNewSites)
+    source2Dest[np.arange(Nj).reshape(-1, 1), JumpNewSites] = np.arange(Nsites)
+    return source2Dest
+
 def makeComputeData(state1List, state2List, dispList, specsToTrain, VacSpec, rateList, JumpSelects,
-        AllJumpRates_st1, JumpNewSites, dxJumps, NNsiteList, N_train, AllJumps=False, mode="train", tracers=False):
+        AllJumpRates_st1, JumpNewSites, dxJumps, NNsiteList, N_train, AllJumps=False, mode="train", tracers=False,
+        labels=False, lazy=False, verbose=True):
 
     # tracer training only for non-vacancy species
     if tracers and VacSpec in specsToTrain:
@@ -127,77 +372,84 @@ def makeComputeData(state1List, state2List, dispList, specsToTrain, VacSpec, rat
     rateData = np.zeros(NData)
 
     if tracers:
-        GatherTensor_tracers = np.zeros((NData, Ndim, Nsites), dtype=int)
+        # only the jump out of each initial state is stored - the gathering permutations of the sites are
+        # looked up from source2Dest (see makeSource2Dest) batch by batch during training
+        GatherTensor_tracers = np.zeros(NData, dtype=int)
         dispData = np.zeros((NData, Ndim, Nsites))
     else:
         GatherTensor_tracers = None
         dispData = np.zeros((NData, 2, Ndim))
     
     # Make the multichannel occupancies
-    print("Building Occupancy Tensors.\nSpecies to train: {}".format(specsToTrain))
-    print("No. of jumps : {}".format(NData))
+    if verbose:
+        print("Building Occupancy Tensors.\nSpecies to train: {}".format(specsToTrain))
+        print("No. of jumps : {}".format(NData))
 
-    # Make a source to destination site tensor
-    source2Dest = np.zeros_like(JumpNewSites)
-    for jInd in range(dxJumps.shape[0]):
-        for destination in range(Nsites):
-            source = JumpNewSites[jInd, destination]
-            if destination == 0:
-                assert source == 0
-            source2Dest[jInd, source] = destination
+    Nj = dxJumps.shape[0]
+    assert np.all(JumpNewSites[:, 0] == 0)
 
     if AllJumps:
         State1_occs, State2_occs, OnSites_state1, OnSites_state2, sp_ch =\
-            makeStateTensors(state1List[:Nsamples], specsToTrain, VacSpec, JumpNewSites, AllJumps=AllJumps)
+            makeStateTensors(state1List[:Nsamples], specsToTrain, VacSpec, JumpNewSites, AllJumps=AllJumps,
+                             labels=labels, lazy=lazy)
 
-        for samp in tqdm(range(Nsamples), position=0, leave=True):
-            state1 = state1List[samp]
-            for jInd in range(dxJumps.shape[0]):
-                JumpSpec = state1[NNsvac[jInd]]
-                Idx = samp*dxJumps.shape[0] + jInd
-                rateData[Idx] = AllJumpRates_st1[samp, jInd]
+        # row samp*Nj + jInd holds jump jInd out of sample samp
+        jumps = np.tile(np.arange(Nj), Nsamples)
+        rateData[:] = AllJumpRates_st1[:Nsamples, :Nj].reshape(-1)
 
-                # Now make the gather tensor
-                if tracers:
-                    for siteInd in range(Nsites):
-                        if siteInd == NNsvac[jInd]:
-                            dispData[Idx, :, siteInd] = -dxJumps[jInd] * a
-                        for dim in range(Ndim):
-                            GatherTensor_tracers[Idx, dim, siteInd] = source2Dest[jInd, siteInd]
+        # Now record the jumps
+        if tracers:
+            dispData[np.arange(NData), :, NNsvac[jumps]] = -dxJumps[jumps] * a
+            GatherTensor_tracers[:] = jumps
 
-                else:
-                    dispData[Idx, 0, :] = dxJumps[jInd] * a
-                    if JumpSpec in specsToTrain:
-                        dispData[Idx, 1, :] -= dxJumps[jInd] * a
+        else:
+            dispData[:, 0, :] = dxJumps[jumps] * a
+            JumpSpecs = state1List[:Nsamples, NNsvac].reshape(-1)
+            specJumps = np.isin(JumpSpecs, specsToTrain)
+            dispData[specJumps, 1, :] -= dxJumps[jumps[specJumps]] * a
 
     else:
         # Next, Build the rates and displacements
         State1_occs, OnSites_state1, sp_ch = \
-            makeStateTensors(state1List[:Nsamples], specsToTrain, VacSpec, JumpNewSites, AllJumps=AllJumps)
+            makeStateTensors(state1List[:Nsamples], specsToTrain, VacSpec, JumpNewSites, AllJumps=AllJumps,
+                             labels=labels, lazy=lazy)
 
         State2_occs, OnSites_state2, _ = \
-            makeStateTensors(state2List[:Nsamples], specsToTrain, VacSpec, JumpNewSites, AllJumps=AllJumps)
-
-        for samp in tqdm(range(Nsamples), position=0, leave=True):
-            rateData[samp] = rateList[samp]
-            # Now make the gather tensor
-            if tracers:
-                jInd = JumpSelects[samp]
-                specJump = state1List[samp, NNsvac[jInd]]
-                for siteInd in range(Nsites):
-                    if siteInd == NNsvac[jInd]:  # whichever site jumps, record it. We'll extract it later if it is the
-                                                 # species of interest using the Onsites tensor.
-                        dispData[samp, :, siteInd] -= dispList[samp, 0, :]
-                    for dim in range(Ndim):
-                        GatherTensor_tracers[samp, dim, siteInd] = source2Dest[jInd, siteInd]
+            makeStateTensors(state2List[:Nsamples], specsToTrain, VacSpec, JumpNewSites, AllJumps=AllJumps,
+                             labels=labels, lazy=lazy)
+
+        rateData[:] = rateList[:Nsamples]
+        # Now record the jumps
+        if tracers:
+            jumps = JumpSelects[:Nsamples]
+            # whichever site jumps, record it. We'll extract it later if it is the
+            # species of interest using the Onsites tensor.
+            dispData[np.arange(Nsamples), :, NNsvac[jumps]] -= dispList[:Nsamples, 0, :]
+            GatherTensor_tracers[:] = jumps
 
-            else:
-                dispData[samp, 0, :] = dispList[samp, VacSpec, :]
-                dispData[samp, 1, :] = sum(dispList[samp, spec, :] for spec in specsToTrain)
+        else:
+            dispData[:, 0, :] = dispList[:Nsamples, VacSpec, :]
+            dispData[:, 1, :] = sum(dispList[:Nsamples, spec, :] for spec in specsToTrain)
 
     return State1_occs, State2_occs, rateData, dispData, GatherTensor_tracers, OnSites_state1, OnSites_state2, sp_ch
 
 
+def toStateTensor(StateOccs):
+    # lazily built all-jump states are used as they are
+    if isinstance(StateOccs, JumpExpandedStates):
+        return StateOccs
+    # memory-mapped states (see PreprocCache) are wrapped without a copy, so that all the runs on a node that
+    # map the same cached file share one physical copy of it
+    if isinstance(StateOccs, np.memmap):
+        return pt.from_numpy(StateOccs)
+    return pt.tensor(StateOccs)
+
+def toMaskTensor(OnSites):
+    # the int8 on-site masks of memory-mapped data are viewed as booleans without a copy, as for the states
+    if isinstance(OnSites, np.memmap) and OnSites.dtype == np.int8:
+        return pt.from_numpy(OnSites).view(pt.bool)
+    return pt.tensor(OnSites, dtype=pt.bool)
+
 def makeDataTensors(State1_Occs, State2_Occs, rates, disps, OnSites_st1, OnSites_st2, SpecsToTrain, VacSpec, sp_ch,
                     Ndim=3, tracers=False):
     # Do a small check that species channels were assigned correctly
@@ -211,8 +463,8 @@ def makeDataTensors(State1_Occs, State2_Occs, rates, disps, OnSites_st1, OnSites
                 assert item == key
 
     # Convert compute data to pytorch tensors
-    state1Data = pt.tensor(State1_Occs)
-    state2Data = pt.tensor(State2_Occs)
+    state1Data = toStateTensor(State1_Occs)
+    state2Data = toStateTensor(State2_Occs)
     rateData=None
     On_st1 = None 
     On_st2 = None
@@ -234,12 +486,356 @@ def makeDataTensors(State1_Occs, State2_Occs, rates, disps, OnSites_st1, OnSites
                 dispData = pt.tensor(disps).double().to(device)
         
         # Convert on-site tensor to boolean mask
-        On_st1 = pt.tensor(OnSites_st1, dtype=pt.bool)
-        On_st2 = pt.tensor(OnSites_st2, dtype=pt.bool)
+        On_st1 = toMaskTensor(OnSites_st1)
+        On_st2 = toMaskTensor(OnSites_st2)
 
     # print(dispData.shape, disps.shape)
     return state1Data, state2Data, dispData, rateData, On_st1, On_st2
 
+class DataRows:
+    """
+    Rows [start, stop) of a dataset of the data file (see Load_Data), which are only read from the file when
+    they are loaded. Passed to a PreprocCache, they are keyed on the name of the dataset and the rows instead of
+    their contents, so that no data is read at all for preprocessed data that is already in the cache.
+    """
+    def __init__(self, DataPath, name, start=0, stop=None):
+        """
+        :param DataPath: the data file.
+        :param name: name of the dataset in the data file (e.g. "InitStates").
+        :param start, stop: range of the rows. All rows after start if stop is None.
+        """
+        self.DataPath = DataPath
+        self.name = name
+        with h5py.File(DataPath, "r") as fl:
+            self.start, self.stop, _ = slice(start, stop).indices(fl[name].shape[0])
+
+    def __len__(self):
+        return max(self.stop - self.start, 0)
+
+    def __getitem__(self, rows):
+        # only contiguous row ranges are kept lazy
+        rows = range(self.start, self.stop)[rows]
+        assert rows.step == 1
+        return DataRows(self.DataPath, self.name, rows.start, rows.stop)
+
+    def load(self):
+        with h5py.File(self.DataPath, "r") as fl:
+            return np.array(fl[self.name][self.start : self.stop])
+
+# Version of the layout of the cached preprocessed data. Entries of other versions are never read.
+PreprocVersion = 1
+
+def fileHash(path, cacheDir=None):
+    # sha256 of the contents of a file. With a cache directory, the hash is stored there along with the size and
+    # modification time of the file, and is only computed again once either of them changes.
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    hashFile = None if cacheDir is None else os.path.join(cacheDir, "file_hashes.json")
+    hashes = {}
+    if hashFile is not None and os.path.isfile(hashFile):
+        with open(hashFile, "r") as fl:
+            hashes = json.load(fl)
+        if hashes.get(path, [None])[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return hashes[path][2]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as fl:
+        for chunk in iter(lambda: fl.read(1 << 24), b""):
+            h.update(chunk)
+
+    if hashFile is not None:
+        hashes[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+        tmpFile = "{}.{}".format(hashFile, os.getpid())
+        with open(tmpFile, "w") as fl:
+            json.dump(hashes, fl)
+        os.replace(tmpFile, hashFile)
+    return h.hexdigest()
+
+class PreprocCache:
+    """
+    On-disk cache of preprocessed data (the outputs of makeComputeData and makeStateTensors), so that runs on the
+    same data with the same options read it from memory-mapped .npy files instead of building it again.
+    An entry is keyed on the hashes of the data and crystal files, the version of the cached layout, the name of
+    the function and its arguments. The contents of arrays are never hashed: data from the data file is passed as
+    DataRows, which are keyed on the dataset and the rows and only read from the file if the entry is not in the
+    cache, and other arrays must come from the crystal file, of which only the shape and type enter the key.
+    Changing the data or any option therefore gives a new entry, and entries that are no longer used are evicted,
+    least recently used first, once the entries in the cache directory take up more than maxBytes.
+    Without a cache directory, the functions are just called on the loaded data.
+    """
+    def __init__(self, cacheDir, DataPath=None, CrysDatPath=None, maxBytes=None):
+        """
+        :param cacheDir: directory of the cache entries. Nothing is cached if None.
+        :param DataPath, CrysDatPath: the data and crystal files the preprocessed data comes from.
+        :param maxBytes: max. total size of the entries. Unbounded if None.
+        """
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        if cacheDir is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+            self.baseKey = {"version": PreprocVersion,
+                            "data": None if DataPath is None else fileHash(DataPath, cacheDir),
+                            "crys": None if CrysDatPath is None else fileHash(CrysDatPath, cacheDir)}
+
+    @staticmethod
+    def argKey(arg):
+        # the contents of data rows and arrays are identified by the file hashes, and everything else by its value
+        if isinstance(arg, DataRows):
+            return "data:{}:{}:{}".format(arg.name, arg.start, arg.stop)
+        if isinstance(arg, np.ndarray):
+            return "array:{}:{}".format(arg.dtype.str, arg.shape)
+        if isinstance(arg, (list, tuple)):
+            return [PreprocCache.argKey(a) for a in arg]
+        return repr(arg)
+
+    @staticmethod
+    def call(func, args, kwargs):
+        # data rows are only read from the data file here, when the data is preprocessed
+        def load(arg):
+            return arg.load() if isinstance(arg, DataRows) else arg
+        return func(*[load(arg) for arg in args], **{name: load(arg) for name, arg in kwargs.items()})
+
+    def entryKey(self, func, args, kwargs):
+        key = dict(self.baseKey, func=func.__name__, args=self.argKey(args),
+                   kwargs={name: self.argKey(arg) for name, arg in kwargs.items()})
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def __call__(self, func, *args, **kwargs):
+        if self.cacheDir is None:
+            return self.call(func, args, kwargs)
+
+        entry = os.path.join(self.cacheDir, self.entryKey(func, args, kwargs))
+        if os.path.isfile(os.path.join(entry, "meta.json")):
+            try:
+                outputs = self.load(entry)
+                print("Read preprocessed data from cache: {}".format(entry))
+                return outputs
+            except (OSError, ValueError, KeyError):
+                # incomplete or damaged entries are built again
+                shutil.rmtree(entry, ignore_errors=True)
+
+        outputs = self.call(func, args, kwargs)
+        self.save(entry, outputs)
+        self.evict(keep=entry)
+        return outputs
+
+    def save(self, entry, outputs):
+        # the entry is written to a temporary directory first, so that it only appears once it is complete
+        tmpEntry = "{}.tmp{}".format(entry, os.getpid())
+        os.makedirs(tmpEntry, exist_ok=True)
+        saved = {}
+
+        def saveArray(arr):
+            # arrays shared by several outputs (such as the base states of lazy all-jump states) are saved once
+            if id(arr) not in saved:
+                name = "arr_{}.npy".format(len(saved))
+                np.save(os.path.join(tmpEntry, name), np.asarray(arr))
+                saved[id(arr)] = name
+            return saved[id(arr)]
+
+        meta = []
+        for out in outputs:
+            if out is None:
+                meta.append({"type": "none"})
+            elif isinstance(out, dict):
+                meta.append({"type": "dict", "items": [[int(k), int(v)] for k, v in out.items()]})
+            elif isinstance(out, JumpExpandedStates):
+                meta.append({"type": "lazy", "base": saveArray(out.baseStates), "exits": out.exits,
+                             "JumpNewSites": saveArray(out.JumpNewSites),
+                             "rows": None if out.rows is None else saveArray(out.rows)})
+            else:
+                meta.append({"type": "array", "file": saveArray(out)})
+
+        with open(os.path.join(tmpEntry, "meta.json"), "w") as fl:
+            json.dump(meta, fl)
+
+        try:
+            os.rename(tmpEntry, entry)
+        except OSError:
+            # another run saved the same entry first
+            shutil.rmtree(tmpEntry, ignore_errors=True)
+
+    def load(self, entry):
+        with open(os.path.join(entry, "meta.json"), "r") as fl:
+            meta = json.load(fl)
+
+        # copy-on-write maps - the cached files are never changed by the runs that read them
+        def loadArray(name):
+            return np.load(os.path.join(entry, name), mmap_mode="c")
+
+        outputs = []
+        for out in meta:
+            if out["type"] == "none":
+                outputs.append(None)
+            elif out["type"] == "dict":
+                outputs.append({k: v for k, v in out["items"]})
+            elif out["type"] == "lazy":
+                rows = None if out["rows"] is None else pt.as_tensor(loadArray(out["rows"]))
+                outputs.append(JumpExpandedStates(loadArray(out["base"]), loadArray(out["JumpNewSites"]),
+                                                  exits=out["exits"], rows=rows))
+            else:
+                outputs.append(loadArray(out["file"]))
+
+        # the modification time of the entry records when it was last used
+        os.utime(os.path.join(entry, "meta.json"))
+        return tuple(outputs)
+
+    def entries(self):
+        # complete entries with their total size and the time they were last used
+        found = []
+        for name in os.listdir(self.cacheDir):
+            entry = os.path.join(self.cacheDir, name)
+            metaFile = os.path.join(entry, "meta.json")
+            if not os.path.isfile(metaFile) or ".tmp" in name:
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            found.append((os.path.getmtime(metaFile), size, entry))
+        return found
+
+    def evict(self, keep=None):
+        # remove the least recently used entries until the rest fit in maxBytes
+        if self.maxBytes is None:
+            return
+        found = sorted(self.entries())
+        total = sum(size for _, size, _ in found)
+        for _, size, entry in found:
+            if total <= self.maxBytes:
+                break
+            if entry == keep:
+                continue
+            print("Evicting preprocessed data from cache: {}".format(entry))
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+class KMCDataset(pt.utils.data.Dataset):
+    """
+    Streams the compute data (see makeComputeData) of a KMC data set from its HDF5 file in batches, so the
+    data set never has to be held in memory as a whole. A row of the data is a sample, or with AllJumps,
+    a jump out of a sample (row samp * z + jump). Item i is the batch of rows
+    rows[i * batch_size : (i + 1) * batch_size], built from only the samples those rows need.
+    Each batch is a tuple (state1, state2, rates, disps, GatherTensor, On_st1, On_st2, jProbs_st1, jProbs_st2)
+    of CPU tensors, with the same contents as the corresponding rows of the in-memory data, and None for the
+    tensors not needed. The jump probabilities are never streamed (boundary state training needs the data in
+    memory), so jProbs_st1 and jProbs_st2 are always None. Every worker process opens its own handle to the file.
+    In a distributed run, a stream sharded with "shard" builds only the share of each batch that a rank computes.
+    """
+    def __init__(self, DataPath, specsToTrain, VacSpec, JumpNewSites, dxJumps, NNsiteList, batch_size,
+                 rowStart=0, rowEnd=None, AllJumps=False, tracers=False, labels=False, InitStates="InitStates",
+                 num_workers=0):
+        """
+        :param DataPath: HDF5 file of the data set (see Load_Data).
+        :param batch_size: no. of rows in each batch.
+        :param rowStart, rowEnd: range of rows to stream. Until the last row if rowEnd is None.
+        :param InitStates: the data set of states to use as initial states. With "FinStates" and AllJumps, the
+        exit states of the final states are built.
+        :param num_workers: no. of worker processes that read and prepare batches ahead of time.
+        The rest are the same as makeComputeData.
+        """
+        self.DataPath = DataPath
+        self.specsToTrain = specsToTrain
+        self.VacSpec = VacSpec
+        self.JumpNewSites = JumpNewSites
+        self.dxJumps = dxJumps
+        self.NNsiteList = NNsiteList
+        self.batch_size = batch_size
+        self.AllJumps = AllJumps
+        self.tracers = tracers
+        self.labels = labels
+        self.InitStates = InitStates
+        self.num_workers = num_workers
+        self.rank = 0
+        self.world_size = 1
+        self.fl = None
+        self.flPid = None
+
+        with h5py.File(DataPath, "r") as fl:
+            Nsamples, self.Nsites = fl[InitStates].shape
+            # the species channels are fixed by the first state, as for the in-memory data
+            _, _, self.sp_ch = makeStateTensors(np.array(fl[InitStates][:1]), specsToTrain, VacSpec, JumpNewSites)
+
+        self.Nj = dxJumps.shape[0] if AllJumps else 1
+        rowEnd = Nsamples * self.Nj if rowEnd is None else rowEnd
+        self.rows = range(rowStart, rowEnd)
+
+    def __getstate__(self):
+        # open file handles are not passed on to worker processes
+        state = self.__dict__.copy()
+        state["fl"] = None
+        return state
+
+    def subset(self, rowStart, rowEnd):
+        # the same stream restricted to the rows [rowStart, rowEnd) of this one
+        sub = copy.copy(self)
+        sub.fl = None
+        sub.rows = self.rows[rowStart : rowEnd]
+        return sub
+
+    def shard(self, rank, world_size):
+        # the same stream, building only the share of each batch (see shardRange) computed by a rank
+        sub = copy.copy(self)
+        sub.fl = None
+        sub.rank = rank
+        sub.world_size = world_size
+        return sub
+
+    def loader(self, shuffle=False, seed=None, skip=0):
+        # batches are already built by the data set, so they are not collated again.
+        # All ranks of a distributed run shuffle the batches the same way with the same seed.
+        # The first "skip" batches of the order are left out without being read (to resume an epoch).
+        order = list(range(len(self)))
+        if shuffle:
+            generator = None if seed is None else pt.Generator().manual_seed(seed)
+            order = pt.randperm(len(self), generator=generator).tolist()
+        return pt.utils.data.DataLoader(self, batch_size=None, sampler=order[skip:], num_workers=self.num_workers,
+                                        prefetch_factor=2 if self.num_workers > 0 else None)
+
+    def __len__(self):
+        return (len(self.rows) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, i):
+        if self.fl is None or self.flPid != os.getpid():
+            self.fl = h5py.File(self.DataPath, "r")
+            self.flPid = os.getpid()
+
+        rows = self.rows[i * self.batch_size : (i + 1) * self.batch_size]
+        shardStart, shardStop = shardRange(rows.start, rows.stop, self.rank, self.world_size)
+        # an empty share is built from one row and emptied afterwards, so that it keeps the shapes of the data
+        rows = range(shardStart, max(shardStop, shardStart + 1))
+        sampStart = rows.start // self.Nj
+        sampEnd = (rows.stop - 1) // self.Nj + 1
+
+        fl = self.fl
+        AllJumpRates = "AllJumpRates_Init" if self.InitStates == "InitStates" else "AllJumpRates_Fin"
+        State1_occs, State2_occs, rates, disps, GatherTensor, OnSites_st1, OnSites_st2, sp_ch = \
+            makeComputeData(fl[self.InitStates][sampStart : sampEnd], fl["FinStates"][sampStart : sampEnd],
+                            fl["SpecDisps"][sampStart : sampEnd], self.specsToTrain, self.VacSpec,
+                            fl["rates"][sampStart : sampEnd], fl["JumpSelects"][sampStart : sampEnd],
+                            fl[AllJumpRates][sampStart : sampEnd], self.JumpNewSites, self.dxJumps, self.NNsiteList,
+                            None, AllJumps=self.AllJumps, mode="eval", tracers=self.tracers, labels=self.labels,
+                            lazy=True, verbose=False)
+        assert sp_ch == self.sp_ch
+
+        # rows of the batch among the rows of the samples read
+        batchRows = slice(shardStart - sampStart * self.Nj, shardStop - sampStart * self.Nj)
+
+        if self.tracers:
+            disps = disps[batchRows]
+        elif self.specsToTrain == [self.VacSpec]:
+            disps = disps[batchRows, 0, :]
+        else:
+            disps = disps[batchRows, 1, :]
+
+        batch = [pt.as_tensor(State1_occs[batchRows]), pt.as_tensor(State2_occs[batchRows]),
+                 pt.tensor(rates[batchRows]).double(), pt.tensor(disps).double(), None, None, None, None, None]
+
+        if self.tracers:
+            batch[4] = pt.tensor(GatherTensor[batchRows]).long()
+        if OnSites_st1 is not None:
+            batch[5] = pt.tensor(OnSites_st1[batchRows], dtype=pt.bool)
+            batch[6] = pt.tensor(OnSites_st2[batchRows], dtype=pt.bool)
+
+        return tuple(batch)
+
 # All vacancy batch output calculations to be done here
 def vacBatchOuts(y1, y2, jProbs_st1, jProbs_st2, Boundary_Train):
     if not Boundary_Train:
@@ -318,19 +914,32 @@ def sort_jp(jProbs_st1, jProbs_st2, jumpSort):
 
 
 # function to train collective transport coefficients for a single batch.
-def train_batch_collective(gNet, batch, end, state1Batch, state2Batch, rateBatch, dispBatch,
+# Run the network on the initial and final states of a batch.
+# With concat, both are stacked along the batch axis and go through a single forward pass, so that the
+# weight rotation and the per-call overheads are paid once instead of twice.
+def forwardStates(gNet, state1Batch, state2Batch, dtype, concat=False):
+    # the network may run in lower precision, but the transport coefficients are computed in double precision
+    with autocastContext(dtype):
+        if concat:
+            y1, y2 = pt.split(gNet(pt.cat((state1Batch, state2Batch), dim=0)),
+                              [state1Batch.shape[0], state2Batch.shape[0]], dim=0)
+        else:
+            y1 = gNet(state1Batch)
+            y2 = gNet(state2Batch)
+    return y1.double(), y2.double()
+
+
+def train_batch_collective(gNet, state1Batch, state2Batch, rateBatch, dispBatch,
                            jProbs_st1_batch, jProbs_st2_batch, SpecsToTrain, VacSpec,
-                           On_st1, On_st2, Boundary_train=False, AddOnSites=False, L0=1.0):
+                           On_st1Batch, On_st2Batch, Boundary_train=False, AddOnSites=False, L0=1.0, dtype=pt.double,
+                           concat=False):
 
-    y1 = gNet(state1Batch)
-    y2 = gNet(state2Batch)
+    y1, y2 = forwardStates(gNet, state1Batch, state2Batch, dtype, concat=concat)
 
     if SpecsToTrain == [VacSpec]:
         y1, y2 = vacBatchOuts(y1, y2, jProbs_st1_batch, jProbs_st2_batch, Boundary_train)
 
     else:
-        On_st1Batch = On_st1[batch: end]
-        On_st2Batch = On_st2[batch: end]
         y1, y2 = SpecBatchOuts(y1, y2, On_st1Batch, On_st2Batch, jProbs_st1_batch, jProbs_st2_batch,
                                Boundary_train, AddOnSites)
 
@@ -340,16 +949,19 @@ def train_batch_collective(gNet, batch, end, state1Batch, state2Batch, rateBatch
 
 
 # function to train tracer transport coefficients for a single batch.
-def train_batch_tracer(gNet, batch, end, state1Batch, state2Batch, rateBatch, dispBatch, GatherTensorBatch,
-                       SpecsToTrain, VacSpec, On_st1, L0=1.0):
+def train_batch_tracer(gNet, state1Batch, state2Batch, rateBatch, dispBatch, JumpBatch, source2Dest,
+                       SpecsToTrain, VacSpec, On_st1Batch, L0=1.0, dtype=pt.double, concat=False):
 
     if VacSpec in SpecsToTrain:
         raise NotImplementedError("Tracer training type is not meant for single vacancy.")
 
-    y1 = gNet(state1Batch)[:, 0, :, :]
-    y2 = gNet(state2Batch)[:, 0, :, :]
+    y1, y2 = forwardStates(gNet, state1Batch, state2Batch, dtype, concat=concat)
+    y1 = y1[:, 0, :, :]
+    y2 = y2[:, 0, :, :]
 
     # rearrange y2 so that sites correspond to their original positions in the initial state.
+    # The permutation of the sites is looked up for the jump out of each initial state.
+    GatherTensorBatch = source2Dest[JumpBatch].unsqueeze(1).expand(-1, y2.shape[1], -1)
     y2_re = pt.gather(y2, 2, GatherTensorBatch)
     # y1 and y2 have shape (Nbatch, 3, Nsites)
 
@@ -369,7 +981,7 @@ def train_batch_tracer(gNet, batch, end, state1Batch, state2Batch, rateBatch, di
     # diff_sites has shape (Nbatch, Nsites)
 
     # sum the contributions by each site occupied by the species of interest in the initial state
-    On_st1Batch = On_st1[batch: end].to(device)
+    On_st1Batch = On_st1Batch.to(device)
     #OnCounts = pt.sum(On_st1Batch, dim=1)
     diff_sum_sites = pt.sum(diff_sites_all * On_st1Batch, dim=1) #/ OnCounts
     diff_batch_total = pt.sum(diff_sum_sites) / L0
@@ -377,30 +989,306 @@ def train_batch_tracer(gNet, batch, end, state1Batch, state2Batch, rateBatch, di
     return diff_batch_total, y1, y2
 
 
+# Transport coefficients of each network of a pool (summed over the samples, as in training) over batches of
+# data (see dataBatches and KMCDataset), with every batch scored by all the networks while it is on the device.
+# In a distributed run, every rank has its share of each batch, and the sums of all the ranks are added up.
+def batchDiffs(pool, batches, SpecsToTrain, VacSpec, tracers=False, source2Dest=None, Boundary_train=False,
+               AddOnSites=True, dtype=pt.double, DDP=False, concat=False, prefetch=0):
+    diffs = pt.zeros(len(pool), dtype=pt.double, device=device)
+    with pt.no_grad():
+        if prefetch > 0:
+            batches = Prefetcher(batches, dtype, depth=prefetch)
+
+        for state1Batch, state2Batch, rateBatch, dispBatch, GatherTensorsBatch, On_st1Batch, On_st2Batch,\
+                jProbs_st1_batch, jProbs_st2_batch in batches:
+
+            state1Batch = batchStates(state1Batch, dtype)
+            state2Batch = batchStates(state2Batch, dtype)
+
+            rateBatch = rateBatch.to(device)
+            dispBatch = dispBatch.to(device)
+            if tracers:
+                GatherTensorsBatch = GatherTensorsBatch.to(device)
+
+            for netInd, net in enumerate(pool):
+                if tracers:
+                    diff_batch, _, _ = train_batch_tracer(net, state1Batch, state2Batch, rateBatch,
+                                                          dispBatch, GatherTensorsBatch, source2Dest, SpecsToTrain,
+                                                          VacSpec, On_st1Batch, dtype=dtype, concat=concat)
+
+                else:
+                    diff_batch, _, _ = train_batch_collective(net, state1Batch, state2Batch, rateBatch,
+                                                              dispBatch, jProbs_st1_batch, jProbs_st2_batch,
+                                                              SpecsToTrain, VacSpec, On_st1Batch, On_st2Batch,
+                                                              Boundary_train=Boundary_train, AddOnSites=AddOnSites,
+                                                              dtype=dtype, concat=concat)
+
+                diffs[netInd] += diff_batch
+
+    if DDP:
+        # sum up the shares of all the ranks
+        pt.distributed.all_reduce(diffs)
+
+    return diffs.cpu().numpy()
+
+
+def getRNGState():
+    # states of all the random number generators that training can draw from
+    return {"torch": pt.get_rng_state(), "numpy": np.random.get_state(),
+            "cuda": pt.cuda.get_rng_state_all() if pt.cuda.is_available() else None}
+
+def setRNGState(state):
+    pt.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    if state["cuda"] is not None and pt.cuda.is_available():
+        pt.cuda.set_rng_state_all(state["cuda"])
+
+class CheckpointWriter:
+    """
+    Writes checkpoints (and removes old ones) on a background thread, in the order they are given, so that
+    training does not wait for the file system. The tensors of a checkpoint are copied to the CPU when it is
+    given, so that training can go on changing the originals. Every file is written to a temporary file next to
+    it and renamed, so that a checkpoint is either complete or not there at all, even if the job is killed while
+    writing it. Errors of the writes are raised by the next call, or by close, which waits for all the writes.
+    """
+    def __init__(self, background=True):
+        self.queue = queue.Queue()
+        self.error = None
+        self.worker = None
+        if background:
+            self.worker = threading.Thread(target=self.work, daemon=True)
+            self.worker.start()
+
+    @staticmethod
+    def snapshot(obj):
+        if isinstance(obj, pt.Tensor):
+            return obj.detach().to("cpu", copy=True)
+        if isinstance(obj, dict):
+            return {key: CheckpointWriter.snapshot(val) for key, val in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(CheckpointWriter.snapshot(val) for val in obj)
+        return copy.deepcopy(obj)
+
+    @staticmethod
+    def write(task):
+        obj, path = task
+        if obj is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmpPath = "{}.tmp{}".format(path, os.getpid())
+        pt.save(obj, tmpPath)
+        os.replace(tmpPath, path)
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                if self.error is None:
+                    self.write(task)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def put(self, task):
+        if self.error is not None:
+            raise self.error
+        if self.worker is None:
+            self.write(task)
+        else:
+            self.queue.put(task)
+
+    def save(self, obj, path):
+        self.put((self.snapshot(obj), path))
+
+    def remove(self, path):
+        self.put((None, path))
+
+    def close(self):
+        if self.worker is not None:
+            self.queue.put(None)
+            self.worker.join()
+            self.worker = None
+        if self.error is not None:
+            raise self.error
+
+class Profiler:
+    """
+    Wall times of the phases of every training epoch - reading the batches ("data"), moving them to the device
+    ("transfer"), the forward pass and the loss ("forward"), the backward pass ("backward"), the optimizer steps
+    ("step"), validation and checkpoints - along with the throughput and the peak resident memory of the process,
+    written as one JSON line per epoch to a log file. With a CUDA device, the no. of allocations and the peak memory
+    allocated on the device are recorded as well (there is no such count for the CPU), and the device is
+    synchronized around every phase, so that the time of its kernels is counted in the phase that launched them.
+    The torch.profiler trace of one chosen epoch can also be saved, with the phases marked in it.
+    A Profiler without a log file measures nothing, and costs (almost) nothing.
+    """
+    def __init__(self, logPath=None, traceEpoch=None, tracePath=None):
+        """
+        :param logPath: JSON lines file the records are appended to. Nothing is measured if None.
+        :param traceEpoch: epoch to record a torch.profiler trace for (none if None).
+        :param tracePath: Chrome trace file the trace is saved to (viewed with chrome://tracing or perfetto).
+        """
+        self.logPath = logPath
+        self.traceEpoch = traceEpoch
+        self.tracePath = tracePath
+        self.trace = None
+        self.times = {}
+        self.samples = 0
+
+    @staticmethod
+    def sync():
+        if device.type == "cuda":
+            pt.cuda.synchronize()
+
+    def phase(self, name):
+        # context of a phase, the time of which is summed over the epoch
+        if self.logPath is None:
+            return contextlib.nullcontext()
+        return self.timed(name)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        self.sync()
+        start = time.perf_counter()
+        with pt.profiler.record_function(name):
+            yield
+        self.sync()
+        self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+    def batches(self, batches):
+        # the batches of an epoch, with the time spent waiting for each of them counted as the "data" phase
+        if self.logPath is None:
+            return batches
+        return self.timedBatches(batches)
+
+    def timedBatches(self, batches):
+        batches = iter(batches)
+        while True:
+            with self.phase("data"):
+                batch = next(batches, None)
+            if batch is None:
+                return
+            yield batch
+
+    def count(self, Nsamples):
+        self.samples += Nsamples
+
+    def log(self, record):
+        if self.logPath is not None:
+            with open(self.logPath, "a") as fl:
+                fl.write(json.dumps(record) + "\n")
+
+    def startEpoch(self, epoch):
+        if self.logPath is None:
+            return
+        self.epoch = epoch
+        self.times = {}
+        self.samples = 0
+        if device.type == "cuda":
+            pt.cuda.reset_peak_memory_stats()
+            self.allocations = pt.cuda.memory_stats().get("allocation.all.allocated", 0)
+        if epoch == self.traceEpoch:
+            activities = [pt.profiler.ProfilerActivity.CPU]
+            if device.type == "cuda":
+                activities.append(pt.profiler.ProfilerActivity.CUDA)
+            self.trace = pt.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.trace.start()
+        self.sync()
+        self.start = time.perf_counter()
+
+    def endEpoch(self):
+        if self.logPath is None:
+            return
+        self.sync()
+        wall = time.perf_counter() - self.start
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace.export_chrome_trace(self.tracePath)
+            self.trace = None
+
+        # ru_maxrss is in kB on Linux, and the peak is over the whole run so far
+        record = {"epoch": self.epoch, "wall": wall, "phases": self.times, "other": wall - sum(self.times.values()),
+                  "samples": self.samples, "samples_per_sec": self.samples / wall,
+                  "peak_rss_MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        if device.type == "cuda":
+            # no. of allocations made by the caching allocator in the epoch, and the peak memory allocated
+            record["allocations"] = pt.cuda.memory_stats().get("allocation.all.allocated", 0) - self.allocations
+            record["peak_allocated_MB"] = pt.cuda.max_memory_allocated() / 2**20
+        self.log(record)
+
+
 """## Write the training loop"""
 def Train(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2, rates, disps,
           jProbs_st1, jProbs_st2, SpecsToTrain, sp_ch, VacSpec, start_ep, end_ep, interval, N_train,
           gNet, lRate=0.001, batch_size=128, scratch_if_no_init=True, DPr=False, Boundary_train=False, jumpSort=True,
-          AddOnSites=False, scaleL0=False, chkpt=True, randomize=False, GatherTensor=None,
-          tracers=False, decay=0.0005):
+          AddOnSites=False, scaleL0=False, chkpt=True, randomize=False, GatherTensor=None, JumpNewSites=None,
+          tracers=False, decay=0.0005, dtype=pt.double, dataStream=None, DDP=False, concat=False,
+          prefetch=0, seed=None, valEvery=0, lrSchedule=None, lrFactor=0.5, lrPatience=2, stopPatience=0,
+          resume=False, chkptBatches=0, profiler=None):
+    # With valEvery > 0, the network is validated every valEvery epochs on the rows of the data after the
+    # first N_train, which are held out of training. The validation transport coefficients drive the "plateau"
+    # learning rate schedule and early stopping (after stopPatience validations without improvement), and only
+    # the checkpoints of the best and the last validated networks written in the run are kept.
+    # Along with every checkpoint (and every chkptBatches batches, if given), the whole state of the training
+    # is saved to train_state.pt in dirPath. With resume, training continues from that state, including the
+    # optimizer, the random number generators and the position in the epoch, as if it had never stopped.
+    # With a profiler (see Profiler), the time of each phase of every epoch is logged.
 
     if tracers and VacSpec in SpecsToTrain:
         raise NotImplementedError("Tracer training is only for non-vacancy species.")
 
+    if lrSchedule not in (None, "plateau", "cosine"):
+        raise ValueError("Learning rate schedule must be plateau or cosine, but given : {}".format(lrSchedule))
+
+    if valEvery <= 0 and (lrSchedule == "plateau" or stopPatience > 0):
+        raise ValueError("The plateau learning rate schedule and early stopping need validation (see valEvery).")
+
+    rank, world_size = distInfo() if DDP else (0, 1)
+
+    if dataStream is not None and Boundary_train:
+        raise NotImplementedError("Boundary state training is not supported with streamed data.")
+
+    if profiler is None:
+        profiler = Profiler()
 
     # 1. get the necessary data tensors
     if not tracers:
         print("Training collective transport coefficients.")
-        Ndim = disps.shape[2]
     else:
         print("Training tracer transport coefficients.")
-        Ndim = disps.shape[1]
 
-    state1Data, state2Data, dispData, rateData, On_st1, On_st2 = makeDataTensors(State1_Occs, State2_Occs, rates, disps,
-            OnSites_st1, OnSites_st2, SpecsToTrain, VacSpec, sp_ch, Ndim=Ndim, tracers=tracers)
+    if dataStream is None:
+        Ndim = disps.shape[1] if tracers else disps.shape[2]
+        state1Data, state2Data, dispData, rateData, On_st1, On_st2 = makeDataTensors(State1_Occs, State2_Occs, rates,
+                disps, OnSites_st1, OnSites_st2, SpecsToTrain, VacSpec, sp_ch, Ndim=Ndim, tracers=tracers)
+
+    else:
+        print("Streaming training data from: {}".format(dataStream.DataPath))
+        if valEvery > 0:
+            valStream = dataStream.subset(N_train, None)
+            dataStream = dataStream.subset(0, N_train)
+        assert len(dataStream.rows) == N_train
+
+    if valEvery > 0:
+        N_val = (state1Data.shape[0] if dataStream is None else N_train + len(valStream.rows)) - N_train
+        if N_val <= 0:
+            raise ValueError("No validation samples after the {} training samples.".format(N_train))
+        print("Validating every {} epochs on {} held-out samples.".format(valEvery, N_val))
 
     # 2. Some safety checks
-    if not tracers:
+    source2Dest = None
+    if tracers:
+        assert JumpNewSites is not None
+        source2Dest = pt.tensor(makeSource2Dest(JumpNewSites)).long().to(device)
+
+    if dataStream is not None:
+        GatherTensor_tracers = None
+
+    elif not tracers:
         if SpecsToTrain == [VacSpec]:
             assert pt.allclose(dispData.cpu(), pt.tensor(disps[:, 0, :], dtype=pt.double))
         else:
@@ -412,18 +1300,25 @@ def Train(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2, rates,
     else:
         assert dispData.shape[0] == state1Data.shape[0]
         # assert dispData.shape[1] == Ndim, "{}".format(dispData.shape)
-        assert dispData.shape[2] == State2_Occs.shape[2]
+        assert dispData.shape[2] == State2_Occs.shape[-1]
 
-        # check gathering tensor
+        # check the jumps
         assert GatherTensor is not None
-        assert GatherTensor.shape[0] == state1Data.shape[0]
-        assert GatherTensor.shape[1] == Ndim
-        assert GatherTensor.shape[2] == State2_Occs.shape[2]
+        assert GatherTensor.shape == (state1Data.shape[0],)
+        assert source2Dest.shape[1] == State2_Occs.shape[-1]
         GatherTensor_tracers = pt.tensor(GatherTensor).long().to(device)
 
     # 3. scale with L0 if indicated
     if scaleL0:
-        L0 = pt.dot(rateData, pt.norm(dispData, dim=1)**2)/(6.0 * dispData.shape[0])
+        if dataStream is None:
+            # only the training samples, without any held-out for validation
+            L0 = pt.dot(rateData[:N_train], pt.norm(dispData[:N_train], dim=1)**2)/(6.0 * N_train)
+        else:
+            # one pass over the streamed data, with the shares of all ranks summed up
+            L0 = sum(pt.dot(batch[2], pt.norm(batch[3], dim=1)**2)
+                     for batch in dataStream.shard(rank, world_size).loader()) / (6.0 * N_train)
+            if DDP:
+                pt.distributed.all_reduce(L0)
         L0 = L0.item()
     else:
         L0 = 1.0
@@ -434,105 +1329,257 @@ def Train(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2, rates,
     if Boundary_train:
         assert gNet.net[-3].Psi.shape[0] == jProbs_st1.shape[1] == jProbs_st2.shape[1] 
         print("Boundary training indicated. Using jump probabilities.")
-        jProbs_st1, jProbs_st2 = sort_jp(jProbs_st1[:N_train], jProbs_st2[:N_train], jumpSort)
+        # the held-out validation samples are kept after the training samples
+        N_jp = N_train + N_val if valEvery > 0 else N_train
+        jProbs_st1, jProbs_st2 = sort_jp(jProbs_st1[:N_jp], jProbs_st2[:N_jp], jumpSort)
 
-    # 5. convert to data parallel if needed. ToDo: move to DistributedDataParallel from DataParallel.
+    # 5. convert to data parallel if needed. For multiple processes, see the DDP option.
     if pt.cuda.device_count() > 1 and DPr:
         print("Running on Devices : {}".format(DeviceIDList))
         gNet = nn.DataParallel(gNet, device_ids=DeviceIDList)
 
     # 6. Load saved networks if needed.
-    try:
-        # As long as the same crysdats are used, this will not change
-        gNet.load_state_dict(pt.load(dirPath + "/ep_{1}.pt".format(T, start_ep), map_location="cpu"))
+    trainStatePath = dirPath + "/train_state.pt"
+    trainState = None
+    startBatch = 0
+    # first epoch of the training run, from which the validations are counted
+    valStart = start_ep
+    if resume:
+        if not os.path.exists(trainStatePath):
+            raise FileNotFoundError("No training state to resume from in {}".format(dirPath))
+        trainState = pt.load(trainStatePath, map_location="cpu", weights_only=False)
+        gNet.load_state_dict(trainState["net"])
+        start_ep, startBatch, valStart = trainState["epoch"], trainState["batch"], trainState["valStart"]
+        print("Resuming from epoch {}, batch {}".format(start_ep, startBatch), flush=True)
 
-        if scratch_if_no_init and start_ep == 0:
-            print("Training from scratch indicated (check option --Scratch), but saved initial network for epoch 0 found at", flush=True)
-            print("save/load directory : {}".format(dirPath), flush=True)
-            print("Terminating so as not to replace existing this pre-existing initial network.".format(dirPath), flush=True)
-            raise RuntimeError("Terminating out of caution.")
+    else:
+        try:
+            # As long as the same crysdats are used, this will not change
+            gNet.load_state_dict(pt.load(dirPath + "/ep_{1}.pt".format(T, start_ep), map_location="cpu"))
 
-        print("Starting from epoch {}".format(start_ep), flush=True)
+            if scratch_if_no_init and start_ep == 0:
+                print("Training from scratch indicated (check option --Scratch), but saved initial network for epoch 0 found at", flush=True)
+                print("save/load directory : {}".format(dirPath), flush=True)
+                print("Terminating so as not to replace existing this pre-existing initial network.".format(dirPath), flush=True)
+                raise RuntimeError("Terminating out of caution.")
 
-    except:
-        if scratch_if_no_init:
-            print("No Network found. Starting from scratch", flush=True)
-        else:
-            raise FileNotFoundError("Required saved networks not found in {} at epoch {}".format(dirPath, start_ep))
+            print("Starting from epoch {}".format(start_ep), flush=True)
+
+        except:
+            if scratch_if_no_init:
+                print("No Network found. Starting from scratch", flush=True)
+            else:
+                raise FileNotFoundError("Required saved networks not found in {} at epoch {}".format(dirPath, start_ep))
 
     print("Batch size : {}".format(batch_size))
 
     # 6. Check if we want to randomize the data at every epoch
     if randomize:
-        print("Shuffling data at every epoch.")
+        print("Shuffling data at every epoch{}.".format("" if seed is None else " with seed {}".format(seed)))
 
     # 7. Create optimizers, any additional tensors
     gNet.to(device)
+    if DDP:
+        # every rank starts from the network of rank 0, and the gradients are all-reduced in backward
+        print("Distributed training with {} processes.".format(world_size))
+        gNet = nn.parallel.DistributedDataParallel(gNet)
+        if dataStream is not None:
+            dataStream = dataStream.shard(rank, world_size)
+
     opt = pt.optim.Adam(gNet.parameters(), lr=lRate, weight_decay=decay)
+    diff0 = None
     y1BatchTest = None
     y2BatchTest = None
+    if trainState is not None:
+        opt.load_state_dict(trainState["opt"])
+        diff0, y1BatchTest, y2BatchTest = trainState["test"]
+
+    # 7.1 Learning rate schedules. The cosine schedule is a function of the epoch itself, so that a resumed
+    # run continues where it left off.
+    scheduler = None
+    if lrSchedule == "plateau":
+        scheduler = pt.optim.lr_scheduler.ReduceLROnPlateau(opt, mode="min", factor=lrFactor, patience=lrPatience)
+    elif lrSchedule == "cosine":
+        scheduler = pt.optim.lr_scheduler.LambdaLR(
+            opt, lambda ep: 0.5 * (1.0 + np.cos(np.pi * (start_ep + ep) / (end_ep + 1))))
+    if trainState is not None and lrSchedule == "plateau":
+        scheduler.load_state_dict(trainState["scheduler"])
+
+    # 7.2 Validation history of the network directory, and the checkpoints written in this run.
+    # A resumed run picks up the best network of the epochs before it.
+    valLog = dirPath + "/validation.json"
+    history = []
+    if trainState is not None:
+        history = trainState["validation"]["history"]
+    elif valEvery > 0 and chkpt and start_ep > 0 and os.path.exists(valLog):
+        with open(valLog, "r") as fl:
+            history = [entry for entry in json.load(fl)["history"] if entry["epoch"] < start_ep]
+    best = min(history, key=lambda entry: entry["L_val"]) if history else None
+    Nbad = 0 if trainState is None else trainState["validation"]["Nbad"]
+    saved = []
+    writer = CheckpointWriter() if chkpt and rank == 0 else None
+
+    def validate():
+        net = gNet.module if DDP else gNet
+        if dataStream is not None:
+            batches = valStream.shard(rank, world_size).loader()
+        else:
+            batches = dataBatches(N_train, N_train + N_val, batch_size, state1Data, state2Data, rateData, dispData,
+                                  GatherTensor_tracers, On_st1, On_st2, jProbs_st1, jProbs_st2,
+                                  rank=rank, world_size=world_size)
+        return batchDiffs([net], batches, SpecsToTrain, VacSpec, tracers=tracers, source2Dest=source2Dest,
+                          Boundary_train=Boundary_train, AddOnSites=AddOnSites, dtype=dtype, DDP=DDP,
+                          concat=concat, prefetch=prefetch)[0] / N_val
+
+    def save(epoch):
+        writer.save((gNet.module if DDP else gNet).state_dict(), dirPath + "/ep_{0}.pt".format(epoch))
+        if epoch not in saved:
+            saved.append(epoch)
+        if valEvery > 0:
+            # only the best and the last checkpoints of this run are kept
+            for ep in saved[:-1]:
+                if best is None or ep != best["epoch"]:
+                    writer.remove(dirPath + "/ep_{0}.pt".format(ep))
+                    saved.remove(ep)
+
+    def saveState(epoch, batch, rng):
+        # training picks up at the given batch of the epoch, with the random number generators as they were
+        # before the batches of the epoch were drawn
+        writer.save({"epoch": epoch, "batch": batch, "valStart": valStart, "rng": rng,
+                     "net": (gNet.module if DDP else gNet).state_dict(), "opt": opt.state_dict(),
+                     "scheduler": scheduler.state_dict() if lrSchedule == "plateau" else None,
+                     "validation": {"history": history, "Nbad": Nbad}, "test": (diff0, y1BatchTest, y2BatchTest)},
+                    trainStatePath)
 
     # 8. start the training loop
     print("Starting Training loop")
 
     for epoch in tqdm(range(start_ep, end_ep + 1), position=0, leave=True):
-        
-        ## checkpoint
-        if epoch % interval == 0 and chkpt:
-            pt.save(gNet.state_dict(), dirPath + "/ep_{0}.pt".format(epoch))
 
-        if randomize:
-            randPerm = pt.randperm(state1Data.shape[0])
-            state1Data = state1Data[randPerm]
-            state2Data = state2Data[randPerm]
-            rateData = rateData[randPerm]
-            dispData = dispData[randPerm]
+        ## validation of the network at the start of the epoch - all ranks get the same transport coefficients.
+        ## An epoch resumed part of the way through (or at its start) was validated and checkpointed before.
+        profiler.startEpoch(epoch)
+        resumed = trainState is not None and epoch == start_ep
+        improved = stop = False
+        if valEvery > 0 and (epoch - valStart) % valEvery == 0 and not resumed:
+            with profiler.phase("validation"):
+                L_val = float(validate())
+            history.append({"epoch": epoch, "L_val": L_val, "lr": opt.param_groups[0]["lr"]})
+            improved = best is None or L_val < best["L_val"]
+            if improved:
+                best = history[-1]
+                Nbad = 0
+            else:
+                Nbad += 1
+            print("Epoch {}: validation L = {:.6e}, best = {:.6e} at epoch {}".format(epoch, L_val, best["L_val"],
+                                                                                     best["epoch"]), flush=True)
+
+            if lrSchedule == "plateau":
+                scheduler.step(L_val)
+            stop = stopPatience > 0 and Nbad >= stopPatience
 
-            if tracers:
-                GatherTensor_tracers = GatherTensor_tracers[randPerm]
-            if Boundary_train:
-                jProbs_st1 = jProbs_st1[randPerm]
-                jProbs_st2 = jProbs_st2[randPerm]
-            if SpecsToTrain != [VacSpec]:
-                On_st1 = On_st1[randPerm]
-                On_st2 = On_st2[randPerm]
-
-        for batch in range(0, N_train, batch_size):
+            if chkpt and rank == 0:
+                with open(valLog, "w") as fl:
+                    json.dump({"best_epoch": best["epoch"], "best_L_val": best["L_val"], "history": history}, fl,
+                              indent=1)
+
+        ## checkpoint
+        if resumed:
+            setRNGState(trainState["rng"])
+        rng = getRNGState()
+        if (epoch % interval == 0 or improved or stop) and chkpt and rank == 0 and not resumed:
+            with profiler.phase("checkpoint"):
+                save(epoch)
+                if not stop:
+                    saveState(epoch, 0, rng)
+
+        if stop:
+            print("Stopping early at epoch {} after {} validations without improvement.".format(epoch, Nbad))
+            profiler.endEpoch()
+            break
+
+        # batches of the epoch already trained on before it was resumed are skipped
+        skip = startBatch if resumed else 0
+
+        # with a seed, the order of every epoch is fixed by the seed and the epoch, also when training is resumed
+        epochSeed = None if seed is None else seed + epoch
+
+        if dataStream is not None:
+            # streamed batches can only be shuffled as a whole
+            if DDP and epochSeed is None:
+                epochSeed = epoch
+            batches = dataStream.loader(shuffle=randomize, seed=epochSeed, skip=skip)
+
+        else:
+            # only an index array is shuffled, and the batches are gathered from the data through it
+            order = None
+            if randomize:
+                generator = None if epochSeed is None else pt.Generator().manual_seed(epochSeed)
+                # held-out validation samples after the training samples are never shuffled into training
+                order = pt.randperm(N_train, generator=generator)
+                if DDP and epochSeed is None:
+                    pt.distributed.broadcast(order, 0)
+
+            batches = dataBatches(skip * batch_size, N_train, batch_size, state1Data, state2Data, rateData, dispData,
+                                  GatherTensor_tracers, On_st1, On_st2, jProbs_st1, jProbs_st2,
+                                  rank=rank, world_size=world_size, order=order)
+
+        if prefetch > 0:
+            batches = Prefetcher(batches, dtype, depth=prefetch)
+
+        for batchInd, (state1Batch, state2Batch, rateBatch, dispBatch, GatherTensorsBatch, On_st1Batch, On_st2Batch,
+                       jProbs_st1_batch, jProbs_st2_batch) in enumerate(profiler.batches(batches), start=skip):
             opt.zero_grad()
-            end = min(batch + batch_size, N_train)
 
-            state1Batch = state1Data[batch: end].double().to(device)
-            state2Batch = state2Data[batch: end].double().to(device)
+            with profiler.phase("transfer"):
+                state1Batch = batchStates(state1Batch, dtype)
+                state2Batch = batchStates(state2Batch, dtype)
 
-            rateBatch = rateData[batch: end]
-            dispBatch = dispData[batch: end]
+                rateBatch = rateBatch.to(device)
+                dispBatch = dispBatch.to(device)
 
-            if tracers:
-                GatherTensorsBatch = GatherTensor_tracers[batch : end]
+                if tracers:
+                    GatherTensorsBatch = GatherTensorsBatch.to(device)
 
-                diff, y1, y2 = train_batch_tracer(gNet, batch, end, state1Batch, state2Batch, rateBatch, dispBatch,
-                                                  GatherTensorsBatch, SpecsToTrain, VacSpec, On_st1, L0=L0)
+            with profiler.phase("forward"):
+                if tracers:
+                    diff, y1, y2 = train_batch_tracer(gNet, state1Batch, state2Batch, rateBatch, dispBatch,
+                                                      GatherTensorsBatch, source2Dest, SpecsToTrain, VacSpec,
+                                                      On_st1Batch, L0=L0, dtype=dtype, concat=concat)
 
-            else:
-                if Boundary_train:
-                    jProbs_st1_batch = jProbs_st1[batch: end]
-                    jProbs_st2_batch = jProbs_st2[batch: end]
                 else:
-                    jProbs_st1_batch = None
-                    jProbs_st2_batch = None
-
-                diff, y1, y2 = train_batch_collective(gNet, batch, end, state1Batch, state2Batch, rateBatch, dispBatch,
-                           jProbs_st1_batch, jProbs_st2_batch, SpecsToTrain, VacSpec,
-                           On_st1, On_st2, Boundary_train=Boundary_train, AddOnSites=AddOnSites, L0=L0)
+                    diff, y1, y2 = train_batch_collective(gNet, state1Batch, state2Batch, rateBatch, dispBatch,
+                               jProbs_st1_batch, jProbs_st2_batch, SpecsToTrain, VacSpec,
+                               On_st1Batch, On_st2Batch, Boundary_train=Boundary_train, AddOnSites=AddOnSites, L0=L0,
+                               dtype=dtype, concat=concat)
+            profiler.count(rateBatch.shape[0])
 
             # Need to fix things this point onward
-            if epoch-start_ep == 0 and batch == 0:
+            if y1BatchTest is None:
                 y1BatchTest = y1.cpu().detach().numpy().copy()
                 y2BatchTest = y2.cpu().detach().numpy().copy()
                 diff0 = diff.item()
 
-            diff.backward()
-            opt.step()
+            with profiler.phase("backward"):
+                if DDP:
+                    # the loss is a sum over the samples, but the gradients are averaged across the ranks
+                    (diff * world_size).backward()
+                else:
+                    diff.backward()
+            with profiler.phase("step"):
+                opt.step()
+
+            if chkptBatches > 0 and (batchInd + 1) % chkptBatches == 0 and chkpt and rank == 0:
+                with profiler.phase("checkpoint"):
+                    saveState(epoch, batchInd + 1, rng)
+
+        if lrSchedule == "cosine":
+            scheduler.step()
+
+        profiler.endEpoch()
+
+    if writer is not None:
+        writer.close()
 
     # For testing return y1 and y2 - we'll test on a single epoch, single batch sample.
     return diff0, y1BatchTest, y2BatchTest
@@ -541,7 +1588,8 @@ def Train(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2, rates,
 def Evaluate(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2, 
         rates, disps, SpecsToTrain, jProbs_st1, jProbs_st2, sp_ch, VacSpec,
         start_ep, end_ep, interval, N_train, gNet, batch_size=512, Boundary_train=False,
-        DPr=False, jumpSort=True, AddOnSites=True, tracers=False, GatherTensor=None):
+        DPr=False, jumpSort=True, AddOnSites=True, tracers=False, GatherTensor=None, JumpNewSites=None,
+        dtype=pt.double, dataStream=None, DDP=False, pool_size=None, concat=False, prefetch=0):
     
     for key, item in sp_ch.items():
         if key > VacSpec:
@@ -550,22 +1598,34 @@ def Evaluate(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2,
             assert key < VacSpec
             assert item == key
 
+    if dataStream is not None and Boundary_train:
+        raise NotImplementedError("Boundary state training is not supported with streamed data.")
+
+    rank, world_size = distInfo() if DDP else (0, 1)
+
+    source2Dest = None
     if tracers:
+        source2Dest = pt.tensor(makeSource2Dest(JumpNewSites)).long().to(device)
+
+    if tracers and dataStream is None:
         GatherTensor_tracers = pt.tensor(GatherTensor).long().to(device)
     else:
         GatherTensor_tracers = None
 
     N_batch = batch_size
     # Convert compute data to pytorch tensors
-    Nsamples = State1_Occs.shape[0]
+    Nsamples = State1_Occs.shape[0] if dataStream is None else len(dataStream.rows)
 
     print("Evaluating species: {}, Vacancy label: {}".format(SpecsToTrain, VacSpec))
     print("Sample Jumps: {}, Training: {}, Validation: {}, Batch size: {}".format(Nsamples, N_train, Nsamples-N_train, N_batch))
     print("Evaluating with networks at: {}".format(dirPath))
     
-    Ndim = disps.shape[2] 
-    state1Data, state2Data, dispData, rateData, On_st1, On_st2 = makeDataTensors(State1_Occs, State2_Occs, rates, disps,
-            OnSites_st1, OnSites_st2, SpecsToTrain, VacSpec, sp_ch, Ndim=Ndim, tracers=tracers)
+    if dataStream is None:
+        Ndim = disps.shape[2]
+        state1Data, state2Data, dispData, rateData, On_st1, On_st2 = makeDataTensors(State1_Occs, State2_Occs, rates,
+                disps, OnSites_st1, OnSites_st2, SpecsToTrain, VacSpec, sp_ch, Ndim=Ndim, tracers=tracers)
+    else:
+        print("Streaming data from: {}".format(dataStream.DataPath))
     
     if Boundary_train:
         assert gNet.net[-3].Psi.shape[0] == jProbs_st1.shape[1] == jProbs_st2.shape[1] 
@@ -579,59 +1639,47 @@ def Evaluate(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2,
         gNet = nn.DataParallel(gNet, device_ids=DeviceIDList)
 
     gNet.to(device)
-    def compute(startSample, endSample):
-        diff_epochs = []
-        with pt.no_grad():
-            for epoch in tqdm(range(start_ep, end_ep + 1, interval), position=0, leave=True):
-                ## load checkpoint
-                # strict=False to ignore the renamed buffer "JumpVecs" (renamed from JumpUnitVecs)
-                # As long as the same crysdats are used, this will not change
-                gNet.load_state_dict(pt.load(dirPath + "/ep_{0}.pt".format(epoch), map_location=device))
- 
-                diff = 0 
-                for batch in range(startSample, endSample, N_batch):
-                    end = min(batch + N_batch, endSample)
-
-                    state1Batch = state1Data[batch : end].double().to(device)
-                    state2Batch = state2Data[batch : end].double().to(device)
-                    
-                    rateBatch = rateData[batch : end].to(device)
-                    dispBatch = dispData[batch : end].to(device)
-
-                    if tracers:
-                        GatherTensorsBatch = GatherTensor_tracers[batch: end]
-
-                        diff_batch, _, _ = train_batch_tracer(gNet, batch, end, state1Batch, state2Batch, rateBatch,
-                                                          dispBatch, GatherTensorsBatch, SpecsToTrain, VacSpec, On_st1)
 
-                    else:
-                        if Boundary_train:
-                            jProbs_st1_batch = jProbs_st1[batch: end]
-                            jProbs_st2_batch = jProbs_st2[batch: end]
-                        else:
-                            jProbs_st1_batch = None
-                            jProbs_st2_batch = None
-
-                        diff_batch, _, _ = train_batch_collective(gNet, batch, end, state1Batch, state2Batch, rateBatch,
-                                                                  dispBatch, jProbs_st1_batch, jProbs_st2_batch,
-                                                                  SpecsToTrain, VacSpec, On_st1, On_st2,
-                                                                  Boundary_train=Boundary_train, AddOnSites=AddOnSites)
+    # Networks of the checkpoints to evaluate together while a batch of data is on the device
+    def loadPool(epochs):
+        pool = []
+        for epoch in epochs:
+            net = copy.deepcopy(gNet)
+            # As long as the same crysdats are used, this will not change
+            net.load_state_dict(pt.load(dirPath + "/ep_{0}.pt".format(epoch), map_location=device))
+            pool.append(net)
+        return pool
+
+    def compute(startSample, endSample, pool):
+        # one pass over the data, with every batch scored by all the networks in the pool
+        if dataStream is not None:
+            batches = dataStream.subset(startSample, endSample).shard(rank, world_size).loader()
+        else:
+            batches = dataBatches(startSample, endSample, N_batch, state1Data, state2Data, rateData, dispData,
+                                  GatherTensor_tracers, On_st1, On_st2, jProbs_st1, jProbs_st2,
+                                  rank=rank, world_size=world_size)
 
-                    diff += diff_batch.item()
+        return batchDiffs(pool, batches, SpecsToTrain, VacSpec, tracers=tracers, source2Dest=source2Dest,
+                          Boundary_train=Boundary_train, AddOnSites=AddOnSites, dtype=dtype, DDP=DDP,
+                          concat=concat, prefetch=prefetch)
 
-                diff_epochs.append(diff)
+    epochs = list(range(start_ep, end_ep + 1, interval))
+    pool_size = len(epochs) if pool_size is None else pool_size
+    print("Evaluating {} checkpoints, {} at a time".format(len(epochs), pool_size))
 
-        return np.array(diff_epochs)
-    
-    train_diff = compute(0, N_train)
-    test_diff = compute(N_train, Nsamples)
+    train_diff = []
+    test_diff = []
+    for poolStart in tqdm(range(0, len(epochs), pool_size), position=0, leave=True):
+        pool = loadPool(epochs[poolStart : poolStart + pool_size])
+        train_diff.append(compute(0, N_train, pool))
+        test_diff.append(compute(N_train, Nsamples, pool))
 
-    return train_diff, test_diff
+    return np.concatenate(train_diff), np.concatenate(test_diff)
 
 
 def Gather_Y(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2, jProbs_st1, jProbs_st2,
         sp_ch, SpecsToTrain, VacSpec, gNet, Ndim, epoch=None, Boundary_train=False, batch_size=256,
-        jumpSort=True, AddOnSites=True):
+        jumpSort=True, AddOnSites=True, dtype=pt.double, dataStream=None, concat=False):
     
     for key, item in sp_ch.items():
         if key > VacSpec:
@@ -640,14 +1688,22 @@ def Gather_Y(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2, jPr
             assert key < VacSpec
             assert item == key
 
+    if dataStream is not None and Boundary_train:
+        raise NotImplementedError("Boundary state training is not supported with streamed data.")
+
     N_batch = batch_size
     # Convert compute data to pytorch tensors
-    Nsamples = State1_Occs.shape[0]
-    rates=None
-    disps=None
+    if dataStream is None:
+        Nsamples = State1_Occs.shape[0]
+        rates=None
+        disps=None
+
+        state1Data, state2Data, dispData, rateData, On_st1, On_st2 = makeDataTensors(State1_Occs, State2_Occs, rates,
+                disps, OnSites_st1, OnSites_st2, SpecsToTrain, VacSpec, sp_ch, Ndim=Ndim)
 
-    state1Data, state2Data, dispData, rateData, On_st1, On_st2 = makeDataTensors(State1_Occs, State2_Occs, rates, disps,
-            OnSites_st1, OnSites_st2, SpecsToTrain, VacSpec, sp_ch, Ndim=Ndim)
+    else:
+        Nsamples = len(dataStream.rows)
+        print("Streaming data from: {}".format(dataStream.DataPath))
     
     if Boundary_train:
         assert gNet.net[-3].Psi.shape[0] == jProbs_st1.shape[1] == jProbs_st2.shape[1] 
@@ -661,6 +1717,11 @@ def Gather_Y(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2, jPr
         y1Vecs = np.zeros((Nsamples, 3))
         y2Vecs = np.zeros((Nsamples, 3))
 
+    if dataStream is not None:
+        batches = dataStream.loader()
+    else:
+        batches = dataBatches(0, Nsamples, N_batch, state1Data, state2Data, None, None, None, On_st1, On_st2,
+                              jProbs_st1, jProbs_st2)
 
     gNet.to(device)
     if epoch is not None:
@@ -673,44 +1734,111 @@ def Gather_Y(T, dirPath, State1_Occs, State2_Occs, OnSites_st1, OnSites_st2, jPr
             # As long as the same crysdats are used, this will not change
             gNet.load_state_dict(pt.load(dirPath + "/ep_{0}.pt".format(epoch), map_location=device))
              
-        for batch in tqdm(range(0, Nsamples, N_batch), position=0, leave=True):
-            end = min(batch + N_batch, Nsamples)
+        batch = 0
+        for state1Batch, state2Batch, _, _, _, On_st1Batch, On_st2Batch, jProbs_st1_batch, jProbs_st2_batch \
+                in tqdm(batches, position=0, leave=True):
+            end = batch + state1Batch.shape[0]
 
-            state1Batch = state1Data[batch : end].double().to(device)
-            state2Batch = state2Data[batch : end].double().to(device)
-            
-            if Boundary_train:
-                jProbs_st1_batch = jProbs_st1[batch : end]
-                jProbs_st2_batch = jProbs_st2[batch : end]
-            else:
-                jProbs_st1_batch = None
-                jProbs_st2_batch = None
+            state1Batch = batchStates(state1Batch, dtype)
+            state2Batch = batchStates(state2Batch, dtype)
 
-            y1 = gNet(state1Batch)
-            y2 = gNet(state2Batch)
+            y1, y2 = forwardStates(gNet, state1Batch, state2Batch, dtype, concat=concat)
 
             if SpecsToTrain==[VacSpec]:
                 y1, y2 = vacBatchOuts(y1, y2, jProbs_st1_batch, jProbs_st2_batch, Boundary_train)
 
             else:
-                On_st1Batch = On_st1[batch : end]
-                On_st2Batch = On_st2[batch : end]
-
                 y1, y2 = SpecBatchOuts(y1, y2, On_st1Batch, On_st2Batch, jProbs_st1_batch, jProbs_st2_batch,
                                        Boundary_train, AddOnSites)
 
             y1Vecs[batch : end] = y1.cpu().numpy()
             y2Vecs[batch : end] = y2.cpu().numpy()
+            batch = end
 
     return y1Vecs, y2Vecs
 
-def GetRep(dirPath, State_Occs, epoch, gNet, LayerInd, batch_size=1000):
-    
+def Gather_Y_Exits(dirPath, State_Occs, OnSites, sp_ch, SpecsToTrain, VacSpec, gNet, JumpNewSites, out, key,
+                   Ndim=3, epoch=None, batch_size=256, AddOnSites=True, dtype=pt.double, dataStream=None,
+                   concat=False, incremental=False):
+    """
+    y vectors of states and of all their exit states, as computed by Gather_Y with all-jump data, but with the
+    network run once on each state instead of once for every jump out of it. The exit states of each batch are
+    built on the device from the batch itself (see exitStates).
+    The y vectors are written batch by batch to the data sets "key" - shape (Nsamples, Ndim) - and "key_exits"
+    - shape (Nsamples * Nj, Ndim), with the exits of each state in the order of the all-jump rows - of the open
+    HDF5 file "out".
+    :param State_Occs, OnSites: states and on-site masks, without the jumps (see makeStateTensors).
+    :param dataStream: stream of the states without the jumps (see KMCDataset), used instead of State_Occs.
+    :param incremental: whether to compute the exit states of a group convolution network by updating the
+    outputs of the states only within the receptive field of each jump (see GCNet.forwardExits).
+    The rest are the same as Gather_Y.
+    """
+    if dataStream is None:
+        state1Data, _, _, _, On_st1, _ = makeDataTensors(State_Occs, State_Occs, None, None, OnSites, OnSites,
+                                                         SpecsToTrain, VacSpec, sp_ch, Ndim=Ndim)
+        Nsamples = state1Data.shape[0]
+        batches = dataBatches(0, Nsamples, batch_size, state1Data, On_st1)
+    else:
+        assert not dataStream.AllJumps
+        Nsamples = len(dataStream.rows)
+        print("Streaming data from: {}".format(dataStream.DataPath))
+        batches = ((batch[0], batch[5]) for batch in dataStream.loader())
+
+    Nj = JumpNewSites.shape[0]
+    yVecs = out.create_dataset(key, shape=(Nsamples, Ndim), dtype=np.float64)
+    yExits = out.create_dataset(key + "_exits", shape=(Nsamples * Nj, Ndim), dtype=np.float64)
+    JumpNewSites = pt.as_tensor(JumpNewSites).long().to(device)
+
+    gNet.to(device)
+    if incremental:
+        plan = gNet.ExitPlan(JumpNewSites)
+    with pt.no_grad():
+        ## load checkpoint
+        if epoch is not None:
+            print("Network: {}".format(dirPath))
+            print("Loading epoch: {}".format(epoch))
+            gNet.load_state_dict(pt.load(dirPath + "/ep_{0}.pt".format(epoch), map_location=device))
+
+        batch = 0
+        for stateBatch, OnBatch in tqdm(batches, position=0, leave=True):
+            end = batch + stateBatch.shape[0]
+
+            stateBatch = batchStates(stateBatch, dtype)
+            if incremental:
+                with autocastContext(dtype):
+                    y, yExit = gNet.forwardExits(stateBatch, plan)
+                y, yExit = y.double(), yExit.double()
+            else:
+                y, yExit = forwardStates(gNet, stateBatch, exitStates(stateBatch, JumpNewSites), dtype,
+                                         concat=concat)
+
+            if SpecsToTrain == [VacSpec]:
+                y, yExit = vacBatchOuts(y, yExit, None, None, False)
+            else:
+                OnBatch = OnBatch.to(device)
+                y, yExit = SpecBatchOuts(y, yExit, OnBatch, exitStates(OnBatch, JumpNewSites), None, None, False,
+                                         AddOnSites)
+
+            yVecs[batch : end] = y.cpu().numpy()
+            yExits[batch * Nj : end * Nj] = yExit.cpu().numpy()
+            batch = end
+
+def GetRep(dirPath, State_Occs, epoch, gNet, LayerInd, batch_size=1000, dtype=pt.double, dataStream=None,
+           final=False):
+    # With a data stream, the representations of its initial states are computed,
+    # or of its final (exit states with AllJumps) states if final is True.
     N_batch = batch_size
     # Convert compute data to pytorch tensors
-    state1Data = pt.tensor(State_Occs)
-    Nsamples = state1Data.shape[0]
-    Nsites = state1Data.shape[2]
+    if dataStream is None:
+        state1Data = toStateTensor(State_Occs)
+        Nsamples = state1Data.shape[0]
+        Nsites = state1Data.shape[-1]
+        batches = dataBatches(0, Nsamples, N_batch, state1Data)
+    else:
+        Nsamples = len(dataStream.rows)
+        Nsites = dataStream.Nsites
+        stateInd = 1 if final else 0
+        batches = (batch[stateInd : stateInd + 1] for batch in dataStream.loader())
     
     print("computing Representations after layer: {}".format(LayerInd))
 
@@ -727,16 +1855,37 @@ def GetRep(dirPath, State_Occs, epoch, gNet, LayerInd, batch_size=1000):
         # strict=False to ignore the renamed buffer "JumpVecs" (renamed from JumpUnitVecs)
         # As long as the same crysdats are used, this will not change
         gNet.load_state_dict(pt.load(dirPath + "/ep_{0}.pt".format(epoch), map_location=device))
-        for batch in tqdm(range(0, Nsamples, N_batch), position=0, leave=True):
-            end = min(batch + N_batch, Nsamples)
+        batch = 0
+        for (state1Batch,) in tqdm(batches, position=0, leave=True):
+            end = batch + state1Batch.shape[0]
 
-            state1Batch = state1Data[batch : end].double().to(device)
+            state1Batch = batchStates(state1Batch, dtype)
 
-            y1 = gNet.getRep(state1Batch, LayerInd)
-            stReps[batch : end] = y1.cpu().numpy()
+            with autocastContext(dtype):
+                y1 = gNet.getRep(state1Batch, LayerInd)
+            stReps[batch : end] = y1.double().cpu().numpy()
+            batch = end
 
     return stReps
 
+def exportNet(path, gNet, sp_ch, VacSpec, onnx=False):
+    # Freezes a trained group convolution network for inference (see FrozenGCNet) and saves it as a TorchScript
+    # graph, with the rotated weights and neighbor gathers folded in as constants, or as an ONNX graph.
+    # The saved network takes the states as they are stored in the data sets, and can be run with GCNetPredict.py.
+    chLabels = makeChannelLabels(sp_ch, len(sp_ch), max(max(sp_ch), VacSpec) + 1)
+    # frozen from a copy, so that the network of the caller stays on its device
+    frozen = FrozenGCNet(copy.deepcopy(gNet).cpu(), chLabels).eval()
+
+    if onnx:
+        # the states of the example input only fix the no. of sites - the batch size can vary
+        example = pt.full((1, int(gNet.net[0].NSites)), VacSpec, dtype=pt.long)
+        pt.onnx.export(frozen, (example,), path, dynamo=False, input_names=["states"], output_names=["y"],
+                       dynamic_axes={"states": {0: "batch"}, "y": {0: "batch"}})
+    else:
+        pt.jit.save(pt.jit.freeze(pt.jit.script(frozen)), path)
+
+    return frozen
+
 def makeDir(args, specsToTrain):
     direcString=""
     if specsToTrain == [args.VacSpec]:
@@ -747,19 +1896,24 @@ def makeDir(args, specsToTrain):
 
     # 1 This is where networks will be saved to and loaded from
     dirNameNets = "ep_T_{0}_{1}_n{2}c{4}_all_{3}".format(args.TNet, direcString, args.Nlayers, int(args.AllJumps), args.Nchannels)
-    if args.Mode == "eval" or args.Mode == "getY" or args.Mode=="getRep":
+    if args.Mode == "eval" or args.Mode == "getY" or args.Mode=="getRep" or args.Mode == "export":
         prepo = "saved at"
         dirNameNets = "ep_T_{0}_{1}_n{2}c{4}_all_{3}".format(args.TNet, direcString, args.Nlayers, int(args.AllJumpsNetType), args.Nchannels)
     
     else:
-        assert args.Mode == "train", "Modes can either be \"train\", \"eval\", \"getY\" or \"getRep\""
+        assert args.Mode == "train", "Modes can either be \"train\", \"eval\", \"getY\", \"getRep\" or \"export\""
         prepo = "saving in"
 
+    # message passing networks are kept separate from group convolution networks of the same size
+    if args.MsgPassNet:
+        dirNameNets += "_mp"
+
     # 2 check if a run directory exists
     dirPath = RunPath + dirNameNets
     if not os.path.isdir(dirPath):
         if args.Start_epoch == 0:
-            os.mkdir(dirPath)
+            # several processes of a distributed run may get here at once
+            os.makedirs(dirPath, exist_ok=True)
         elif args.Start_epoch > 0:
             raise ValueError("Training directory does not exist but start epoch greater than zero: {}\ndirectory given: {}".format(args.Start_epoch, dirPath))
 
@@ -776,8 +1930,9 @@ def main(args):
         print("Mode : {}, setting end epoch to start epoch".format(args.Mode))
         args.End_epoch = args.Start_epoch
 
-    if not (args.Mode == "train" or args.Mode == "eval" or args.Mode == "getY" or args.Mode == "getRep"):
-        raise ValueError("Mode needs to be train, eval, getY or getRep but given : {}".format(args.Mode))
+    if not (args.Mode == "train" or args.Mode == "eval" or args.Mode == "getY" or args.Mode == "getRep"
+            or args.Mode == "export"):
+        raise ValueError("Mode needs to be train, eval, getY, getRep or export but given : {}".format(args.Mode))
 
     if args.Mode == "train":
         if args.Tdata != args.TNet:
@@ -788,6 +1943,28 @@ def main(args):
 
     if args.Tracers and args.BoundTrain:
         raise NotImplementedError("Cannot do tracer training with boundary states.")
+
+    if args.MsgPassNet and (args.BoundTrain or args.Mode == "getRep" or args.Mode == "export"):
+        raise NotImplementedError("Boundary state training, getRep and export modes are only for group convolution networks.")
+
+    if args.Incremental and (args.MsgPassNet or not (args.Mode == "getY" and args.AllJumps)):
+        raise NotImplementedError("Incremental exit state evaluation is only for group convolution networks in the getY mode with all jumps.")
+
+    if args.Stream and args.BoundTrain:
+        raise NotImplementedError("Cannot stream data with boundary states.")
+
+    if (args.Profile or args.ProfileTrace is not None) and args.Mode != "train":
+        raise NotImplementedError("Profiling is only for the train mode.")
+
+    if args.Distributed:
+        if not (args.Mode == "train" or args.Mode == "eval"):
+            raise NotImplementedError("Distributed runs are only for train and eval modes.")
+        if args.DatPar:
+            raise ValueError("Distributed runs cannot be combined with data parallelism (option --DatPar).")
+
+        # the processes are launched with torchrun, which sets their ranks and the rendezvous in the environment
+        pt.distributed.init_process_group(backend="gloo")
+        print("Distributed run: process {} of {}".format(pt.distributed.get_rank(), pt.distributed.get_world_size()))
     
     # 1. Load crystal data
     GpermNNIdx, NNsiteList, JumpNewSites, dxJumps = Load_crysDats(args.CrysDatPath)
@@ -814,11 +1991,23 @@ def main(args):
     Ndim = dxJumps.shape[1]
 
     # 2. Load data
-    state1List, state2List, dispList, rateList, AllJumpRates_st1, AllJumpRates_st2, JumpSelects =\
-        Load_Data(args.DataPath)
-
-    # 2.1 Convert jump rates to probabilities
+    # Only the first state is read here. The rest of the data is either streamed from the file in batches, or
+    # read from it when it is preprocessed, and not at all if the preprocessed data is found in the cache.
+    if args.Stream:
+        print("Streaming data from {} with {} worker processes.".format(args.DataPath, args.NWorkers))
+    state1List, state2List, dispList, rateList, AllJumpRates_st1, AllJumpRates_st2, JumpSelects = \
+        [DataRows(args.DataPath, name) for name in ("InitStates", "FinStates", "SpecDisps", "rates",
+                                                    "AllJumpRates_Init", "AllJumpRates_Fin", "JumpSelects")]
+    state1First = state1List[:1].load()
+    Nsamples = len(state1List)
+
+    # 2.1 Preprocessed data is read from and saved to an on-disk cache, if a cache directory is given
+    preprocess = PreprocCache(None if args.Stream else args.CacheDir, args.DataPath, args.CrysDatPath,
+                              maxBytes=None if args.CacheMaxGB is None else int(args.CacheMaxGB * 1e9))
+
+    # 2.2 Convert jump rates to probabilities
     if args.BoundTrain:
+        AllJumpRates_st1, AllJumpRates_st2 = AllJumpRates_st1.load(), AllJumpRates_st2.load()
         jProbs_st1 = AllJumpRates_st1 / np.sum(AllJumpRates_st1, axis=1).reshape(-1, 1)
         jProbs_st2 = AllJumpRates_st2 / np.sum(AllJumpRates_st2, axis=1).reshape(-1, 1)
         assert np.allclose(np.sum(jProbs_st1, axis=1), 1.0)
@@ -832,7 +2021,7 @@ def main(args):
     specsToTrain = [int(args.SpecTrain[i]) for i in range(len(args.SpecTrain))]
     specsToTrain = sorted(specsToTrain)
 
-    specs = np.unique(state1List[0])
+    specs = np.unique(state1First[0])
     NSpec = specs.shape[0] - 1
     dirPath, direcString = makeDir(args, specsToTrain)
     
@@ -840,106 +2029,161 @@ def main(args):
         assert args.NchLast == z
 
     # 4. Initiate the network
-    gNet = GCNet(GnnPerms.long(), NNsites, JumpVecs, N_ngb=N_ngb, NSpec=NSpec,
-            mean=args.Mean_wt, std=args.Std_wt, nl=args.Nlayers, nch=args.Nchannels, nchLast=args.NchLast).double()
+    if args.MsgPassNet:
+        print("Using message passing network.")
+        gNet = msgPassNet(NLayers=args.Nlayers, NChannels=args.Nchannels, NSpec=NSpec, VecsPerSite=args.NchLast,
+                NNsites=NNsites, JumpVecs=JumpVecs, mean=args.Mean_wt, std=args.Std_wt,
+                NgbChunk=args.NgbChunk, labels=args.CompactStates)
+
+        print("No. of vectors per site: {}".format(gNet.net[-1].Weights.shape[1]))
 
-    print("No. of channels in last layer: {}".format(gNet.net[-3].Psi.shape[0]))
+    else:
+        gNet = GCNet(GnnPerms.long(), NNsites, JumpVecs, N_ngb=N_ngb, NSpec=NSpec,
+                mean=args.Mean_wt, std=args.Std_wt, nl=args.Nlayers, nch=args.Nchannels, nchLast=args.NchLast,
+                fused=args.FusedGConv, labels=args.CompactStates, reduceGroup=args.ReduceGroup)
+
+        print("No. of channels in last layer: {}".format(gNet.net[-3].Psi.shape[0]))
+        if args.ReduceGroup:
+            print("Distinct neighbor permutations of the group: {} of {}".format(gNet.net[0].GnnPerms.shape[0],
+                                                                                 GnnPerms.shape[0]))
+
+    dtype = Precisions[args.Precision]
+    print("Network precision: {}".format(args.Precision))
+    gNet = gNet.to(storageType(dtype))
+
+    # 4.1 Streams of the data rows [rowStart, rowEnd), used instead of the in-memory tensors with "Stream"
+    def makeStream(rowStart=0, rowEnd=None, AllJumps=args.AllJumps, InitStates="InitStates"):
+        return KMCDataset(args.DataPath, specsToTrain, args.VacSpec, JumpNewSites, dxJumps, NNsiteList,
+                          args.Batch_size, rowStart=rowStart, rowEnd=rowEnd, AllJumps=AllJumps,
+                          tracers=args.Tracers and args.Mode in ("train", "eval"), labels=args.CompactStates,
+                          InitStates=InitStates, num_workers=args.NWorkers)
 
     # 5. Call Training or evaluating or y-evaluating or rep-getting function here
     N_train_jumps = z*args.N_train if args.AllJumps else args.N_train
+    dataStream = None
     if args.Mode == "train":
-        State1_occs, State2_occs, rateData, dispData, GatherTensor_tracers, OnSites_state1, OnSites_state2, sp_ch = \
-            makeComputeData(state1List, state2List, dispList, specsToTrain, args.VacSpec, rateList, JumpSelects,
-                            AllJumpRates_st1, JumpNewSites, dxJumps, NNsiteList, args.N_train, AllJumps=args.AllJumps,
-                            mode=args.Mode, tracers=args.Tracers)
+        # with validation, the samples after the training samples are held out for it
+        N_samples_train = args.N_train
+        if args.ValEvery > 0:
+            N_samples_train = Nsamples if args.N_val is None else min(args.N_train + args.N_val, Nsamples)
+
+        # only the first process of a distributed run logs its times
+        profiler = Profiler()
+        if args.Profile and distInfo()[0] == 0:
+            profiler = Profiler(dirPath + "/profile.jsonl", traceEpoch=args.ProfileTrace,
+                                tracePath=dirPath + "/trace_ep_{}.json".format(args.ProfileTrace))
+        preprocStart = time.perf_counter()
+
+        if args.Stream:
+            dataStream = makeStream(rowEnd=z*N_samples_train if args.AllJumps else N_samples_train)
+            State1_occs, State2_occs, rateData, dispData, GatherTensor_tracers, OnSites_state1, OnSites_state2 = \
+                (None,) * 7
+            sp_ch = dataStream.sp_ch
+        else:
+            State1_occs, State2_occs, rateData, dispData, GatherTensor_tracers, OnSites_state1, OnSites_state2, sp_ch = \
+                preprocess(makeComputeData, state1List, state2List, dispList, specsToTrain, args.VacSpec, rateList,
+                           JumpSelects, AllJumpRates_st1, JumpNewSites, dxJumps, NNsiteList, N_samples_train,
+                           AllJumps=args.AllJumps, mode=args.Mode, tracers=args.Tracers,
+                           labels=args.CompactStates, lazy=True)
         print("Done Creating numpy occupancy tensors. Species channels: {}".format(sp_ch))
+        profiler.log({"preprocess": time.perf_counter() - preprocStart})
 
         Train(args.Tdata, dirPath, State1_occs, State2_occs, OnSites_state1, OnSites_state2,
               rateData, dispData, jProbs_st1, jProbs_st2, specsToTrain, sp_ch, args.VacSpec,
               args.Start_epoch, args.End_epoch, args.Interval, N_train_jumps, gNet,
               lRate=args.Learning_rate, batch_size=args.Batch_size, scratch_if_no_init=args.Scratch,
               DPr=args.DatPar, Boundary_train=args.BoundTrain, jumpSort=args.JumpSort, AddOnSites=args.AddOnSitesJPINN,
-              scaleL0=args.ScaleL0, randomize=args.Shuffle, GatherTensor=GatherTensor_tracers,
-              tracers=args.Tracers, decay=args.Decay)
+              scaleL0=args.ScaleL0, randomize=args.Shuffle, GatherTensor=GatherTensor_tracers, JumpNewSites=JumpNewSites,
+              tracers=args.Tracers, decay=args.Decay, dtype=dtype, dataStream=dataStream, DDP=args.Distributed,
+              concat=args.ConcatForward, prefetch=args.Prefetch, seed=args.Seed, valEvery=args.ValEvery,
+              lrSchedule=None if args.LRSchedule == "none" else args.LRSchedule, lrFactor=args.LRFactor,
+              lrPatience=args.LRPatience, stopPatience=args.EarlyStop, resume=args.Resume,
+              chkptBatches=args.ChkptBatches, profiler=profiler)
 
     elif args.Mode == "eval":
-        State1_occs, State2_occs, rateData, dispData, GatherTensor_tracers, OnSites_state1, OnSites_state2, sp_ch = \
-            makeComputeData(state1List, state2List, dispList, specsToTrain, args.VacSpec, rateList, JumpSelects,
-                            AllJumpRates_st1, JumpNewSites, dxJumps, NNsiteList, args.N_train, AllJumps=args.AllJumps,
-                            mode=args.Mode, tracers=args.Tracers)
+        if args.Stream:
+            dataStream = makeStream()
+            State1_occs, State2_occs, rateData, dispData, GatherTensor_tracers, OnSites_state1, OnSites_state2 = \
+                (None,) * 7
+            sp_ch = dataStream.sp_ch
+        else:
+            State1_occs, State2_occs, rateData, dispData, GatherTensor_tracers, OnSites_state1, OnSites_state2, sp_ch = \
+                preprocess(makeComputeData, state1List, state2List, dispList, specsToTrain, args.VacSpec, rateList,
+                           JumpSelects, AllJumpRates_st1, JumpNewSites, dxJumps, NNsiteList, args.N_train,
+                           AllJumps=args.AllJumps, mode=args.Mode, tracers=args.Tracers,
+                           labels=args.CompactStates, lazy=True)
         print("Done Creating numpy occupancy tensors. Species channels: {}".format(sp_ch))
 
         train_diff, valid_diff = Evaluate(args.TNet, dirPath, State1_occs, State2_occs,
                 OnSites_state1, OnSites_state2, rateData, dispData,
                 specsToTrain, jProbs_st1, jProbs_st2, sp_ch, args.VacSpec, args.Start_epoch, args.End_epoch,
                 args.Interval, N_train_jumps, gNet, batch_size=args.Batch_size, tracers=args.Tracers,
-                GatherTensor=GatherTensor_tracers, Boundary_train=args.BoundTrain, DPr=args.DatPar,
-                jumpSort=args.JumpSort, AddOnSites=args.AddOnSitesJPINN)
+                GatherTensor=GatherTensor_tracers, JumpNewSites=JumpNewSites, Boundary_train=args.BoundTrain, DPr=args.DatPar,
+                jumpSort=args.JumpSort, AddOnSites=args.AddOnSitesJPINN, dtype=dtype, dataStream=dataStream,
+                DDP=args.Distributed, pool_size=args.EvalPool, concat=args.ConcatForward,
+                prefetch=args.Prefetch)
+
+        # all ranks have the same sums, which are saved once
+        if not args.Distributed or pt.distributed.get_rank() == 0:
+            if not args.Tracers:
+                np.save("tr_{0}_{1}_{2}_n{3}c{4}_all_{5}.npy".format(direcString, args.Tdata, args.TNet, args.Nlayers, args.Nchannels,
+                                                                     int(args.AllJumps)), train_diff/(1.0*args.N_train))
+                np.save("val_{0}_{1}_{2}_n{3}c{4}_all_{5}.npy".format(direcString, args.Tdata, args.TNet, args.Nlayers, args.Nchannels,
+                                                                      int(args.AllJumps)), valid_diff/(1.0 * (Nsamples - args.N_train)))
 
-        if not args.Tracers:
-            np.save("tr_{0}_{1}_{2}_n{3}c{4}_all_{5}.npy".format(direcString, args.Tdata, args.TNet, args.Nlayers, args.Nchannels,
-                                                                 int(args.AllJumps)), train_diff/(1.0*args.N_train))
-            np.save("val_{0}_{1}_{2}_n{3}c{4}_all_{5}.npy".format(direcString, args.Tdata, args.TNet, args.Nlayers, args.Nchannels,
-                                                                  int(args.AllJumps)), valid_diff/(1.0 * (state1List.shape[0] - args.N_train)))
-
-        else:
-            np.save("tr_{0}_{1}_{2}_n{3}c{4}_all_{5}_tracer.npy".format(direcString, args.Tdata, args.TNet, args.Nlayers,
-                                                                 args.Nchannels,
-                                                                 int(args.AllJumps)), train_diff / (1.0 * args.N_train))
-            np.save("val_{0}_{1}_{2}_n{3}c{4}_all_{5}_tracer.npy".format(direcString, args.Tdata, args.TNet, args.Nlayers,
-                                                                  args.Nchannels,
-                                                                  int(args.AllJumps)),
-                    valid_diff / (1.0 * (State1_occs.shape[0] - args.N_train)))
+            else:
+                np.save("tr_{0}_{1}_{2}_n{3}c{4}_all_{5}_tracer.npy".format(direcString, args.Tdata, args.TNet, args.Nlayers,
+                                                                     args.Nchannels,
+                                                                     int(args.AllJumps)), train_diff / (1.0 * args.N_train))
+                np.save("val_{0}_{1}_{2}_n{3}c{4}_all_{5}_tracer.npy".format(direcString, args.Tdata, args.TNet, args.Nlayers,
+                                                                      args.Nchannels,
+                                                                      int(args.AllJumps)),
+                        valid_diff / (1.0 * ((len(State1_occs) if dataStream is None else len(dataStream.rows)) - args.N_train)))
 
     elif args.Mode == "getY":
         if args.AllJumps:
-            State1_occs, State2_occs, OnSites_state1, OnSites_state2, sp_ch = \
-                makeStateTensors(state1List, specsToTrain, args.VacSpec, JumpNewSites, AllJumps=True)
-
-            print("Calculating y for state 1  and state 1 exits for {}.".format(args.Tdata))
-            y_st1_Vecs, y_st1_Exits = Gather_Y(args.TNet, dirPath, State1_occs, State2_occs,
-                                      OnSites_state1, OnSites_state2, jProbs_st1, jProbs_st2, sp_ch,
-                                      specsToTrain, args.VacSpec, gNet, Ndim, batch_size=args.Batch_size,
-                                      epoch=args.Start_epoch,
-                                      Boundary_train=args.BoundTrain, AddOnSites=args.AddOnSitesJPINN)
-
-            State1_occs, State2_occs, OnSites_state1, OnSites_state2, sp_ch = \
-                makeStateTensors(state2List, specsToTrain, args.VacSpec, JumpNewSites, AllJumps=True)
-
-            print("Calculating y for state 2  and state 2 exits for {}.".format(args.Tdata))
-            y_st2_Vecs, y_st2_Exits = Gather_Y(args.TNet, dirPath, State1_occs, State2_occs,
-                                               OnSites_state1, OnSites_state2, jProbs_st1, jProbs_st2, sp_ch,
-                                               specsToTrain, args.VacSpec, gNet, Ndim, batch_size=args.Batch_size,
-                                               epoch=args.Start_epoch,
-                                               Boundary_train=args.BoundTrain, AddOnSites=args.AddOnSitesJPINN)
-
-            np.save("y_st1_{0}_{1}_{2}_n{3}c{4}_all_{5}_{6}.npy".format(direcString, args.Tdata,
-                                                                                args.TNet, args.Nlayers,args.Nchannels,
-                                                                                int(args.AllJumps), args.Start_epoch), y_st1_Vecs[::z])
-
-            np.save("y_st1_exits_{0}_{1}_{2}_n{3}c{4}_all_{5}_{6}.npy".format(direcString, args.Tdata,
-                                                                                args.TNet, args.Nlayers,args.Nchannels,
-                                                                                int(args.AllJumps), args.Start_epoch), y_st1_Exits)
-
-            np.save("y_st2_{0}_{1}_{2}_n{3}c{4}_all_{5}_{6}.npy".format(direcString, args.Tdata,
-                                                                        args.TNet, args.Nlayers,args.Nchannels,
-                                                                        int(args.AllJumps), args.Start_epoch), y_st2_Vecs[::z])
-
-            np.save("y_st2_exits_{0}_{1}_{2}_n{3}c{4}_all_{5}_{6}.npy".format(direcString, args.Tdata,
-                                                                                args.TNet, args.Nlayers,args.Nchannels,
-                                                                                int(args.AllJumps), args.Start_epoch), y_st2_Exits)
+            # y vectors of the initial and final states and of all their exit states, in one HDF5 file
+            yPath = "y_{0}_{1}_{2}_n{3}c{4}_all_{5}_{6}.h5".format(direcString, args.Tdata, args.TNet, args.Nlayers,
+                                                                   args.Nchannels, int(args.AllJumps), args.Start_epoch)
+            with h5py.File(yPath, "w") as out:
+                for InitStates, stateList, key in [("InitStates", state1List, "y_st1"),
+                                                   ("FinStates", state2List, "y_st2")]:
+                    if args.Stream:
+                        dataStream = makeStream(AllJumps=False, InitStates=InitStates)
+                        State_occs, OnSites_state = None, None
+                        sp_ch = dataStream.sp_ch
+                    else:
+                        State_occs, OnSites_state, sp_ch = \
+                            preprocess(makeStateTensors, stateList, specsToTrain, args.VacSpec, JumpNewSites,
+                                       AllJumps=False, labels=args.CompactStates)
+
+                    print("Calculating {} and its exits for {}.".format(key, args.Tdata))
+                    Gather_Y_Exits(dirPath, State_occs, OnSites_state, sp_ch, specsToTrain, args.VacSpec, gNet,
+                                   JumpNewSites, out, key, Ndim=Ndim, epoch=args.Start_epoch,
+                                   batch_size=args.Batch_size, AddOnSites=args.AddOnSitesJPINN, dtype=dtype,
+                                   dataStream=dataStream, concat=args.ConcatForward,
+                                   incremental=args.Incremental)
+            print("y vectors saved to {}".format(yPath))
 
         else:
-            State1_occs, OnSites_state1, sp_ch = \
-                makeStateTensors(state1List, specsToTrain, args.VacSpec, JumpNewSites, AllJumps=False)
+            if args.Stream:
+                dataStream = makeStream()
+                State1_occs, State2_occs, OnSites_state1, OnSites_state2 = (None,) * 4
+                sp_ch = dataStream.sp_ch
+            else:
+                State1_occs, OnSites_state1, sp_ch = \
+                    preprocess(makeStateTensors, state1List, specsToTrain, args.VacSpec, JumpNewSites, AllJumps=False,
+                               labels=args.CompactStates)
 
-            State2_occs, OnSites_state2, sp_ch = \
-                makeStateTensors(state2List, specsToTrain, args.VacSpec, JumpNewSites, AllJumps=False)
+                State2_occs, OnSites_state2, sp_ch = \
+                    preprocess(makeStateTensors, state2List, specsToTrain, args.VacSpec, JumpNewSites, AllJumps=False,
+                               labels=args.CompactStates)
 
             y1Vecs, y2Vecs = Gather_Y(args.TNet, dirPath, State1_occs, State2_occs,
                     OnSites_state1, OnSites_state2, jProbs_st1, jProbs_st2, sp_ch,
                     specsToTrain, args.VacSpec, gNet, Ndim, batch_size=args.Batch_size, epoch=args.Start_epoch,
-                    Boundary_train=args.BoundTrain, AddOnSites=args.AddOnSitesJPINN)
+                    Boundary_train=args.BoundTrain, AddOnSites=args.AddOnSitesJPINN, dtype=dtype,
+                    dataStream=dataStream, concat=args.ConcatForward)
 
             np.save("y_st1_{0}_{1}_{2}_n{3}c{4}_all_{5}_{6}.npy".format(direcString, args.Tdata, args.TNet, args.Nlayers,
                                                                         args.Nchannels, int(args.AllJumps), args.Start_epoch),
@@ -953,23 +2197,33 @@ def main(args):
             print("site wise y vectors will be computed for indicated samples")
 
         if args.AllJumps:
-            State1_occs, State1_exit_occs, _, _, _ = \
-                makeStateTensors(state1List[args.RepStart : args.RepStart + args.N_train], specsToTrain, args.VacSpec,
-                                 JumpNewSites, AllJumps=True)
+            if args.Stream:
+                dataStream = makeStream(args.RepStart * z, (args.RepStart + args.N_train) * z)
+                State1_occs, State1_exit_occs = None, None
+            else:
+                State1_occs, State1_exit_occs, _, _, _ = \
+                    preprocess(makeStateTensors, state1List[args.RepStart : args.RepStart + args.N_train],
+                               specsToTrain, args.VacSpec, JumpNewSites, AllJumps=True, labels=args.CompactStates,
+                               lazy=True)
 
             stReps_st1 = GetRep(dirPath, State1_occs, args.Start_epoch, gNet, args.RepLayer,
-                                 batch_size=args.Batch_size)
+                                 batch_size=args.Batch_size, dtype=dtype, dataStream=dataStream)
             stReps_st1_exits = GetRep(dirPath, State1_exit_occs, args.Start_epoch, gNet, args.RepLayer,
-                                   batch_size=args.Batch_size)
+                                   batch_size=args.Batch_size, dtype=dtype, dataStream=dataStream, final=True)
 
-            State2_occs, State2_exit_occs, _, _, _ = \
-                makeStateTensors(state2List[args.RepStart : args.RepStart + args.N_train], specsToTrain, args.VacSpec,
-                                 JumpNewSites, AllJumps=True)
+            if args.Stream:
+                dataStream = makeStream(args.RepStart * z, (args.RepStart + args.N_train) * z, InitStates="FinStates")
+                State2_occs, State2_exit_occs = None, None
+            else:
+                State2_occs, State2_exit_occs, _, _, _ = \
+                    preprocess(makeStateTensors, state2List[args.RepStart : args.RepStart + args.N_train],
+                               specsToTrain, args.VacSpec, JumpNewSites, AllJumps=True, labels=args.CompactStates,
+                               lazy=True)
             stReps_st2 = GetRep(dirPath, State2_occs, args.Start_epoch, gNet, args.RepLayer,
-                                   batch_size=args.Batch_size)
+                                   batch_size=args.Batch_size, dtype=dtype, dataStream=dataStream)
 
             stReps_st2_exits = GetRep(dirPath, State2_exit_occs, args.Start_epoch, gNet, args.RepLayer,
-                                batch_size=args.Batch_size)
+                                batch_size=args.Batch_size, dtype=dtype, dataStream=dataStream, final=True)
 
             np.save("Rep_L_{0}_st1_{1}_{2}_{3}_n{4}c{5}_all_{6}_{7}.npy".format(args.RepLayer, direcString, args.Tdata,
                                                                                 args.TNet, args.Nlayers,args.Nchannels,
@@ -992,28 +2246,49 @@ def main(args):
                     stReps_st2_exits)
 
         else:
-            State1_occs, _, _ = \
-                makeStateTensors(state1List[args.RepStart: args.RepStart + args.N_train],
-                                 specsToTrain, args.VacSpec, JumpNewSites, AllJumps=False)
+            if args.Stream:
+                dataStream = makeStream(args.RepStart, args.RepStart + args.N_train)
+                State1_occs = None
+            else:
+                State1_occs, _, _ = \
+                    preprocess(makeStateTensors, state1List[args.RepStart: args.RepStart + args.N_train],
+                               specsToTrain, args.VacSpec, JumpNewSites, AllJumps=False, labels=args.CompactStates)
             stReps_st1 = GetRep(dirPath, State1_occs, args.Start_epoch, gNet, args.RepLayer,
-                                batch_size=args.Batch_size)
+                                batch_size=args.Batch_size, dtype=dtype, dataStream=dataStream)
 
             np.save("Rep_L_{0}_st1_{1}_{2}_{3}_n{4}c{5}_all_{6}_{7}.npy".format(args.RepLayer, direcString, args.Tdata,
                                                                                 args.TNet, args.Nlayers,args.Nchannels,
                                                                                 int(args.AllJumps), args.Start_epoch),
                     stReps_st1)
 
-            State2_occs, _, _ = \
-                makeStateTensors(state2List[args.RepStart: args.RepStart + args.N_train],
-                                 specsToTrain, args.VacSpec, JumpNewSites, AllJumps=False)
+            if args.Stream:
+                State2_occs = None
+            else:
+                State2_occs, _, _ = \
+                    preprocess(makeStateTensors, state2List[args.RepStart: args.RepStart + args.N_train],
+                               specsToTrain, args.VacSpec, JumpNewSites, AllJumps=False, labels=args.CompactStates)
             stReps_st2 = GetRep(dirPath, State2_occs, args.Start_epoch, gNet, args.RepLayer,
-                                batch_size=args.Batch_size)
+                                batch_size=args.Batch_size, dtype=dtype, dataStream=dataStream, final=True)
 
             np.save("Rep_L_{0}_st2_{1}_{2}_{3}_n{4}c{5}_all_{6}_{7}.npy".format(args.RepLayer, direcString, args.Tdata,
                                                                                 args.TNet, args.Nlayers,args.Nchannels,
                                                                                 int(args.AllJumps), args.Start_epoch),
                     stReps_st2)
 
+    elif args.Mode == "export":
+        # the species channels are fixed by the first state, as for the data used to train the network
+        _, _, sp_ch = makeStateTensors(state1First, specsToTrain, args.VacSpec, JumpNewSites)
+        gNet.load_state_dict(pt.load(dirPath + "/ep_{0}.pt".format(args.Start_epoch), map_location="cpu"))
+
+        exportPath = "GCNet_T_{0}_{1}_n{2}c{3}_all_{4}_{5}.{6}".format(args.TNet, direcString, args.Nlayers,
+                                                                       args.Nchannels, int(args.AllJumpsNetType),
+                                                                       args.Start_epoch, "onnx" if args.ONNX else "pt")
+        exportNet(exportPath, gNet, sp_ch, args.VacSpec, onnx=args.ONNX)
+        print("Exported network of epoch {} to {}".format(args.Start_epoch, exportPath))
+
+    if args.Distributed:
+        pt.distributed.destroy_process_group()
+
     print("All done\n\n")
 
 
@@ -1024,7 +2299,8 @@ if __name__ == "__main__":
     parser.add_argument("-cr", "--CrysDatPath", metavar="/path/to/crys/dat", type=str, help="Path to crystal Data.")
     parser.add_argument("-a0", "--LatParam", metavar="float", type=float, default=1.0, help="Lattice parameter.")
 
-    parser.add_argument("-m", "--Mode", metavar="string", type=str, help="Running mode (one of train, eval, getY, getRep). If getRep, then layer must specified with -RepLayer.")
+    parser.add_argument("-m", "--Mode", metavar="string", type=str, help="Running mode (one of train, eval, getY, getRep, export). If getRep, then layer must specified with -RepLayer.")
+    parser.add_argument("-onx", "--ONNX", action="store_true", help="Whether to export the network as an ONNX graph instead of a TorchScript graph in export mode (needs the onnx package).")
     parser.add_argument("-trc", "--Tracers", action="store_true",
                         help="Whether to train to or evaluate tracer transport coefficients. Used only with \"train\"and \"eval\" modes.")
     parser.add_argument("-shf", "--Shuffle", action="store_true",
@@ -1035,14 +2311,31 @@ if __name__ == "__main__":
     parser.add_argument("-nojsr", "--JumpSort", action="store_false", help="Whether to switch on/off sort jumps by rates. Not doing it will cause symmetry to break.")
     parser.add_argument("-aos","--AddOnSitesJPINN", action="store_true", help="Whether to consider on sites along with vacancy sites in JPINN.")
     parser.add_argument("-nosym", "--NoSymmetry", action="store_true", help="Whether to switch off all symmetry operations except identity.")
+    parser.add_argument("-fgc", "--FusedGConv", action="store_true", help="Whether to use the fused group convolution kernel, which does not build rotated weights and rearranged inputs (lower memory).")
+    parser.add_argument("-rdg", "--ReduceGroup", action="store_true", help="Whether to do the group convolutions only once for each distinct permutation of the neighbors among the group operations, with the group averages weighted by the no. of operations giving each. The outputs are the same. If all the permutations are distinct (as for the FCC crystal data files in CrysDat_FCC), the network is the same as without this option. Must be the same for training and later runs.")
     parser.add_argument("-l0", "--ScaleL0", action="store_true", help="Whether to scale transport coefficients during training with uncorrelated value.")
 
     parser.add_argument("-nl", "--Nlayers",  metavar="int", type=int, default=1, help="No. of intermediate layers of the neural network.")
     parser.add_argument("-nch", "--Nchannels", metavar="int", type=int, default=4, help="No. of representation channels in non-input layers.")
     parser.add_argument("-ncL", "--NchLast", metavar="int", type=int, default=1, help="No. channels of the last layers - how many vectors to produce per site.")
 
+    parser.add_argument("-mpn", "--MsgPassNet", action="store_true", help="Whether to use a message passing network instead of a group convolution network. -nl sets the no. of message passing layers before the output layer and -nch the no. of message channels in each.")
+    parser.add_argument("-ngc", "--NgbChunk", metavar="int", type=int, default=None, help="No. of neighbors whose messages are computed together in message passing layers (all if not given). Smaller values use less memory.")
+
+    parser.add_argument("-prec", "--Precision", metavar="string", type=str, default="fp64", choices=list(Precisions.keys()), help="Floating point precision of the network (fp64, fp32 or bf16). bf16 runs as mixed precision with fp32 parameters. Transport coefficients are always accumulated in fp64.")
+    parser.add_argument("-cat", "--ConcatForward", action="store_true", help="Whether to run the initial and final states of a batch through the network together in a single forward pass instead of two. Faster for small batches, at the cost of twice the activation memory per forward pass.")
+    parser.add_argument("-inc", "--Incremental", action="store_true", help="Whether to compute the relaxation vectors of the exit states in the getY mode with all jumps by updating those of the initial and final states only within the receptive field of each jump, instead of running the network on every exit state. Only for group convolution networks.")
+    parser.add_argument("-cst", "--CompactStates", action="store_true", help="Whether to store the states as one int8 species label per site instead of one-hot occupancies. The labels are expanded into occupancies by the network on the device.")
+    parser.add_argument("-str", "--Stream", action="store_true", help="Whether to stream the data from the HDF5 file in batches instead of loading it into memory. Not available for boundary state training.")
+    parser.add_argument("-nwk", "--NWorkers", metavar="int", type=int, default=2, help="No. of worker processes that read and prepare batches ahead of time when streaming data.")
+
+    parser.add_argument("-pf", "--Prefetch", metavar="int", type=int, default=2, help="No. of batches staged on the device by a background thread ahead of the one being computed in Train and eval modes (0 to move each batch when it is needed). The states are cast to floating point on the device.")
+    parser.add_argument("-cch", "--CacheDir", metavar="/path/to/cache", type=str, default=None, help="Directory of an on-disk cache of the preprocessed data (occupancies, rates and displacements). Later runs on the same data with the same options read it from memory-mapped files instead of reading the data file and building it again, and runs on the same node share one copy of the states in memory. A directory in shared memory (such as one in /dev/shm) keeps that copy in memory. Not used if not given, or when streaming data.")
+    parser.add_argument("-cmx", "--CacheMaxGB", metavar="float", type=float, default=50.0, help="Max. size of the cache directory in GB. The least recently used data is removed once it gets larger.")
     parser.add_argument("-scr", "--Scratch", action="store_true", help="Whether to create new network and start from scratch")
     parser.add_argument("-DPr", "--DatPar", action="store_true", help="Whether to use data parallelism. Note - does not work for residual or subnet models. Used only in Train and eval modes.")
+    parser.add_argument("-evp", "--EvalPool", metavar="int", type=int, default=None, help="No. of checkpoints evaluated together in one pass over the data in eval mode (all if not given). Each one is kept in memory as a network.")
+    parser.add_argument("-ddp", "--Distributed", action="store_true", help="Whether to run as one of several processes launched with torchrun (gloo backend). Every batch is shared out across the processes. Used only in Train and eval modes.")
 
     parser.add_argument("-td", "--Tdata", metavar="int", type=int, help="Temperature (or composition for SR2) to read data from")
     parser.add_argument("-tn", "--TNet", metavar="int", type=int, help="Temperature (or composition for SR2) to use networks from\n For example one can evaluate a network trained on 1073 K data, on the 1173 K data, to see what it does.")
@@ -1058,6 +2351,17 @@ if __name__ == "__main__":
     parser.add_argument("-ajn", "--AllJumpsNetType", action="store_true", help="Whether to use network trained on all jumps, or single selected jumps out of a state.")
 
     parser.add_argument("-nt", "--N_train", type=int, metavar="int", default=10000, help="No. of training samples.")
+    parser.add_argument("-sd", "--Seed", metavar="int", type=int, default=None, help="Seed of the shuffled order of the training samples (see --Shuffle). The order of each epoch is fixed by the seed and the epoch, so that training runs can be reproduced and resumed with the same orders. Random if not given.")
+    parser.add_argument("-vle", "--ValEvery", metavar="int", type=int, default=0, help="Validate the network every this many epochs during training, on the samples after the training samples, which are held out of training. The validation transport coefficients are logged to validation.json in the network directory, and only the checkpoints of the best and the last networks are kept. No validation if 0.")
+    parser.add_argument("-nv", "--N_val", metavar="int", type=int, default=None, help="No. of validation samples used with --ValEvery (all the samples after the training samples if not given).")
+    parser.add_argument("-lrs", "--LRSchedule", metavar="string", type=str, default="none", choices=["none", "plateau", "cosine"], help="Learning rate schedule during training. plateau scales the learning rate by --LRFactor after --LRPatience validations without improvement (needs --ValEvery), and cosine anneals it to zero over the epochs up to the end epoch.")
+    parser.add_argument("-lrf", "--LRFactor", metavar="float", type=float, default=0.5, help="Factor by which the plateau schedule scales the learning rate.")
+    parser.add_argument("-lrp", "--LRPatience", metavar="int", type=int, default=2, help="No. of validations without improvement after which the plateau schedule scales the learning rate.")
+    parser.add_argument("-esp", "--EarlyStop", metavar="int", type=int, default=0, help="Stop training after this many validations without improvement (needs --ValEvery). No early stopping if 0.")
+    parser.add_argument("-rsm", "--Resume", action="store_true", help="Resume training exactly where it stopped, from the training state (network, optimizer, random number generators and position in the epoch) saved to train_state.pt in the network directory with every checkpoint. The start epoch is then taken from the saved state.")
+    parser.add_argument("-ckb", "--ChkptBatches", metavar="int", type=int, default=0, help="Also save the training state every this many batches within an epoch, so that a resumed run loses at most this many batches. Only at the checkpoints of the epochs if 0.")
+    parser.add_argument("-prf", "--Profile", action="store_true", help="Log the wall time of each phase of every training epoch (reading the batches, moving them to the device, the forward and backward passes, the optimizer steps, validation and checkpoints), the samples trained on per second, the peak memory of the process and, with a CUDA device only, the no. of allocations and the peak memory allocated on the device to profile.jsonl in the network directory, one JSON line per epoch.")
+    parser.add_argument("-prt", "--ProfileTrace", metavar="int", type=int, default=None, help="Epoch for which to also save a torch.profiler trace to trace_ep_<epoch>.json in the network directory (needs --Profile), to view with chrome://tracing or perfetto.")
     parser.add_argument("-i", "--Interval", type=int, default=1, metavar="int", help="Epoch intervals in which to save or load networks.")
     parser.add_argument("-lr", "--Learning_rate", metavar="float", type=float, default=0.001, help="Learning rate for Adam algorithm.")
     parser.add_argument("-dcy", "--Decay", metavar="float", type=float, default=0.0005, help="Weight decay (L2 penalty for the weights).")
@@ -4,17 +4,79 @@
 # In[1]:
 
 
+import copy
 import torch as pt
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
 
 
 # In[2]:
 
 
+class GConvFunction(pt.autograd.Function):
+    """
+    Fused group convolution. Instead of building the rotated weights for all group operations and the
+    (Nbatch, NchIn*N_ngb, Nsites) rearranged input, the neighbors of each site are gathered one neighbor shell
+    at a time, and the group-permuted filter entries for that shell are applied to them directly.
+    Only the input is saved for the backward pass, where the gathers are repeated.
+    """
+    @staticmethod
+    def forward(ctx, In, Psi, bias, GnnPerms, NNsites):
+        Nbatch, NchIn, Nsites = In.shape
+        NchOut = Psi.shape[0]
+        Ng, N_ngb = GnnPerms.shape
+
+        out = bias.repeat_interleave(Ng, dim=0).expand(Nbatch, NchOut * Ng, Nsites).contiguous()
+        for k in range(N_ngb):
+            # filter entries applied to the k^th neighbor of each site under every group operation
+            # shape (NchOut*Ng, NchIn) - rows ordered in the same way as the output channels.
+            Wk = Psi[:, :, GnnPerms[:, k]].transpose(1, 2).reshape(NchOut * Ng, NchIn)
+            In_k = In.index_select(2, NNsites[k])
+            out.baddbmm_(Wk.expand(Nbatch, -1, -1), In_k)
+
+        ctx.save_for_backward(In, Psi, GnnPerms, NNsites)
+        return out.view(Nbatch, NchOut, Ng, Nsites)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, gradOut):
+        In, Psi, GnnPerms, NNsites = ctx.saved_tensors
+        Nbatch, NchIn, Nsites = In.shape
+        NchOut = Psi.shape[0]
+        Ng, N_ngb = GnnPerms.shape
+
+        gradIn = gradPsi = gradBias = None
+        gradOut = gradOut.reshape(Nbatch, NchOut * Ng, Nsites)
+
+        if ctx.needs_input_grad[2]:
+            gradBias = gradOut.view(Nbatch, NchOut, Ng, Nsites).sum(dim=(0, 2, 3)).view(NchOut, 1)
+
+        if ctx.needs_input_grad[1]:
+            gradPsi = pt.zeros_like(Psi)
+            # flatten the batch and site axes to do a single matmul per neighbor shell
+            gradOutFlat = gradOut.transpose(0, 1).reshape(NchOut * Ng, Nbatch * Nsites)
+
+        if ctx.needs_input_grad[0]:
+            gradIn = pt.zeros_like(In)
+
+        for k in range(N_ngb):
+            In_k = In.index_select(2, NNsites[k])
+            if ctx.needs_input_grad[1]:
+                gradWk = pt.matmul(gradOutFlat, In_k.transpose(0, 1).reshape(NchIn, Nbatch * Nsites).T)
+                # send the gradients back to the un-permuted filter entries
+                gradPsi.index_add_(2, GnnPerms[:, k], gradWk.view(NchOut, Ng, NchIn).transpose(1, 2))
+
+            if ctx.needs_input_grad[0]:
+                Wk = Psi[:, :, GnnPerms[:, k]].transpose(1, 2).reshape(NchOut * Ng, NchIn)
+                gradIn.index_add_(2, NNsites[k], pt.bmm(Wk.T.expand(Nbatch, -1, -1), gradOut))
+
+        return gradIn, gradPsi, gradBias, None, None
+
+
 class GConv(nn.Module):
     def __init__(self, InChannels, OutChannels, GnnPerms, NNsites, 
-                 N_ngb, mean=1.0, std=0.1):
+                 N_ngb, mean=1.0, std=0.1, fused=False):
         """
         Implements a group-equivariant convolutional layer. Permutations of convolutional filters under
         space group operations are used to build symmetry-equivariant outputs that rotate/transform automatically
@@ -25,8 +87,11 @@ class GConv(nn.Module):
         :param: NNsites - nearest neighbors of each site - shape(coordination number + 1, Nsites).
         Note - the 0th row of NNsites is just [0, 1, 2...], i.e, the sites themselves are their own 0th neighbors
         :param: N_ngb (coordination number + 1)
+        :param: fused - whether to do the convolution with the fused kernel (GConvFunction), which does not
+        build the rotated weights and the rearranged input.
         """
         super().__init__()
+        self.fused = fused
         Nsites = NNsites.shape[1]
         self.register_buffer("NSites", pt.tensor(Nsites))
         self.register_buffer("GnnPerms", GnnPerms)
@@ -42,8 +107,34 @@ class GConv(nn.Module):
             
         self.register_parameter("Psi", Layerweights)
         self.register_parameter("bias", LayerBias)
-    
+
+        # key of the parameters the currently stored rotated weights were built from (see RotateParams)
+        self.RotKey = None
+
+    def RotationKey(self, GnnPerms):
+        # The version counters of the parameters are incremented by every in-place change to them, such as
+        # optimizer steps and load_state_dict. The data pointers, dtype and device change with .to() and .double().
+        return (self.Psi._version, self.bias._version, self.Psi.data_ptr(), self.bias.data_ptr(),
+                self.Psi.dtype, self.Psi.device, GnnPerms.data_ptr(), GnnPerms.shape, pt.is_grad_enabled())
+
+    def ClearRotation(self, grad=None):
+        self.RotKey = None
+
+    def __getstate__(self):
+        # The stored rotated weights are left out of copies and pickles. They are rebuilt when needed, and
+        # can be part of an autograd graph, which cannot be copied.
+        state = self.__dict__.copy()
+        state.pop("GWeights", None)
+        state.pop("Gbias", None)
+        state["RotKey"] = None
+        return state
+
     def RotateParams(self, GnnPerms):
+        # Re-use the stored rotated weights if the parameters have not changed since they were built.
+        key = self.RotationKey(GnnPerms)
+        if self.RotKey == key:
+            return
+
         Ng = GnnPerms.shape[0]
         # First, get the input and output channels
         NchIn = self.NchIn
@@ -63,19 +154,43 @@ class GConv(nn.Module):
         
         # store the repeated biases
         self.Gbias = bias.repeat_interleave(Ng, dim=0)
+
+        # If the rotated weights are part of an autograd graph, they can only be re-used until a backward pass
+        # goes through that graph, after which its buffers are freed. So clear them once their gradient arrives.
+        if self.GWeights.requires_grad:
+            self.GWeights.register_hook(self.ClearRotation)
+            self.Gbias.register_hook(self.ClearRotation)
+
+        self.RotKey = key
     
+    def GroupWeights(self):
+        # copies of the rotated weights and biases, which are not part of any autograd graph
+        self.RotateParams(self.GnnPerms)
+        return self.GWeights.detach().clone(), self.Gbias.detach().clone()
+
     def RearrangeInput(self, In, NNsites):
         N_ngb = NNsites.shape[0]
         
         Nch = In.shape[1]
+
+        # Gather all neighbors along the site axis with the flattened (N_ngb*Nsites) neighbor list.
+        # Row ch*N_ngb + k of the output holds the k^th neighbors of channel ch.
+        # The flattened list is a view of NNsites, so no index tensor is built here.
+        out = In[:, :, NNsites.reshape(-1)]
         
-        In = In.repeat_interleave(N_ngb, dim=1)
-        NNRepeat = NNsites.unsqueeze(0).repeat(In.shape[0], Nch, 1)
-        
-        return pt.gather(In, 2, NNRepeat)
+        return out.view(In.shape[0], Nch*N_ngb, NNsites.shape[1])
     
     def forward(self, In):
         
+        if self.fused:
+            Psi, bias = self.Psi, self.bias
+            if pt.is_autocast_enabled(In.device.type):
+                # the in-place batched matmuls of the fused kernel are not autocast, so its inputs are cast to
+                # the autocast dtype here, as autocast does for the matmul of the unfused convolution below.
+                castType = pt.get_autocast_dtype(In.device.type)
+                In, Psi, bias = In.to(castType), Psi.to(castType), bias.to(castType)
+            return GConvFunction.apply(In, Psi, bias, self.GnnPerms, self.NNsites)
+
         Nbatch = In.shape[0]
         NchOut = self.NchOut
         Ng = self.GnnPerms.shape[0]
@@ -91,6 +206,58 @@ class GConv(nn.Module):
         
         return out.view(Nbatch, NchOut, Ng, NSites)
 
+class GConvEmbed(GConv):
+    def __init__(self, NSpec, OutChannels, GnnPerms, NNsites, N_ngb, mean=1.0, std=0.1):
+        """
+        Input layer version of GConv that takes a species label for each site instead of one-hot occupancies.
+        The convolution of one-hot occupancies only picks out one weight column per neighbor, so the
+        rotated weights are used directly as an embedding table, summed over the neighbors of each site.
+        :param: NSpec - no. of species channels. Labels 0 to NSpec-1 are the channels, and the label NSpec
+        is the vacancy, which has no channel and contributes nothing.
+        :param: the rest are the same as GConv.
+        """
+        super().__init__(NSpec, OutChannels, GnnPerms, NNsites, N_ngb, mean=mean, std=std)
+
+    def forward(self, In):
+        # In has shape (Nbatch, Nsites) and holds the species label of each site
+        Nbatch = In.shape[0]
+        NchIn = self.NchIn
+        NchOut = self.NchOut
+        N_ngb = self.NNsites.shape[0]
+        Ng = self.GnnPerms.shape[0]
+        NSites = self.NSites
+
+        if pt.is_grad_enabled() and self.Psi.requires_grad:
+            # The backward pass of embedding_bag is slower than that of the dense convolution,
+            # so for training the labels are only expanded into occupancies on the device.
+            return super().forward(OneHot(In, int(NchIn), self.Psi.dtype))
+
+        self.RotateParams(self.GnnPerms)
+
+        # Embedding table with row k*(NchIn + 1) + label holding the weights of the k^th neighbor
+        # for that label. The vacancy rows are zero.
+        table = self.GWeights.view(NchOut * Ng, NchIn, N_ngb).permute(2, 1, 0)
+        table = F.pad(table, (0, 0, 0, 1)).reshape(N_ngb * (NchIn + 1), NchOut * Ng)
+
+        # labels of the neighbors of each site, shifted into the row block of their neighbor
+        offsets = pt.arange(N_ngb, device=In.device).view(N_ngb, 1) * (NchIn + 1)
+        ngbRows = In.long()[:, self.NNsites] + offsets
+        ngbRows = ngbRows.transpose(1, 2).reshape(Nbatch * NSites, N_ngb)
+
+        out = F.embedding_bag(ngbRows, table, mode="sum").view(Nbatch, NSites, NchOut * Ng)
+        out = out.transpose(1, 2) + self.Gbias
+
+        return out.reshape(Nbatch, NchOut, Ng, NSites)
+
+
+def OneHot(In, NSpec, dtype):
+    """
+    Expands species labels of shape (Nbatch, Nsites) into one-hot occupancies of shape (Nbatch, NSpec, Nsites).
+    The label NSpec (vacancy) gets no channel.
+    """
+    return F.one_hot(In.long(), NSpec + 1)[:, :, :NSpec].transpose(1, 2).to(dtype)
+
+
 class GAvg(nn.Module):
     def __init__(self):
         super().__init__()
@@ -101,10 +268,45 @@ class GAvg(nn.Module):
         return pt.sum(In, dim=2)/Ng
 
 
+class GAvgReduced(nn.Module):
+    def __init__(self, multiplicity):
+        """
+        Group average over the distinct neighbor permutations of a group (see ReduceGroup), each weighted by the
+        no. of group operations that give it. The same as GAvg over the whole group.
+        :param: multiplicity - no. of group operations giving each distinct permutation - shape (Ndistinct,).
+        """
+        super().__init__()
+        self.register_buffer("weights", multiplicity.double() / multiplicity.sum())
+
+    def forward(self, In):
+        return pt.sum(In * self.weights.to(In.dtype).view(1, 1, -1, 1), dim=2)
+
+
+def ReduceGroup(GnnPerms):
+    """
+    Distinct neighbor permutations of the group operations. Operations that permute the neighbors in the same
+    way give the same rotated filter, so the convolution only needs to be done once for each distinct
+    permutation, and the group average is weighted by the multiplicities (see GAvgReduced).
+    :param: GnnPerms - Permutation of nearest neighbors under inverse group operations - shape (Ng, N_ngb)
+    :return: GnnPerms - the distinct permutations, in the order they first appear in GnnPerms (so that
+    the identity stays first) - shape (Ndistinct, N_ngb).
+    :return: multiplicity - no. of group operations giving each distinct permutation - shape (Ndistinct,), or
+    None if all the permutations are distinct.
+    """
+    perms, inverse, counts = pt.unique(GnnPerms, dim=0, return_inverse=True, return_counts=True)
+    if perms.shape[0] == GnnPerms.shape[0]:
+        return GnnPerms, None
+    first = pt.full((perms.shape[0],), GnnPerms.shape[0], dtype=pt.long)
+    first = first.scatter_reduce(0, inverse.cpu(), pt.arange(GnnPerms.shape[0]), reduce="amin")
+    order = pt.argsort(first)
+    return perms[order.to(perms.device)], counts[order.to(counts.device)]
+
+
 
 class GCNet(nn.Module):
     def __init__(self, GnnPerms, NNsites, JumpVecs, N_ngb,
-            NSpec, mean=1.0, std=0.1, nl=3, nch=8, nchLast=1, relu=False):
+            NSpec, mean=1.0, std=0.1, nl=3, nch=8, nchLast=1, relu=False, fused=False, labels=False,
+            reduceGroup=False):
         
         super().__init__()
         modules = []
@@ -113,31 +315,46 @@ class GCNet(nn.Module):
             nonLin = nn.ReLU
         else:
             nonLin = nn.Softplus
+
+        # With reduceGroup, the convolutions are only done for the distinct neighbor permutations of the group,
+        # and averaged with their multiplicities. If all of them are distinct, the network is the same.
+        multiplicity = None
+        if reduceGroup:
+            GnnPerms, multiplicity = ReduceGroup(GnnPerms)
+
+        def groupAvg():
+            return GAvg() if multiplicity is None else GAvgReduced(multiplicity)
         
+        # With labels, the input states hold a species label per site instead of one-hot occupancies
+        def inputLayer(OutChannels):
+            if labels:
+                return GConvEmbed(NSpec, OutChannels, GnnPerms, NNsites, N_ngb, mean=mean, std=std)
+            return GConv(NSpec, OutChannels, GnnPerms, NNsites, N_ngb, mean=mean, std=std, fused=fused)
+
         if nl == -1:
             modules = [
-                GConv(NSpec, nchLast, GnnPerms, NNsites, N_ngb, mean=mean, std=std),
+                inputLayer(nchLast),
                 nonLin(),
-                GAvg()
+                groupAvg()
             ]
 
         else:
             modules += [
-                GConv(NSpec, nch, GnnPerms, NNsites, N_ngb, mean=mean, std=std),
+                inputLayer(nch),
                 nonLin(),
-                GAvg()
+                groupAvg()
             ]
 
             for l in range(nl):
                 modules += [
-                    GConv(nch, nch, GnnPerms, NNsites, N_ngb, mean=mean, std=std),
+                    GConv(nch, nch, GnnPerms, NNsites, N_ngb, mean=mean, std=std, fused=fused),
                     nonLin(),
-                    GAvg()
+                    groupAvg()
                 ]
             modules += [
-                GConv(nch, nchLast, GnnPerms, NNsites, N_ngb, mean=mean, std=std),
+                GConv(nch, nchLast, GnnPerms, NNsites, N_ngb, mean=mean, std=std, fused=fused),
                 nonLin(),
-                GAvg()
+                groupAvg()
             ]
         
         self.net = nn.Sequential(*modules)
@@ -150,9 +367,8 @@ class GCNet(nn.Module):
         N_ngb = self.NNsites.shape[0]
         Nch = In.shape[1]
         Nsites = In.shape[2]
-        In = In.repeat_interleave(N_ngb, dim=1)
-        NNRepeat = self.NNsites.unsqueeze(0).repeat(In.shape[0], Nch, 1)
-        return pt.gather(In, 2, NNRepeat).view(In.shape[0], Nch, N_ngb, Nsites)
+        out = In[:, :, self.NNsites.reshape(-1)]
+        return out.view(In.shape[0], Nch, N_ngb, Nsites)
 
     def NgbSum(self, In):
         Nbatch = In.shape[0]
@@ -168,7 +384,9 @@ class GCNet(nn.Module):
 
     def forward(self, InState):
         y = self.net(InState)
-        return self.NgbSum(y)
+        # The jump vectors nearly cancel in the neighbor sum, so it is never autocast to reduced precision
+        with pt.autocast(device_type=y.device.type, enabled=False):
+            return self.NgbSum(y.to(self.JumpVecs.dtype))
     
     def getRep(self, InState, LayerInd):
         # LayerInd is counted starting from zero
@@ -181,6 +399,199 @@ class GCNet(nn.Module):
             y = self.net[L](y)
         return y
 
+    def ExitPlan(self, JumpNewSites):
+        """
+        Sites to recompute for the exit states of every jump in forwardExits.
+        The exit state after a jump (JumpNewSites) is the state with the vacancy at site 0 swapped with its
+        neighbor, translated back so that the vacancy is at site 0 again. The network is translation-equivariant,
+        so the outputs of an exit state are those of the swapped state, translated in the same way. The swapped
+        state only differs from the state at two sites, and the outputs of each layer only change at the sites
+        within the receptive field of those two sites.
+        :param: JumpNewSites - site permutation of each jump - shape (Nj, Nsites).
+        :return: plan - dictionary of the index tensors used by forwardExits.
+        """
+        NNsites = self.net[0].NNsites
+        Nsites = NNsites.shape[1]
+        JumpNewSites = pt.as_tensor(JumpNewSites).long().to(NNsites.device)
+        Nj = JumpNewSites.shape[0]
+        sites = pt.arange(Nsites, device=NNsites.device)
+
+        # For each jump, find the neighbor of site 0 for which the permutation is the swap of that neighbor
+        # with site 0, followed by a translation, i.e, a permutation of the sites that keeps the neighbor lists.
+        swapSites = []
+        translations = []
+        for jmp in range(Nj):
+            for ngb in NNsites[1:, 0].tolist():
+                swap = sites.clone()
+                swap[0], swap[ngb] = ngb, 0
+                tau = swap[JumpNewSites[jmp]]
+                if pt.equal(NNsites[:, tau], tau[NNsites]):
+                    break
+            else:
+                raise ValueError("Jump {} is not a nearest neighbor vacancy jump followed by a translation".format(jmp))
+            swapSites.append(ngb)
+            translations.append(tau)
+
+        # Sites at which the output of each layer changes, padded to the same no. of sites for every jump by
+        # repeating the first one, which then only gets computed more than once.
+        def padSites(siteList):
+            m = max(s.shape[0] for s in siteList)
+            return pt.stack([pt.cat((s, s[:1].repeat(m - s.shape[0]))) for s in siteList])
+
+        changed = [pt.tensor([[0, ngb] for ngb in swapSites], device=NNsites.device)]
+        layerNgbs = [NNsites] * (len(self.net) // 3) + [self.NNsites]
+        gathers = []
+        for ngbs in layerNgbs:
+            prev = changed[-1]
+            siteList = []
+            for jmp in range(Nj):
+                mask = pt.zeros(Nsites, dtype=pt.bool, device=NNsites.device)
+                mask[prev[jmp]] = True
+                siteList.append(mask[ngbs].any(dim=0).nonzero().view(-1))
+            new = padSites(siteList)
+
+            # neighbors of the new sites, and where they are among the changed sites of the previous layer
+            # (-1 for the ones that keep the values of the state)
+            ngbSites = ngbs[:, new].transpose(0, 1)
+            loc = pt.full((Nj, Nsites), -1, dtype=pt.long, device=NNsites.device)
+            loc.scatter_(1, prev, pt.arange(prev.shape[1], device=NNsites.device).repeat(Nj, 1))
+            src = pt.gather(loc, 1, ngbSites.reshape(Nj, -1)).view(ngbSites.shape)
+            jj, kk, pp = (src >= 0).nonzero(as_tuple=True)
+            gathers.append((ngbSites, (jj, kk, pp), src[jj, kk, pp]))
+            changed.append(new)
+
+        translations = pt.stack(translations)
+        # the sites of the exit states that the changed outputs are translated to
+        inverse = pt.argsort(translations, dim=1)
+        exitSites = pt.gather(inverse, 1, changed[-1])
+
+        return {"swapSources": pt.stack([changed[0][:, 1], changed[0][:, 0]], dim=1), "gathers": gathers,
+                "translations": translations, "exitSites": exitSites}
+
+    def forwardExits(self, InState, plan):
+        """
+        Outputs of a batch of states and of all their exit states, as from forward on each of them, but with
+        only the sites within the receptive field of the jump recomputed for the exit states (see ExitPlan).
+        :param: InState - occupancies or species labels of the states - shape (Nbatch, NSpec, Nsites) or (Nbatch, Nsites).
+        :param: plan - the exit plan of the jumps (see ExitPlan).
+        :return: y - outputs of the states - shape (Nbatch, nchLast, 3, Nsites).
+        :return: yExits - outputs of the exit states, with the exit of state samp after jump jmp in row
+        samp * Nj + jmp - shape (Nbatch * Nj, nchLast, 3, Nsites).
+        """
+        Nbatch = InState.shape[0]
+        Nj = plan["translations"].shape[0]
+
+        # outputs of each layer for the states - the changed values of the exits are filled in from these
+        acts = [InState]
+        for L in range(0, len(self.net), 3):
+            acts.append(self.net[L + 2](self.net[L + 1](self.net[L](acts[-1]))))
+
+        # the exits are convolved as occupancies, also when the network takes species labels
+        if InState.dim() == 2:
+            InState = OneHot(InState, int(self.net[0].NchIn), self.net[0].Psi.dtype)
+            acts[0] = InState
+
+        def gatherChanged(act, changedAct, gather):
+            # values at the neighbors of the changed sites, with those that changed for the exits put in.
+            # shape (Nbatch, Nch, Nj, Nngb, m)
+            ngbSites, (jj, kk, pp), src = gather
+            out = act[:, :, ngbSites.reshape(-1)].view(act.shape[0], act.shape[1], *ngbSites.shape)
+            out[:, :, jj, kk, pp] = changedAct[:, :, jj, src].to(out.dtype)
+            return out
+
+        # the changed occupancies of the swapped states - shape (Nbatch, NSpec, Nj, 2)
+        changedAct = InState[:, :, plan["swapSources"]]
+        for L in range(0, len(self.net), 3):
+            conv = self.net[L]
+            conv.RotateParams(conv.GnnPerms)
+            ngbs = gatherChanged(acts[L // 3], changedAct, plan["gathers"][L // 3])
+            m = ngbs.shape[-1]
+            ngbs = ngbs.permute(0, 2, 1, 3, 4).reshape(Nbatch * Nj, -1, m)
+            out = (pt.matmul(conv.GWeights, ngbs) + conv.Gbias).view(Nbatch * Nj, int(conv.NchOut), -1, m)
+            out = self.net[L + 2](self.net[L + 1](out))
+            changedAct = out.view(Nbatch, Nj, -1, m).transpose(1, 2)
+
+        with pt.autocast(device_type=InState.device.type, enabled=False):
+            y = self.NgbSum(acts[-1].to(self.JumpVecs.dtype))
+            ngbs = gatherChanged(acts[-1].to(self.JumpVecs.dtype), changedAct, plan["gathers"][-1])
+            # shape (Nbatch, Nj, Nch, 3, m)
+            yChanged = pt.matmul(self.JumpVecs, ngbs.permute(0, 2, 1, 3, 4))
+
+            # the exit outputs are the translated outputs of the states, with the changed sites put in
+            Nch, Ndim, Nsites = y.shape[1:]
+            yExits = y[:, :, :, plan["translations"].reshape(-1)].view(Nbatch, Nch, Ndim, Nj, Nsites)
+            yExits = yExits.permute(0, 3, 1, 2, 4).clone(memory_format=pt.contiguous_format)
+            exitSites = plan["exitSites"]
+            jj = pt.arange(Nj, device=y.device).repeat_interleave(exitSites.shape[1])
+            pp = pt.arange(exitSites.shape[1], device=y.device).repeat(Nj)
+            yExits[:, jj, :, :, exitSites.reshape(-1)] = yChanged[:, jj, :, :, pp]
+
+        return y, yExits.view(Nbatch * Nj, Nch, Ndim, Nsites)
+
+
+class FrozenGConv(nn.Module):
+    def __init__(self, gconv):
+        """
+        Inference version of a trained GConv (or GConvEmbed, with one-hot occupancies as input) with the
+        group-rotated weights and biases built once and stored as constant buffers, along with the flattened
+        neighbor list used to gather the neighbors of every site.
+        :param: gconv - the trained layer.
+        """
+        super().__init__()
+        with pt.no_grad():
+            W, b = gconv.GroupWeights()
+        self.register_buffer("W", W)
+        self.register_buffer("b", b)
+        self.register_buffer("ngbIndex", gconv.NNsites.reshape(-1).clone())
+        self.NchOut = int(gconv.NchOut)
+        self.Ng = int(gconv.GnnPerms.shape[0])
+        self.Nsites = int(gconv.NSites)
+
+    def forward(self, In):
+        Nbatch = In.shape[0]
+        out = In[:, :, self.ngbIndex].view(Nbatch, -1, self.Nsites)
+        out = pt.matmul(self.W, out) + self.b
+        return out.view(Nbatch, self.NchOut, self.Ng, self.Nsites)
+
+
+class FrozenGCNet(nn.Module):
+    def __init__(self, gNet, chLabels):
+        """
+        Inference version of a trained GCNet, which only does the forward pass, with the rotated weights of every
+        layer and the neighbor gathers stored as constants (see FrozenGConv). It takes the states as they are
+        stored in the data sets (one species per site, with the vacancy at site 0), so that it can be used without
+        any of the data preparation in GCNetRun. The outputs are the same as those of gNet for the occupancies of
+        the states.
+        :param: gNet - the trained network.
+        :param: chLabels - species channel of each species, with NSpec for the vacancy (see makeStateLabels in
+        GCNetRun), so that the network can be scripted and run on its own.
+        """
+        super().__init__()
+        layers = []
+        for layer in gNet.net:
+            layers.append(FrozenGConv(layer) if isinstance(layer, GConv) else copy.deepcopy(layer))
+        self.net = nn.Sequential(*layers)
+        self.NSpec = int(gNet.net[0].NchIn)
+
+        dtype = gNet.net[0].Psi.dtype
+        self.register_buffer("chLabels", pt.as_tensor(chLabels).long())
+        # the vacancy site is always left empty, as in the occupancies used to train the network
+        siteMask = pt.ones(1, 1, int(gNet.net[0].NSites), dtype=dtype)
+        siteMask[:, :, 0] = 0
+        self.register_buffer("siteMask", siteMask)
+        self.register_buffer("ngbIndex", gNet.NNsites.reshape(-1).clone())
+        self.register_buffer("JumpVecs", gNet.JumpVecs.clone())
+
+    def forward(self, states):
+        # states has shape (Nbatch, Nsites) and holds the species at each site
+        labels = self.chLabels[states.long()]
+        occs = F.one_hot(labels, self.NSpec + 1)[:, :, :self.NSpec].transpose(1, 2).to(self.siteMask.dtype)
+        y = self.net(occs * self.siteMask).to(self.JumpVecs.dtype)
+
+        Nbatch, Nch, Nsites = y.shape
+        y = y[:, :, self.ngbIndex].view(Nbatch, Nch, -1, Nsites)
+        return pt.matmul(self.JumpVecs, y)
+
 
 # Let's build a message passing / crystal graph network here
 class msgPassLayer(nn.Module):
@@ -189,15 +600,18 @@ class msgPassLayer(nn.Module):
     GConv layers need space group information, but the message passing layer does not.
     Message passing is more seamlessly applicable to multi-site lattices.
     """
-    def __init__(self, NChannels, CompsPerSiteIn, CompsPerSiteOut, NNsites, mean=1.0, std=0.1):
+    def __init__(self, NChannels, CompsPerSiteIn, CompsPerSiteOut, NNsites, mean=1.0, std=0.1, NgbChunk=None):
         """
         :param NChannels: No. of mesaage gathering linear transformations in each layer.
         :param CompsPerSiteIn(Out): No. of components in the input (output) tensor for each site.
         :param NNsites: nearest neighbors of each site - shape(coordination number + 1, Nsites).
         :param mean: mean to initialize the weight arrays from a normal distribution.
         :param std: standard deviation to initialize the weight arrays from a normal distribution.
+        :param NgbChunk: No. of neighbors whose messages are computed together. All neighbors are done
+        together if None. Smaller values reduce the memory needed by the forward pass.
         """
         super().__init__()
+        self.NgbChunk = NgbChunk
         Nsites = NNsites.shape[1]
         self.register_buffer("NSites", pt.tensor(Nsites))
         self.register_buffer("NNsites", NNsites)
@@ -219,6 +633,38 @@ class msgPassLayer(nn.Module):
         :return: out: output tensor of shape (N_batch, NSpec, Nsites), or of shape
         (N_batch, 1, Nsites) if "output" argument in __init__ was set to True.
         """
+        Nbatch = In.shape[0]
+        NchIn = In.shape[1]
+        Nsites = In.shape[2]
+        Z = self.NNsites.shape[0] - 1
+
+        # The channels are summed linearly before the non-linearity, so we can sum the weights and biases
+        # over them first. Then the messages from a site itself and from its neighbors are separate products,
+        # which are done once for all sites before the neighbor messages are gathered.
+        W = pt.sum(self.Weights, dim=0)
+        b = pt.sum(self.bias, dim=0)
+        selfMsg = pt.matmul(W[:, :NchIn], In) + b.view(1, -1, 1)
+        ngbMsg = pt.matmul(W[:, NchIn:], In)
+        # selfMsg and ngbMsg have shape (batch, specChannels, Nsites)
+
+        NgbChunk = Z if self.NgbChunk is None else self.NgbChunk
+        out = 0.
+        for z in range(0, Z, NgbChunk):
+            zEnd = min(z + NgbChunk, Z)
+            # gather the messages from the neighbors z to zEnd - 1 of all the sites
+            ngbSites = self.NNsites[1 + z: 1 + zEnd].reshape(-1)
+            o = selfMsg.unsqueeze(2) + ngbMsg[:, :, ngbSites].view(Nbatch, ngbMsg.shape[1], zEnd - z, Nsites)
+
+            # Apply non-linearity and sum across neighbors
+            out = out + pt.sum(F.softplus(o), dim=2)
+
+        return out
+
+    def forward_loop(self, In):
+        """
+        Computes the same output as forward, one neighbor at a time, without summing the weights of the
+        channels first. Kept as a reference for testing.
+        """
 
         dt = In.dtype
         dev = In.device
@@ -226,7 +672,6 @@ class msgPassLayer(nn.Module):
 
         total[:, :In.shape[1], :] = In[:, :, :]
 
-        # ToDo : can this loop be optimized with primitives?
         out = pt.zeros(In.shape[0], self.Weights.shape[1], In.shape[2], dtype=dt).to(dev)
         for z in range(self.Z):
             # reindex the site according to the z^th nearest neighbor and append
@@ -253,7 +698,8 @@ class msgPassNet(nn.Module):
     Constructs a sequence of message passing layers, and return relaxation vector as a linear combination of
     nearest neighbor vectors, with the coefficients of the combination being the output of the last layer.
     """
-    def __init__(self, NLayers, NChannels, NSpec, VecsPerSite, NNsites, JumpVecs, mean=1.0, std=0.1):
+    def __init__(self, NLayers, NChannels, NSpec, VecsPerSite, NNsites, JumpVecs, mean=1.0, std=0.1, NgbChunk=None,
+                 labels=False):
         """
         :param NChannels: No. of mesaage gathering linear transformations in each layer.
         :param NSpec: No. of atomic species (excluding vacancy)
@@ -262,8 +708,13 @@ class msgPassNet(nn.Module):
         :param JumpVecs: nearest neighbor Jump vectors - shape(coordination number, 3).
         :param mean: mean to initialize the weight arrays from a normal distribution.
         :param std: standard deviation to initialize the weight arrays from a normal distribution.
+        :param NgbChunk: No. of neighbors whose messages are computed together in each layer (see msgPassLayer).
+        :param labels: whether the input states hold a species label per site instead of one-hot occupancies.
+        They are expanded into occupancies on the device.
         """
         super().__init__()
+        self.NSpec = NSpec
+        self.labels = labels
         Nsites = NNsites.shape[1]
         self.register_buffer("JumpVecs", JumpVecs)
         self.register_buffer("NNsites", NNsites[1:, :]) # exclude the vacancy site - this will be used to reindex
@@ -272,12 +723,12 @@ class msgPassNet(nn.Module):
         # arguments of msgPassLayer: NChannels, CompsPerSiteIn, CompsPerSiteOut, NNsites, mean=1.0, std=0.1
         for l in range(NLayers):
             seq += [
-                msgPassLayer(NChannels, NSpec, NSpec, NNsites, mean=mean, std=std)
+                msgPassLayer(NChannels, NSpec, NSpec, NNsites, mean=mean, std=std, NgbChunk=NgbChunk)
             ]
 
         # Apply output layer
         seq += [
-            msgPassLayer(NChannels, NSpec, VecsPerSite, NNsites, mean=mean, std=std)
+            msgPassLayer(NChannels, NSpec, VecsPerSite, NNsites, mean=mean, std=std, NgbChunk=NgbChunk)
         ]
 
         self.net = nn.Sequential(*seq)
@@ -286,16 +737,18 @@ class msgPassNet(nn.Module):
         N_ngb = self.NNsites.shape[0]
         Nch = out.shape[1]
         Nsites = out.shape[2]
-        out = out.repeat_interleave(N_ngb, dim=1)
-        NNRepeat = self.NNsites.unsqueeze(0).repeat(out.shape[0], Nch, 1)
-        return pt.gather(out, 2, NNRepeat).view(out.shape[0], Nch, N_ngb, Nsites)
+        return out[:, :, self.NNsites.reshape(-1)].view(out.shape[0], Nch, N_ngb, Nsites)
 
     def forward(self, In):
+        if self.labels:
+            In = OneHot(In, self.NSpec, self.JumpVecs.dtype)
         out = self.net(In) # shape (batch, 1, sites)
         # print(out.shape)
         out = self.reshapeOut(out)
         # print(out.shape)
-        return pt.matmul(self.JumpVecs, out)
+        # The jump vectors nearly cancel in the neighbor sum, so it is never autocast to reduced precision
+        with pt.autocast(device_type=out.device.type, enabled=False):
+            return pt.matmul(self.JumpVecs, out.to(self.JumpVecs.dtype))
 
 
 
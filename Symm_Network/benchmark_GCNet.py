@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import platform
+import argparse
+import itertools
+import subprocess
+
+import numpy as np
+import torch as pt
+
+from GCNetRun import Load_crysDats, makeStateTensors, train_batch_collective, Precisions, storageType, \
+    autocastContext, device
+from SymmLayers import GConv, GCNet, msgPassNet, ReduceGroup
+
+# Timings of the hot path of training - the group convolution layers, the networks, building the state tensors
+# and a whole training step - for the crystal data files in CrysDat_FCC, over the no. of channels, the no. of layers,
+# the batch size and the symmetry group (the full group, the identity only as with --NoSymmetry in GCNetRun.py, or
+# the distinct neighbor permutations of the full group as with --ReduceGroup).
+# The states are random, with one vacancy at site 0, so that no data set is needed.
+# Results are saved as JSON, and can be compared to those of an earlier run (e.g., of another commit).
+
+CrysDatDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CrysDat_FCC")
+CrysDats = ["CrystData.h5", "CrystData_ortho_5_cube.h5"]
+
+def sync():
+    if device.type == "cuda":
+        pt.cuda.synchronize()
+
+def timeit(fn, Nrep=5, warmup=1):
+    """
+    Wall times of a function.
+    :param fn: function to time, called without arguments.
+    :param Nrep: no. of timed calls.
+    :param warmup: no. of calls before the timed ones (not timed).
+    :return: dictionary of the median, min. and mean times of the calls in seconds.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(Nrep):
+        sync()
+        start = time.perf_counter()
+        fn()
+        sync()
+        times.append(time.perf_counter() - start)
+    return {"median_s": float(np.median(times)), "min_s": float(np.min(times)), "mean_s": float(np.mean(times))}
+
+def randomStates(Nstates, Nsites, NSpec, JumpNewSites, seed=0):
+    # random species labels 0 to NSpec - 1 with the vacancy (label NSpec) at site 0, along with the state after
+    # a random jump out of each of them. Every species is present in the first state (see makeStateTensors).
+    rng = np.random.default_rng(seed)
+    state1List = rng.integers(0, NSpec, size=(Nstates, Nsites)).astype(np.int8)
+    state1List[0, 1 : NSpec + 1] = np.arange(NSpec)
+    state1List[:, 0] = NSpec
+    jumps = rng.integers(0, JumpNewSites.shape[0], size=Nstates)
+    state2List = state1List[np.arange(Nstates).reshape(-1, 1), JumpNewSites[jumps]]
+    return state1List, state2List
+
+def benchConfigs(CrysDatPath, nchs, nls, batchSizes, symmetries, NSpec=5, dtype=pt.double, Nrep=5, msgPass=True):
+    """
+    Times the benchmarks for one crystal over all the combinations of the settings.
+    :param CrysDatPath: path to the crystal data file.
+    :param nchs: no. of channels of the intermediate layers.
+    :param nls: no. of intermediate layers.
+    :param batchSizes: no. of states in a batch.
+    :param symmetries: "full" for the full symmetry group, "none" for the identity only and "reduced" for the
+    distinct neighbor permutations of the full group (see ReduceGroup).
+    :param NSpec: no. of species other than the vacancy.
+    :param dtype: precision the networks are run in (see Precisions).
+    :param Nrep: no. of timed calls of each benchmark.
+    :param msgPass: whether to also time message passing networks.
+    :return: list of records of the settings and the times of each benchmark.
+    """
+    GpermNNIdx, NNsiteList, JumpNewSites, dxJumps = Load_crysDats(CrysDatPath)
+    N_ngb, Nsites = NNsiteList.shape
+    NNsites = pt.tensor(NNsiteList).long()
+    JumpVecs = pt.tensor(dxJumps.T, dtype=pt.double)
+    VacSpec = NSpec
+    crystal = os.path.basename(CrysDatPath)
+
+    records = []
+    def record(bench, timings, batch, **settings):
+        timings["samples_per_sec"] = batch / timings["median_s"]
+        records.append(dict(bench=bench, crystal=crystal, Nsites=Nsites, batch=batch, **settings, **timings))
+        print("{:<22s} {:<28s} {}: {:.4e} s".format(
+            bench, crystal, " ".join("{} {}".format(key, val) for key, val in dict(batch=batch, **settings).items()),
+            timings["median_s"]), flush=True)
+
+    for batch in batchSizes:
+        state1List, state2List = randomStates(batch, Nsites, NSpec, JumpNewSites)
+        record("makeStateTensors", timeit(lambda: makeStateTensors(state1List, [VacSpec], VacSpec, JumpNewSites),
+                                          Nrep=Nrep), batch)
+
+        state1 = pt.tensor(makeStateTensors(state1List, [VacSpec], VacSpec, JumpNewSites)[0])
+        state2 = pt.tensor(makeStateTensors(state2List, [VacSpec], VacSpec, JumpNewSites)[0])
+        state1 = state1.to(device).to(storageType(dtype))
+        state2 = state2.to(device).to(storageType(dtype))
+        rates = pt.rand(batch, dtype=pt.double, device=device)
+        disps = pt.randn(batch, 3, dtype=pt.double, device=device)
+
+        for nch, nl, symmetry in itertools.product(nchs, nls, symmetries):
+            GnnPerms = pt.tensor(GpermNNIdx if symmetry != "none" else GpermNNIdx[:1]).long()
+            reduceGroup = symmetry == "reduced"
+            if reduceGroup:
+                GnnPerms = ReduceGroup(GnnPerms)[0]
+            settings = dict(nch=nch, nl=nl, symmetry=symmetry, Ng=GnnPerms.shape[0])
+
+            pt.manual_seed(0)
+            if nl == nls[0]:
+                # a single layer does not depend on the no. of layers
+                gconv = GConv(nch, nch, GnnPerms, NNsites, N_ngb, mean=0.02, std=0.2).to(device).to(storageType(dtype))
+                x = pt.randn(batch, nch, Nsites, device=device).to(storageType(dtype))
+                with pt.no_grad(), autocastContext(dtype):
+                    record("GConv", timeit(lambda: gconv(x), Nrep=Nrep), batch, nch=nch, symmetry=symmetry,
+                           Ng=settings["Ng"])
+
+            gNet = GCNet(pt.tensor(GpermNNIdx).long() if reduceGroup else GnnPerms, NNsites, JumpVecs, N_ngb=N_ngb,
+                         NSpec=NSpec, mean=0.02, std=0.2, nl=nl, nch=nch, nchLast=1,
+                         reduceGroup=reduceGroup).to(device).to(storageType(dtype))
+            with pt.no_grad(), autocastContext(dtype):
+                record("GCNet.forward", timeit(lambda: gNet(state1), Nrep=Nrep), batch, **settings)
+
+            def forwardBackward():
+                gNet.zero_grad()
+                with autocastContext(dtype):
+                    y = gNet(state1)
+                y.double().sum().backward()
+            record("GCNet.forward_backward", timeit(forwardBackward, Nrep=Nrep), batch, **settings)
+
+            # one step of Train, with both states of each jump
+            opt = pt.optim.Adam(gNet.parameters(), lr=0.001)
+            def trainStep():
+                opt.zero_grad()
+                diff, _, _ = train_batch_collective(gNet, state1, state2, rates, disps, None, None, [VacSpec],
+                                                    VacSpec, None, None, dtype=dtype)
+                diff.backward()
+                opt.step()
+            record("Train.step", timeit(trainStep, Nrep=Nrep), batch, **settings)
+
+        if not msgPass:
+            continue
+        # message passing networks have no group, and are timed once for each size
+        for nch, nl in itertools.product(nchs, nls):
+            pt.manual_seed(0)
+            mpNet = msgPassNet(NLayers=nl, NChannels=nch, NSpec=NSpec, VecsPerSite=1, NNsites=NNsites,
+                               JumpVecs=JumpVecs, mean=0.02, std=0.2).to(device).to(storageType(dtype))
+            with pt.no_grad(), autocastContext(dtype):
+                record("msgPassNet.forward", timeit(lambda: mpNet(state1), Nrep=Nrep), batch, nch=nch, nl=nl)
+
+    return records
+
+def recordKey(record):
+    # the settings of a record, by which runs are compared
+    return tuple((key, record[key]) for key in sorted(record.keys())
+                 if not (key.endswith("_s") or key == "samples_per_sec"))
+
+def compare(records, baseline):
+    """
+    Ratios of the median times of the benchmarks to those of a baseline run with the same settings.
+    :param records: records of this run (see benchConfigs).
+    :param baseline: records of the baseline run.
+    :return: list of (record, ratio) for the settings found in both runs - ratios above 1 are slower than baseline.
+    """
+    baseTimes = {recordKey(record): record["median_s"] for record in baseline}
+    return [(record, record["median_s"] / baseTimes[recordKey(record)]) for record in records
+            if recordKey(record) in baseTimes]
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(args):
+    dtype = Precisions[args.Precision]
+    if args.Threads is not None:
+        pt.set_num_threads(args.Threads)
+
+    records = []
+    for CrysDat in args.CrysDats:
+        CrysDatPath = CrysDat if os.path.exists(CrysDat) else os.path.join(CrysDatDir, CrysDat)
+        records += benchConfigs(CrysDatPath, args.Nchannels, args.Nlayers, args.Batch_sizes, args.Symmetries,
+                                NSpec=args.NSpec, dtype=dtype, Nrep=args.Nrep, msgPass=not args.NoMsgPass)
+
+    meta = {"commit": gitCommit(), "torch": pt.__version__, "python": platform.python_version(),
+            "machine": platform.machine(), "processor": platform.processor(), "device": str(device),
+            "threads": pt.get_num_threads(), "precision": args.Precision, "Nrep": args.Nrep,
+            "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+    with open(args.OutPath, "w") as fl:
+        json.dump({"meta": meta, "results": records}, fl, indent=1)
+    print("Results of {} benchmarks saved to {}".format(len(records), args.OutPath))
+
+    if args.Compare is not None:
+        with open(args.Compare, "r") as fl:
+            baseline = json.load(fl)
+        print("Compared to commit {} (time / baseline time):".format(baseline["meta"]["commit"]))
+        for record, ratio in compare(records, baseline["results"]):
+            settings = " ".join("{} {}".format(key, val) for key, val in recordKey(record)
+                                if key not in ("bench", "crystal"))
+            print("{:<22s} {:<28s} {}: {:.3f}{}".format(record["bench"], record["crystal"], settings, ratio,
+                  "  <-- slower" if ratio > 1 + args.Tolerance else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the group convolution networks and their training.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-cr", "--CrysDats", metavar="/path/to/crys/dat", type=str, nargs="+", default=CrysDats, help="Crystal data files to benchmark with - paths, or names of files in CrysDat_FCC.")
+    parser.add_argument("-nch", "--Nchannels", metavar="int", type=int, nargs="+", default=[4, 8, 16], help="No. of channels of the intermediate layers to benchmark.")
+    parser.add_argument("-nl", "--Nlayers", metavar="int", type=int, nargs="+", default=[1, 3], help="No. of intermediate layers to benchmark.")
+    parser.add_argument("-bs", "--Batch_sizes", metavar="int", type=int, nargs="+", default=[32, 128], help="Batch sizes to benchmark.")
+    parser.add_argument("-sym", "--Symmetries", metavar="string", type=str, nargs="+", default=["full", "none"], choices=["full", "none", "reduced"], help="Symmetry groups to benchmark - the full group, none (the identity only, as with --NoSymmetry in GCNetRun.py) and reduced (the distinct neighbor permutations of the full group, as with --ReduceGroup).")
+    parser.add_argument("-nsp", "--NSpec", metavar="int", type=int, default=5, help="No. of species other than the vacancy in the random states.")
+    parser.add_argument("-prec", "--Precision", metavar="string", type=str, default="fp64", choices=list(Precisions.keys()), help="Floating point precision of the networks.")
+    parser.add_argument("-nr", "--Nrep", metavar="int", type=int, default=5, help="No. of timed runs of each benchmark (after one untimed run). The median, min. and mean times are saved.")
+    parser.add_argument("-thr", "--Threads", metavar="int", type=int, default=None, help="No. of CPU threads for torch (its default if not given).")
+    parser.add_argument("-nmp", "--NoMsgPass", action="store_true", help="Whether to skip the message passing networks.")
+    parser.add_argument("-o", "--OutPath", metavar="/path/to/output", type=str, default="benchmark_GCNet.json", help="Path of the JSON file to save the results to.")
+    parser.add_argument("-cmp", "--Compare", metavar="/path/to/baseline", type=str, default=None, help="Results of an earlier run to compare to, e.g., of another commit.")
+    parser.add_argument("-tol", "--Tolerance", metavar="float", type=float, default=0.1, help="Relative slow down beyond which a benchmark is flagged in the comparison.")
+
+    args = parser.parse_args()
+    main(args)
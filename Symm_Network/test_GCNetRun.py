@@ -1,6 +1,14 @@
 import unittest
 import os
 import sys
+import time
+import copy
+import json
+import tempfile
+import io
+import contextlib
+import importlib.util
+from unittest import mock
 RunPath = os.getcwd() + "/"
 CrysDatPath = "../CrysDat_FCC/CrystData.h5"
 Data1 = "Test_Data/testData_HEA.h5" # test data set of HEA at 1073 K.
@@ -12,9 +20,96 @@ import torch as pt
 from tqdm import tqdm
 import pickle
 from onsager import crystal, supercell
+import GCNetRun
 from GCNetRun import Load_Data, makeComputeData, makeDataTensors, Load_crysDats
-from GCNetRun import Train
-from SymmLayers import GCNet
+from GCNetRun import Train, Precisions, storageType, Gather_Y
+from GCNetRun import makeStateTensors, JumpExpandedStates
+from GCNetRun import Evaluate, KMCDataset, dataBatches, makeSource2Dest, train_batch_collective
+from GCNetRun import Prefetcher, exportNet, PreprocCache, DataRows, Gather_Y_Exits, exitStates, CheckpointWriter, Profiler
+from GCNetPredict import loadPredictor, predict
+from SymmLayers import GCNet, OneHot
+
+
+# Loop implementations of the occupancy, rate and displacement builders, kept as references for the
+# vectorized ones in GCNetRun
+def makeStateTensors_loop(stateList, sp_ch, NSpec, JumpNewSites, AllJumps=False):
+    Nsamples = stateList.shape[0]
+    Nj = JumpNewSites.shape[0]
+    Nsites = stateList.shape[1]
+    if AllJumps:
+        stateOccs = np.zeros((Nsamples * Nj, NSpec, Nsites), dtype=np.int8)
+        stateExits = np.zeros((Nsamples * Nj, NSpec, Nsites), dtype=np.int8)
+        for stateInd in range(Nsamples):
+            state1 = stateList[stateInd]
+            for jmp in range(Nj):
+                state2 = state1[JumpNewSites[jmp]]
+                for site in range(1, Nsites):
+                    stateOccs[stateInd * Nj + jmp, sp_ch[state1[site]], site] = 1
+                    stateExits[stateInd * Nj + jmp, sp_ch[state2[site]], site] = 1
+        return stateOccs, stateExits
+
+    stateOccs = np.zeros((Nsamples, NSpec, Nsites), dtype=np.int8)
+    for stateInd in range(Nsamples):
+        for site in range(1, Nsites):
+            stateOccs[stateInd, sp_ch[stateList[stateInd, site]], site] = 1
+    return stateOccs
+
+def makeRatesDisps_loop(state1List, dispList, specsToTrain, VacSpec, rateList, JumpSelects, AllJumpRates_st1,
+                        JumpNewSites, dxJumps, NNsiteList, Nsamples, AllJumps=False, tracers=False):
+    a = np.linalg.norm(dispList[0, VacSpec, :]) / np.linalg.norm(dxJumps[0])
+    Nsites = state1List.shape[1]
+    Ndim = dispList.shape[2]
+    NNsvac = NNsiteList[1:, 0]
+    NData = Nsamples * dxJumps.shape[0] if AllJumps else Nsamples
+    rateData = np.zeros(NData)
+    if tracers:
+        GatherTensor_tracers = np.zeros(NData, dtype=int)
+        dispData = np.zeros((NData, Ndim, Nsites))
+    else:
+        GatherTensor_tracers = None
+        dispData = np.zeros((NData, 2, Ndim))
+
+    for samp in range(Nsamples):
+        if AllJumps:
+            state1 = state1List[samp]
+            for jInd in range(dxJumps.shape[0]):
+                Idx = samp * dxJumps.shape[0] + jInd
+                rateData[Idx] = AllJumpRates_st1[samp, jInd]
+                if tracers:
+                    GatherTensor_tracers[Idx] = jInd
+                    for siteInd in range(Nsites):
+                        if siteInd == NNsvac[jInd]:
+                            dispData[Idx, :, siteInd] = -dxJumps[jInd] * a
+                else:
+                    dispData[Idx, 0, :] = dxJumps[jInd] * a
+                    if state1[NNsvac[jInd]] in specsToTrain:
+                        dispData[Idx, 1, :] -= dxJumps[jInd] * a
+        else:
+            rateData[samp] = rateList[samp]
+            if tracers:
+                jInd = JumpSelects[samp]
+                GatherTensor_tracers[samp] = jInd
+                for siteInd in range(Nsites):
+                    if siteInd == NNsvac[jInd]:
+                        dispData[samp, :, siteInd] -= dispList[samp, 0, :]
+            else:
+                dispData[samp, 0, :] = dispList[samp, VacSpec, :]
+                dispData[samp, 1, :] = sum(dispList[samp, spec, :] for spec in specsToTrain)
+
+    return rateData, dispData, GatherTensor_tracers
+
+
+# Training and evaluation in one process of a distributed run, for comparison with a single process
+def trainDistributed(rank, world_size, initFile, TrainArgs, EvalArgs, batch_size):
+    pt.distributed.init_process_group(backend="gloo", init_method="file://" + initFile, rank=rank,
+                                      world_size=world_size)
+    # tensors passed to spawned processes share their memory, so each process needs its own network
+    gNet = copy.deepcopy(TrainArgs[-1])
+    Train(*TrainArgs[:-1], gNet, batch_size=batch_size, DDP=True)
+    train_diff, valid_diff = Evaluate(*EvalArgs[:-1], gNet, batch_size=batch_size, DDP=True)
+    if rank == 0:
+        np.save(TrainArgs[1] + "/diffs.npy", np.array([train_diff, valid_diff]))
+    pt.distributed.destroy_process_group()
 
 
 class TestGCNetRun_HEA_collective(unittest.TestCase):
@@ -24,6 +119,7 @@ class TestGCNetRun_HEA_collective(unittest.TestCase):
         self.state1List, self.state2List, self.dispList, self.rateList, self.AllJumpRates_st1,\
         self.AllJumpRates_st2, self.JumpSelects =\
             Load_Data(Data1)
+        self.DataPath = Data1
 
         self.GpermNNIdx, self.NNsiteList, self.JumpNewSites, self.dxJumps = Load_crysDats(CrysDatPath)
 
@@ -348,6 +444,1022 @@ class TestGCNetRun_HEA_collective(unittest.TestCase):
                             msg="{} \n {}".format(y1[samp], y1_samp.detach().numpy()))
             self.assertTrue(np.allclose(y2[samp], y2_samp.detach().numpy()))
 
+    def test_makeComputeData_labels(self):
+        specsToTrain = [self.specCheck]
+        N_check = 20
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        for AllJumps in [False, True]:
+            computeData = makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, self.VacSpec,
+                                          self.rateList, self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites,
+                                          self.dxJumps, self.NNsiteList, N_check, AllJumps=AllJumps, mode="train")
+
+            computeDataLabels = makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain,
+                                                self.VacSpec, self.rateList, self.JumpSelects, self.AllJumpRates_st1,
+                                                self.JumpNewSites, self.dxJumps, self.NNsiteList, N_check,
+                                                AllJumps=AllJumps, mode="train", labels=True)
+
+            for occs, stLabels in zip(computeData[:2], computeDataLabels[:2]):
+                self.assertEqual(stLabels.dtype, np.int8)
+                self.assertEqual(stLabels.shape, (occs.shape[0], occs.shape[2]))
+                self.assertEqual(occs.nbytes, NSpec * stLabels.nbytes)
+                self.assertTrue(pt.equal(OneHot(pt.tensor(stLabels), NSpec, pt.int8), pt.tensor(occs)))
+
+            # the rest of the compute data is unchanged
+            for arr, arrLabels in zip(computeData[2:], computeDataLabels[2:]):
+                if arr is None:
+                    self.assertTrue(arrLabels is None)
+                elif isinstance(arr, dict):
+                    self.assertEqual(arr, arrLabels)
+                else:
+                    self.assertTrue(np.array_equal(arr, arrLabels))
+
+        # Training on labels should give the same results as training on occupancies
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=8, nchLast=1).double()
+        gNetLabels = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                           mean=0.02, std=0.2, nl=1, nch=8, nchLast=1, labels=True).double()
+        gNetLabels.load_state_dict(gNet.state_dict())
+
+        outs = []
+        for net, data in [(gNet, computeData), (gNetLabels, computeDataLabels)]:
+            State1, State2, rates, disps, _, On_st1, On_st2, sp_ch = data
+            outs.append(Train(self.T, ".", State1, State2, On_st1, On_st2, rates, disps, None, None, specsToTrain,
+                              sp_ch, self.VacSpec, 0, 0, 100, N_check * self.z, net, batch_size=N_check * self.z,
+                              chkpt=False))
+
+        self.assertTrue(np.isclose(outs[0][0], outs[1][0], rtol=1e-12, atol=0))
+        self.assertTrue(np.allclose(outs[0][1], outs[1][1], rtol=1e-10, atol=1e-12))
+        self.assertTrue(np.allclose(outs[0][2], outs[1][2], rtol=1e-10, atol=1e-12))
+
+    def test_makeStateTensors_lazy(self):
+        specsToTrain = [self.specCheck]
+        N_check = 20
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        for labels in [False, True]:
+            eager = makeStateTensors(self.state1List[:N_check], specsToTrain, self.VacSpec, self.JumpNewSites,
+                                     AllJumps=True, labels=labels)
+            lazy = makeStateTensors(self.state1List[:N_check], specsToTrain, self.VacSpec, self.JumpNewSites,
+                                    AllJumps=True, labels=labels, lazy=True)
+
+            self.assertEqual(eager[4], lazy[4])
+            for occs, occsLazy in zip(eager[:2], lazy[:2]):
+                self.assertTrue(isinstance(occsLazy, JumpExpandedStates))
+                self.assertEqual(occsLazy.shape, occs.shape)
+                self.assertTrue(pt.equal(occsLazy[:], pt.tensor(occs)))
+                self.assertTrue(pt.equal(occsLazy[7 : 31], pt.tensor(occs[7 : 31])))
+
+                # shuffling only re-orders the rows
+                perm = pt.randperm(occs.shape[0])
+                occsShuffled = occsLazy[perm]
+                self.assertTrue(isinstance(occsShuffled, JumpExpandedStates))
+                self.assertTrue(pt.equal(occsShuffled[5 : 50], pt.tensor(occs)[perm][5 : 50]))
+
+            for OnSites, OnSitesLazy in zip(eager[2:4], lazy[2:4]):
+                self.assertTrue(np.array_equal(OnSites, OnSitesLazy))
+
+        # Training and y vectors must be the same with lazily built states
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=8, nchLast=1).double()
+        sd = {key: val.clone() for key, val in gNet.state_dict().items()}
+        trainOuts = []
+        yOuts = []
+        for lazy in [False, True]:
+            State1, State2, rates, disps, _, On_st1, On_st2, sp_ch = \
+                makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, self.VacSpec,
+                                self.rateList, self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites,
+                                self.dxJumps, self.NNsiteList, N_check, AllJumps=True, mode="train", lazy=lazy)
+
+            gNet.load_state_dict(sd)
+            yOuts.append(Gather_Y(self.T, ".", State1, State2, On_st1, On_st2, None, None, sp_ch, specsToTrain,
+                                  self.VacSpec, gNet, self.Ndim, batch_size=37))
+
+            trainOuts.append(Train(self.T, ".", State1, State2, On_st1, On_st2, rates, disps, None, None,
+                                   specsToTrain, sp_ch, self.VacSpec, 0, 1, 100, N_check * self.z, gNet,
+                                   batch_size=37, chkpt=False))
+
+        self.assertEqual(trainOuts[0][0], trainOuts[1][0])
+        for out, outLazy in zip(trainOuts[0][1:] + yOuts[0], trainOuts[1][1:] + yOuts[1]):
+            self.assertTrue(np.array_equal(out, outLazy))
+
+    def test_KMCDataset_stream(self):
+        # Streamed batches must be the same as the batches of the in-memory data
+        specsToTrain = [self.specCheck]
+        N_check = 20
+        batch_size = 37
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        for AllJumps, tracers, labels in [(False, False, False), (True, False, True), (False, True, False),
+                                          (True, True, True)]:
+            Nj = self.z if AllJumps else 1
+            State1, State2, rates, disps, GatherTensor, On_st1, On_st2, sp_ch = \
+                makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, self.VacSpec,
+                                self.rateList, self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites,
+                                self.dxJumps, self.NNsiteList, N_check, AllJumps=AllJumps, mode="train",
+                                tracers=tracers, labels=labels, lazy=True)
+            Ndim = disps.shape[1] if tracers else disps.shape[2]
+            tensors = makeDataTensors(State1, State2, rates, disps, On_st1, On_st2, specsToTrain, self.VacSpec, sp_ch,
+                                      Ndim=Ndim, tracers=tracers)
+            GatherTensor = pt.tensor(GatherTensor).long() if tracers else None
+            batches = dataBatches(0, N_check * Nj, batch_size, tensors[0], tensors[1], tensors[3], tensors[2],
+                                  GatherTensor, tensors[4], tensors[5], None, None)
+
+            dataStream = KMCDataset(self.DataPath, specsToTrain, self.VacSpec, self.JumpNewSites, self.dxJumps,
+                                    self.NNsiteList, batch_size, rowEnd=N_check * Nj, AllJumps=AllJumps,
+                                    tracers=tracers, labels=labels)
+            self.assertEqual(dataStream.sp_ch, sp_ch)
+            self.assertEqual(len(dataStream), (N_check * Nj + batch_size - 1) // batch_size)
+
+            NBatches = 0
+            for batch, batchStream in zip(batches, dataStream.loader()):
+                NBatches += 1
+                for arr, arrStream in zip(batch, batchStream):
+                    if arr is None:
+                        self.assertTrue(arrStream is None)
+                        continue
+                    self.assertEqual(arrStream.dtype, pt.as_tensor(arr).dtype)
+                    self.assertTrue(pt.equal(pt.as_tensor(arr), arrStream))
+            self.assertEqual(NBatches, len(dataStream))
+
+        # Training, evaluation and y vectors must be the same with streamed data
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=8, nchLast=1).double()
+        sd = {key: val.clone() for key, val in gNet.state_dict().items()}
+        Nsamples = 3 * N_check
+        State1, State2, rates, disps, _, On_st1, On_st2, sp_ch = \
+            makeComputeData(self.state1List[:Nsamples], self.state2List[:Nsamples], self.dispList[:Nsamples],
+                            specsToTrain, self.VacSpec, self.rateList[:Nsamples], self.JumpSelects[:Nsamples],
+                            self.AllJumpRates_st1[:Nsamples], self.JumpNewSites, self.dxJumps, self.NNsiteList,
+                            None, AllJumps=False, mode="eval")
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            outs = []
+            for dataStream in [None] + [KMCDataset(self.DataPath, specsToTrain, self.VacSpec, self.JumpNewSites,
+                                                   self.dxJumps, self.NNsiteList, batch_size, rowEnd=Nsamples,
+                                                   num_workers=nw)
+                                        for nw in [0, 2]]:
+                arrays = [State1, State2, On_st1, On_st2, rates, disps] if dataStream is None else [None] * 6
+                gNet.load_state_dict(sd)
+                yOut = Gather_Y(self.T, dirPath, *arrays[:4], None, None, sp_ch, specsToTrain, self.VacSpec, gNet,
+                                self.Ndim, batch_size=batch_size, dataStream=dataStream)
+
+                gNet.load_state_dict(sd)
+                trainStream = None if dataStream is None else dataStream.subset(0, N_check)
+                trainOut = Train(self.T, dirPath, *arrays, None, None, specsToTrain, sp_ch, self.VacSpec, 0, 1, 1,
+                                 N_check, gNet, batch_size=batch_size, dataStream=trainStream)
+
+                evalOut = Evaluate(self.T, dirPath, *arrays[:4], *arrays[4:], specsToTrain, None, None, sp_ch,
+                                   self.VacSpec, 0, 1, 1, N_check, gNet, batch_size=batch_size, dataStream=dataStream)
+                os.remove(dirPath + "/ep_0.pt")
+                os.remove(dirPath + "/ep_1.pt")
+                outs.append([trainOut[0]] + list(trainOut[1:]) + list(yOut) + list(evalOut))
+
+        self.assertEqual(outs[0][2].shape[0], min(batch_size, N_check))
+        self.assertEqual(outs[0][3].shape[0], Nsamples)
+        for out in outs[1:]:
+            self.assertEqual(out[0], outs[0][0])
+            for arr, arrStream in zip(outs[0][1:], out[1:]):
+                self.assertTrue(np.array_equal(arr, arrStream))
+
+    def test_Train_distributed(self):
+        # Training and evaluating with the batches shared out across processes must be the same as in one process
+        specsToTrain = [self.specCheck]
+        N_check = 21
+        Nsamples = 3 * N_check
+        batch_size = 10 # the last training batch has fewer rows than there are processes
+        world_size = 3
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        State1, State2, rates, disps, _, On_st1, On_st2, sp_ch = \
+            makeComputeData(self.state1List[:Nsamples], self.state2List[:Nsamples], self.dispList[:Nsamples],
+                            specsToTrain, self.VacSpec, self.rateList[:Nsamples], self.JumpSelects[:Nsamples],
+                            self.AllJumpRates_st1[:Nsamples], self.JumpNewSites, self.dxJumps, self.NNsiteList,
+                            None, AllJumps=False, mode="eval")
+
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        sd = {key: val.clone() for key, val in gNet.state_dict().items()}
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            diffs = []
+            for run in ["single", "distributed"]:
+                os.mkdir(dirPath + "/" + run)
+                gNet.load_state_dict(sd)
+                TrainArgs = (self.T, dirPath + "/" + run, State1, State2, On_st1, On_st2, rates, disps, None, None,
+                             specsToTrain, sp_ch, self.VacSpec, 0, 2, 1, N_check, gNet)
+                EvalArgs = (self.T, dirPath + "/" + run, State1, State2, On_st1, On_st2, rates, disps,
+                            specsToTrain, None, None, sp_ch, self.VacSpec, 0, 2, 1, N_check, gNet)
+
+                if run == "single":
+                    Train(*TrainArgs, batch_size=batch_size)
+                    diffs.append(np.array(Evaluate(*EvalArgs, batch_size=batch_size)))
+                else:
+                    pt.multiprocessing.spawn(trainDistributed, nprocs=world_size,
+                                             args=(world_size, dirPath + "/init", TrainArgs, EvalArgs, batch_size))
+                    diffs.append(np.load(dirPath + "/distributed/diffs.npy"))
+
+            for epoch in range(3):
+                sd1 = pt.load(dirPath + "/single/ep_{}.pt".format(epoch))
+                sd2 = pt.load(dirPath + "/distributed/ep_{}.pt".format(epoch))
+                self.assertEqual(sd1.keys(), sd2.keys())
+                for key in sd1.keys():
+                    self.assertTrue(pt.allclose(sd1[key], sd2[key], rtol=0, atol=1e-12))
+
+        self.assertTrue(np.allclose(diffs[0], diffs[1], rtol=1e-12, atol=0))
+
+    def test_Evaluate_pool(self):
+        # Evaluating pools of checkpoints in one pass over the data must give the same sums as one at a time
+        specsToTrain = [self.specCheck]
+        N_check = 20
+        Nsamples = 3 * N_check
+        batch_size = 16
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        State1, State2, rates, disps, _, On_st1, On_st2, sp_ch = \
+            makeComputeData(self.state1List[:Nsamples], self.state2List[:Nsamples], self.dispList[:Nsamples],
+                            specsToTrain, self.VacSpec, self.rateList[:Nsamples], self.JumpSelects[:Nsamples],
+                            self.AllJumpRates_st1[:Nsamples], self.JumpNewSites, self.dxJumps, self.NNsiteList,
+                            None, AllJumps=False, mode="eval")
+
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            Train(self.T, dirPath, State1, State2, On_st1, On_st2, rates, disps, None, None, specsToTrain, sp_ch,
+                  self.VacSpec, 0, 3, 1, N_check, gNet, batch_size=batch_size)
+
+            diffs = []
+            for pool_size in [None, 1, 3]:
+                diffs.append(Evaluate(self.T, dirPath, State1, State2, On_st1, On_st2, rates, disps, specsToTrain,
+                                      None, None, sp_ch, self.VacSpec, 0, 3, 1, N_check, gNet,
+                                      batch_size=batch_size, pool_size=pool_size))
+
+            # the sums of each checkpoint computed directly
+            state1Data, state2Data, dispData, rateData, On1, On2 = \
+                makeDataTensors(State1, State2, rates, disps, On_st1, On_st2, specsToTrain, self.VacSpec, sp_ch,
+                                Ndim=self.Ndim)
+            diffRef = np.zeros((2, 4))
+            for epoch in range(4):
+                gNet.load_state_dict(pt.load(dirPath + "/ep_{}.pt".format(epoch)))
+                with pt.no_grad():
+                    for rangeInd, (start, end) in enumerate([(0, N_check), (N_check, Nsamples)]):
+                        diff, _, _ = train_batch_collective(gNet, state1Data[start:end].double(),
+                                                            state2Data[start:end].double(),
+                                                            rateData[start:end], dispData[start:end], None, None,
+                                                            specsToTrain, self.VacSpec, On1[start:end], On2[start:end])
+                        diffRef[rangeInd, epoch] = diff.item()
+
+        for train_diff, valid_diff in diffs:
+            self.assertEqual(train_diff.shape, (4,))
+            self.assertTrue(np.array_equal(train_diff, diffs[0][0]))
+            self.assertTrue(np.array_equal(valid_diff, diffs[0][1]))
+            self.assertTrue(np.allclose(train_diff, diffRef[0], rtol=1e-12, atol=0))
+            self.assertTrue(np.allclose(valid_diff, diffRef[1], rtol=1e-12, atol=0))
+
+    def test_makeComputeData_vectorized(self):
+        # The vectorized builders must give byte-identical arrays to the loop implementations
+        specsToTrain = [self.specCheck]
+        N_check = 100
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        for AllJumps in [False, True]:
+            for tracers in [False, True]:
+                start = time.time()
+                State1_occs, State2_occs, rates, disps, GatherTensor_tracers, _, _, sp_ch = \
+                    makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, self.VacSpec,
+                                    self.rateList, self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites,
+                                    self.dxJumps, self.NNsiteList, N_check, AllJumps=AllJumps, mode="train",
+                                    tracers=tracers)
+                tVec = time.time() - start
+
+                start = time.time()
+                if AllJumps:
+                    State1_ref, State2_ref = makeStateTensors_loop(self.state1List[:N_check], sp_ch, NSpec,
+                                                                   self.JumpNewSites, AllJumps=True)
+                else:
+                    State1_ref = makeStateTensors_loop(self.state1List[:N_check], sp_ch, NSpec, self.JumpNewSites)
+                    State2_ref = makeStateTensors_loop(self.state2List[:N_check], sp_ch, NSpec, self.JumpNewSites)
+                refs = makeRatesDisps_loop(self.state1List, self.dispList, specsToTrain, self.VacSpec, self.rateList,
+                                           self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps,
+                                           self.NNsiteList, N_check, AllJumps=AllJumps, tracers=tracers)
+                tLoop = time.time() - start
+                print("AllJumps: {}, tracers: {}. Vectorized: {:.4f} s, loops: {:.4f} s".format(AllJumps, tracers,
+                                                                                               tVec, tLoop))
+
+                arrays = [State1_occs, State2_occs, rates, disps, GatherTensor_tracers]
+                for arr, ref in zip(arrays, [State1_ref, State2_ref] + list(refs)):
+                    if ref is None:
+                        self.assertTrue(arr is None)
+                        continue
+                    self.assertEqual(arr.dtype, ref.dtype)
+                    self.assertEqual(arr.shape, ref.shape)
+                    self.assertEqual(arr.tobytes(), ref.tobytes())
+
+        # Benchmark on the whole data set
+        for AllJumps in [False, True]:
+            start = time.time()
+            makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, self.VacSpec,
+                            self.rateList, self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps,
+                            self.NNsiteList, None, AllJumps=AllJumps, mode="eval")
+            print("All {} samples, AllJumps: {}. {:.4f} s".format(self.state1List.shape[0], AllJumps,
+                                                                  time.time() - start))
+
+    def test_Train_precision(self):
+        # The training loss and the y vectors must stay close to double precision in lower precision, with both
+        # the unfused and the fused group convolutions
+        specCheck = self.specCheck
+        specsToTrain = [specCheck]
+        VacSpec = self.VacSpec
+        N_check = 200
+        State1_occs, State2_occs, rates, disps, GatherTensor_tracers, OnSites_state1, OnSites_state2, sp_ch = \
+            makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, VacSpec, self.rateList,
+                            self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps,
+                            self.NNsiteList, N_check, tracers=False, AllJumps=False, mode="train")
+
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=3, nch=8, nchLast=1).double()
+        sd = gNet.state_dict()
+
+        for fused in [False, True]:
+            Ls = {}
+            ys = {}
+            for prec, dtype in Precisions.items():
+                gNetPrec = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                                 mean=0.02, std=0.2, nl=3, nch=8, nchLast=1, fused=fused)
+                gNetPrec.load_state_dict(sd)
+                gNetPrec = gNetPrec.to(storageType(dtype))
+
+                Ls[prec], y1, y2 = Train(self.T, ".", State1_occs, State2_occs, OnSites_state1, OnSites_state2,
+                                         rates, disps, None, None, specsToTrain, sp_ch, VacSpec, 0, 0, 100, N_check,
+                                         gNetPrec, batch_size=N_check, scratch_if_no_init=True, chkpt=False,
+                                         dtype=dtype)
+
+                # the transport coefficients are accumulated in double precision regardless
+                self.assertEqual(y1.dtype, np.float64)
+                ys[prec] = y1
+
+            print("Fused: {}. L at each precision: {}".format(fused, Ls))
+            relDev = {prec: abs(L - Ls["fp64"]) / Ls["fp64"] for prec, L in Ls.items()}
+            yDev = {prec: np.max(np.abs(y - ys["fp64"])) / np.max(np.abs(ys["fp64"])) for prec, y in ys.items()}
+            print("Relative deviation of L from fp64: {}".format(relDev))
+            print("Max. deviation of y from fp64 (relative to max |y|): {}".format(yDev))
+
+            self.assertLess(relDev["fp32"], 1e-4)
+            self.assertLess(yDev["fp32"], 1e-3)
+            # Rounding errors grow with the unit roundoff, by a factor set by the cancellations in the y vectors
+            # of each data set, which the fp32 deviation measures (bf16 deviates by 5-10% for the HEA sets, but by
+            # ~100% for the binary set, which fp32 also resolves least well). The bf16 deviation must be of the
+            # size the bf16 roundoff gives, and well above the fp32 one, so that the convolutions did run in bf16.
+            epsRatio = pt.finfo(pt.bfloat16).eps / pt.finfo(pt.float32).eps
+            self.assertLess(yDev["bf16"], 4 * epsRatio * yDev["fp32"])
+            self.assertGreater(yDev["bf16"], 10 * yDev["fp32"])
+
+    def test_Train_concat(self):
+        # Running the initial and final states in one forward pass must give the same training step
+        specsToTrain = [self.specCheck]
+        VacSpec = self.VacSpec
+        N_check = 200
+        State1_occs, State2_occs, rates, disps, GatherTensor_tracers, OnSites_state1, OnSites_state2, sp_ch = \
+            makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, VacSpec, self.rateList,
+                            self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps,
+                            self.NNsiteList, N_check, tracers=False, AllJumps=False, mode="train")
+
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=3, nch=8, nchLast=1).double()
+        sd = copy.deepcopy(gNet.state_dict())
+
+        outs = {}
+        for concat in [False, True]:
+            gNet.load_state_dict(sd)
+            outs[concat] = Train(self.T, ".", State1_occs, State2_occs, OnSites_state1, OnSites_state2, rates,
+                                 disps, None, None, specsToTrain, sp_ch, VacSpec, 0, 1, 100, N_check, gNet,
+                                 batch_size=32, scratch_if_no_init=True, chkpt=False, concat=concat)
+            outs[concat] = (outs[concat], copy.deepcopy(gNet.state_dict()))
+
+        (L, y1, y2), sdSep = outs[False]
+        (LCat, y1Cat, y2Cat), sdCat = outs[True]
+        self.assertTrue(np.allclose(L, LCat, rtol=1e-12, atol=0))
+        self.assertTrue(np.allclose(y1, y1Cat, rtol=1e-10, atol=1e-14))
+        self.assertTrue(np.allclose(y2, y2Cat, rtol=1e-10, atol=1e-14))
+        for key in sdSep.keys():
+            self.assertTrue(pt.allclose(sdSep[key], sdCat[key], rtol=1e-8, atol=1e-12), msg=key)
+
+        # Benchmark a training step (forward and backward) with separate and concatenated forward passes
+        state1Data, state2Data, dispData, rateData, On1, On2 = \
+            makeDataTensors(State1_occs, State2_occs, rates, disps, OnSites_state1, OnSites_state2, specsToTrain,
+                            VacSpec, sp_ch, Ndim=self.Ndim)
+        state1Data = state1Data.double()
+        state2Data = state2Data.double()
+        Nrep = 3
+        for batch_size in [1, 4, 16, 64]:
+            times = {}
+            for concat in [False, True]:
+                start = time.time()
+                for rep in range(Nrep):
+                    gNet.zero_grad()
+                    diff, _, _ = train_batch_collective(gNet, state1Data[:batch_size], state2Data[:batch_size],
+                                                        rateData[:batch_size], dispData[:batch_size], None, None,
+                                                        specsToTrain, VacSpec, On1[:batch_size], On2[:batch_size],
+                                                        concat=concat)
+                    diff.backward()
+                times[concat] = (time.time() - start) / Nrep
+            print("Batch size {}. Separate: {:.4f} s, concatenated: {:.4f} s per step".format(batch_size,
+                                                                                          times[False], times[True]))
+
+    def test_Train_prefetch(self):
+        # Training with batches staged ahead of time on a background thread must give the same results
+        specsToTrain = [self.specCheck]
+        VacSpec = self.VacSpec
+        N_check = 200
+        State1_occs, State2_occs, rates, disps, GatherTensor_tracers, OnSites_state1, OnSites_state2, sp_ch = \
+            makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, VacSpec, self.rateList,
+                            self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps,
+                            self.NNsiteList, N_check, tracers=False, AllJumps=False, mode="train")
+
+        # the states stay in their compact dtype until they reach the device
+        state1Data, state2Data, dispData, rateData, On1, On2 = \
+            makeDataTensors(State1_occs, State2_occs, rates, disps, OnSites_state1, OnSites_state2, specsToTrain,
+                            VacSpec, sp_ch, Ndim=self.Ndim)
+        self.assertEqual(state1Data.dtype, pt.int8)
+        batches = list(dataBatches(0, N_check, 64, state1Data, state2Data, rateData, None))
+        staged = list(Prefetcher(batches, pt.float32, depth=2))
+        self.assertEqual(len(staged), len(batches))
+        for batch, stagedBatch in zip(batches, staged):
+            self.assertEqual(stagedBatch[0].dtype, pt.float32)
+            self.assertTrue(pt.equal(stagedBatch[1], batch[1].float()))
+            self.assertTrue(pt.equal(stagedBatch[2], batch[2]))
+            self.assertTrue(stagedBatch[3] is None)
+
+        # stopping early must not leave the background thread waiting
+        for batch in Prefetcher(batches, pt.double, depth=1):
+            break
+
+        # errors in the batches are raised where the batches are used
+        def badBatches():
+            yield batches[0]
+            raise ValueError("bad batch")
+        with self.assertRaises(ValueError):
+            for batch in Prefetcher(badBatches(), pt.double):
+                pass
+
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        sd = copy.deepcopy(gNet.state_dict())
+
+        outs = {}
+        for prefetch in [0, 2]:
+            gNet.load_state_dict(sd)
+            start = time.time()
+            L, y1, y2 = Train(self.T, ".", State1_occs, State2_occs, OnSites_state1, OnSites_state2, rates, disps,
+                              None, None, specsToTrain, sp_ch, VacSpec, 0, 1, 100, N_check, gNet, batch_size=16,
+                              scratch_if_no_init=True, chkpt=False, prefetch=prefetch)
+            print("Prefetch {}: {:.4f} s".format(prefetch, time.time() - start))
+            outs[prefetch] = (L, y1, y2, copy.deepcopy(gNet.state_dict()))
+
+        for out, outPf in zip(outs[0][:3], outs[2][:3]):
+            self.assertTrue(np.array_equal(out, outPf))
+        for key in outs[0][3].keys():
+            self.assertTrue(pt.equal(outs[0][3][key], outs[2][3][key]), msg=key)
+
+    def test_Train_shuffle(self):
+        # Shuffling through an index array must train the same as on data permuted with the same order
+        specsToTrain = [self.specCheck]
+        VacSpec = self.VacSpec
+        N_check = 100
+        State1_occs, State2_occs, rates, disps, GatherTensor_tracers, OnSites_state1, OnSites_state2, sp_ch = \
+            makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, VacSpec, self.rateList,
+                            self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps,
+                            self.NNsiteList, N_check, tracers=False, AllJumps=False, mode="train")
+
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        sd = copy.deepcopy(gNet.state_dict())
+
+        def train(seed, randomize=True, perm=slice(None)):
+            gNet.load_state_dict(sd)
+            L, y1, y2 = Train(self.T, ".", State1_occs[perm], State2_occs[perm], OnSites_state1[perm],
+                              OnSites_state2[perm], rates[perm], disps[perm], None, None, specsToTrain, sp_ch, VacSpec,
+                              0, 0, 100, N_check, gNet, batch_size=16, scratch_if_no_init=True, chkpt=False,
+                              randomize=randomize, seed=seed)
+            return L, y1, y2, copy.deepcopy(gNet.state_dict())
+
+        def assertSame(out1, out2):
+            for a, b in zip(out1[:3], out2[:3]):
+                self.assertTrue(np.array_equal(a, b))
+            for key in out1[3].keys():
+                self.assertTrue(pt.equal(out1[3][key], out2[3][key]), msg=key)
+
+        # the same seed gives the same epoch
+        out = train(7)
+        assertSame(out, train(7))
+        self.assertNotEqual(out[0], train(8)[0])
+
+        # the order of epoch 0 is fixed by the seed
+        perm = pt.randperm(N_check, generator=pt.Generator().manual_seed(7)).numpy()
+        assertSame(out, train(None, randomize=False, perm=perm))
+
+        # gathering batches through an order, including from lazily expanded states
+        State1_lazy = makeStateTensors(self.state1List[:10], specsToTrain, VacSpec, self.JumpNewSites,
+                                       AllJumps=True, lazy=True)[0]
+        order = pt.randperm(State1_lazy.shape[0])
+        rows = pt.arange(State1_lazy.shape[0])
+        batches = list(dataBatches(0, State1_lazy.shape[0], 7, State1_lazy, rows, None, order=order))
+        self.assertTrue(pt.equal(pt.cat([b[1] for b in batches]), order))
+        self.assertTrue(pt.equal(pt.cat([b[0] for b in batches]), State1_lazy[:][order]))
+        self.assertTrue(all(b[2] is None for b in batches))
+
+    def test_Train_validation(self):
+        # In-loop validation must not change training, and must match evaluating the saved checkpoints
+        specsToTrain = [self.specCheck]
+        VacSpec = self.VacSpec
+        N_check = 60
+        N_val = 40
+        State1_occs, State2_occs, rates, disps, _, OnSites_state1, OnSites_state2, sp_ch = \
+            makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, VacSpec, self.rateList,
+                            self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps,
+                            self.NNsiteList, N_check + N_val, AllJumps=False, mode="train")
+        data = (State1_occs, State2_occs, OnSites_state1, OnSites_state2, rates, disps)
+
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        sd = copy.deepcopy(gNet.state_dict())
+
+        def train(dirPath, start_ep=0, end_ep=4, lRate=0.001, **kwargs):
+            if start_ep == 0:
+                gNet.load_state_dict(sd)
+            Train(self.T, dirPath, *data, None, None, specsToTrain, sp_ch, VacSpec, start_ep, end_ep, 1, N_check,
+                  gNet, lRate=lRate, batch_size=16, scratch_if_no_init=(start_ep == 0), **kwargs)
+            if os.path.exists(dirPath + "/validation.json"):
+                with open(dirPath + "/validation.json", "r") as fl:
+                    return json.load(fl)
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            train(dirPath, chkpt=False)
+            sdRef = copy.deepcopy(gNet.state_dict())
+            log = train(dirPath, valEvery=2)
+            for key in sdRef.keys():
+                self.assertTrue(pt.equal(sdRef[key], gNet.state_dict()[key]), msg=key)
+
+            # validated at epochs 0, 2 and 4, with only the best and the last checkpoints kept
+            self.assertEqual([entry["epoch"] for entry in log["history"]], [0, 2, 4])
+            best = min(log["history"], key=lambda entry: entry["L_val"])
+            self.assertEqual(log["best_epoch"], best["epoch"])
+            kept = sorted(int(fl[3:-3]) for fl in os.listdir(dirPath) if fl.startswith("ep_"))
+            self.assertEqual(kept, sorted({best["epoch"], 4}))
+
+            _, valDiff = Evaluate(self.T, dirPath, *data, specsToTrain, None, None, sp_ch, VacSpec, 4, 4, 1,
+                                  N_check, gNet, batch_size=16)
+            self.assertTrue(np.isclose(valDiff[0] / N_val, log["history"][-1]["L_val"], rtol=1e-12, atol=0))
+
+            # a resumed run keeps the best network of the epochs before it
+            logResumed = train(dirPath, start_ep=4, end_ep=6, valEvery=2)
+            self.assertEqual([entry["epoch"] for entry in logResumed["history"]][:2], [0, 2])
+            self.assertLessEqual(logResumed["best_L_val"], best["L_val"])
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            # without training, the network never improves, and training stops after stopPatience validations
+            log = train(dirPath, end_ep=10, lRate=0.0, valEvery=1, stopPatience=2)
+            self.assertEqual([entry["epoch"] for entry in log["history"]], [0, 1, 2])
+            self.assertEqual(sorted(fl for fl in os.listdir(dirPath) if fl.startswith("ep_")), ["ep_0.pt", "ep_2.pt"])
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            # the plateau schedule scales the learning rate after lrPatience validations without improvement,
+            # in the same way as it does for the same validation history on its own
+            log = train(dirPath, end_ep=5, lRate=1e-6, valEvery=1, lrSchedule="plateau", lrPatience=1)
+            opt = pt.optim.SGD([pt.zeros(1, requires_grad=True)], lr=1e-6)
+            scheduler = pt.optim.lr_scheduler.ReduceLROnPlateau(opt, factor=0.5, patience=1)
+            lrs = []
+            for entry in log["history"]:
+                lrs.append(opt.param_groups[0]["lr"])
+                scheduler.step(entry["L_val"])
+            self.assertEqual([entry["lr"] for entry in log["history"]], lrs)
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            log = train(dirPath, end_ep=3, valEvery=1, lrSchedule="cosine")
+            self.assertTrue(np.allclose([entry["lr"] for entry in log["history"]],
+                                        [0.0005 * (1 + np.cos(np.pi * ep / 4)) for ep in range(4)]))
+
+        with self.assertRaises(ValueError):
+            train(".", chkpt=False, stopPatience=2)
+
+        # shuffled epochs only ever gather training rows, never the held-out ones
+        with tempfile.TemporaryDirectory() as dirPath:
+            with mock.patch.object(GCNetRun, "takeRows", wraps=GCNetRun.takeRows) as takeRows:
+                train(dirPath, end_ep=2, valEvery=1, randomize=True)
+            rows = pt.cat([call.args[1] for call in takeRows.call_args_list])
+            self.assertEqual(set(rows.tolist()), set(range(N_check)))
+
+        # L0 is computed from the training samples only
+        def trainL0(dataL0, **kwargs):
+            out = io.StringIO()
+            with tempfile.TemporaryDirectory() as dirPath, contextlib.redirect_stdout(out):
+                Train(self.T, dirPath, *dataL0, None, None, specsToTrain, sp_ch, VacSpec, 0, 0, 1, N_check, gNet,
+                      batch_size=16, scratch_if_no_init=True, scaleL0=True, **kwargs)
+            return [line for line in out.getvalue().splitlines() if line.startswith("L0 : ")]
+        self.assertEqual(trainL0(data, valEvery=1), trainL0(tuple(d[:N_check] for d in data), chkpt=False))
+
+        # boundary training validates with the jump probabilities of the held-out samples
+        jProbs = self.AllJumpRates_st1 / np.sum(self.AllJumpRates_st1, axis=1).reshape(-1, 1)
+        gNetJP = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                       mean=0.02, std=0.2, nl=1, nch=4, nchLast=self.z).double()
+        with tempfile.TemporaryDirectory() as dirPath:
+            Train(self.T, dirPath, *data, jProbs, jProbs, specsToTrain, sp_ch, VacSpec, 0, 1, 1, N_check, gNetJP,
+                  batch_size=16, scratch_if_no_init=True, Boundary_train=True, valEvery=1)
+            with open(dirPath + "/validation.json", "r") as fl:
+                log = json.load(fl)
+            self.assertEqual([entry["epoch"] for entry in log["history"]], [0, 1])
+            self.assertTrue(all(np.isfinite(entry["L_val"]) for entry in log["history"]))
+
+    def test_Train_resume(self):
+        # A run resumed from its saved training state must end exactly where the uninterrupted run does
+        specsToTrain = [self.specCheck]
+        VacSpec = self.VacSpec
+        N_check = 60
+        N_val = 20
+        State1_occs, State2_occs, rates, disps, _, OnSites_state1, OnSites_state2, sp_ch = \
+            makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, VacSpec, self.rateList,
+                            self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps,
+                            self.NNsiteList, N_check + N_val, AllJumps=False, mode="train")
+        data = (State1_occs, State2_occs, OnSites_state1, OnSites_state2, rates, disps)
+
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        sd = copy.deepcopy(gNet.state_dict())
+
+        def train(dirPath, end_ep, resume=False, **kwargs):
+            # the batches are shuffled without a seed, from the global random number generator
+            if resume:
+                for p in gNet.parameters():
+                    p.data.normal_()
+                pt.manual_seed(1234)
+            else:
+                gNet.load_state_dict(sd)
+                pt.manual_seed(1)
+            out = Train(self.T, dirPath, *data, None, None, specsToTrain, sp_ch, VacSpec, 0, end_ep, 1, N_check,
+                        gNet, lRate=0.01, batch_size=16, randomize=True, valEvery=1, resume=resume, **kwargs)
+            with open(dirPath + "/validation.json", "r") as fl:
+                return out, copy.deepcopy(gNet.state_dict()), json.load(fl)["history"]
+
+        # with 4 batches per epoch, the last state of the interrupted run is saved either part of the way
+        # through epoch 1 or at its start
+        for kwargs in [dict(chkptBatches=3, lrSchedule="plateau", lrPatience=0), dict()]:
+            with tempfile.TemporaryDirectory() as dirRef, tempfile.TemporaryDirectory() as dirPath:
+                outRef, sdRef, historyRef = train(dirRef, 3, **kwargs)
+                train(dirPath, 1, **kwargs)
+                state = pt.load(dirPath + "/train_state.pt", weights_only=False)
+                self.assertEqual((state["epoch"], state["batch"]), (1, kwargs.get("chkptBatches", 0)))
+
+                out, sdResumed, history = train(dirPath, 3, resume=True, **kwargs)
+                for key in sdRef.keys():
+                    self.assertTrue(pt.equal(sdRef[key], sdResumed[key]), msg=key)
+                self.assertEqual(history, historyRef)
+                self.assertEqual(out[0], outRef[0])
+                self.assertTrue(np.array_equal(out[1], outRef[1]))
+                self.assertTrue(np.array_equal(out[2], outRef[2]))
+                self.assertFalse([fl for fl in os.listdir(dirPath) if ".tmp" in fl])
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            with self.assertRaises(FileNotFoundError):
+                train(dirPath, 1, resume=True)
+
+            # errors of background writes are raised when the writer is closed
+            writer = CheckpointWriter()
+            writer.save(sd, dirPath + "/missing/ep_0.pt")
+            with self.assertRaises(Exception):
+                writer.close()
+
+    def test_Train_profile(self):
+        # Profiling must not change training, and must log the phases of every epoch
+        specsToTrain = [self.specCheck]
+        VacSpec = self.VacSpec
+        N_check = 60
+        State1_occs, State2_occs, rates, disps, _, OnSites_state1, OnSites_state2, sp_ch = \
+            makeComputeData(self.state1List, self.state2List, self.dispList, specsToTrain, VacSpec, self.rateList,
+                            self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps,
+                            self.NNsiteList, N_check, AllJumps=False, mode="train")
+
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        sd = copy.deepcopy(gNet.state_dict())
+
+        sds = []
+        with tempfile.TemporaryDirectory() as dirPath:
+            profiled = Profiler(dirPath + "/profile.jsonl", traceEpoch=1, tracePath=dirPath + "/trace.json")
+            for profiler in [None, profiled]:
+                gNet.load_state_dict(sd)
+                Train(self.T, dirPath, State1_occs, State2_occs, OnSites_state1, OnSites_state2, rates, disps,
+                      None, None, specsToTrain, sp_ch, VacSpec, 0, 2, 1, N_check, gNet, lRate=0.001, batch_size=16,
+                      chkpt=False, profiler=profiler)
+                sds.append(copy.deepcopy(gNet.state_dict()))
+
+            for key in sd.keys():
+                self.assertTrue(pt.equal(sds[0][key], sds[1][key]), msg=key)
+
+            with open(dirPath + "/profile.jsonl", "r") as fl:
+                records = [json.loads(line) for line in fl]
+            self.assertEqual([record["epoch"] for record in records], [0, 1, 2])
+            for record in records:
+                print("Epoch {}: {:.1f} samples/s, {}".format(record["epoch"], record["samples_per_sec"],
+                      ", ".join("{} {:.3f} s".format(key, val) for key, val in record["phases"].items())))
+                self.assertEqual(record["samples"], N_check)
+                self.assertEqual(sorted(record["phases"].keys()), ["backward", "data", "forward", "step", "transfer"])
+                self.assertGreater(record["other"], -1e-6)
+                self.assertGreater(record["peak_rss_MB"], 0)
+                # allocations are only counted on a CUDA device
+                self.assertEqual("allocations" in record, GCNetRun.device.type == "cuda")
+
+            # only the chosen epoch is traced
+            with open(dirPath + "/trace.json", "r") as fl:
+                trace = json.load(fl)
+            self.assertTrue(any(event.get("name") == "forward" for event in trace["traceEvents"]))
+
+    def test_exportNet(self):
+        # An exported network must predict the same relaxation vectors from the raw states as the trained one
+        specsToTrain = [self.specCheck]
+        N_check = 50
+        State1_occs, _, sp_ch = makeStateTensors(self.state1List[:N_check], specsToTrain, self.VacSpec,
+                                                 self.JumpNewSites)
+        NSpec = len(sp_ch)
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        with pt.no_grad():
+            y = gNet(pt.tensor(State1_occs).double()).numpy()
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            exportNet(dirPath + "/GCNet.pt", gNet, sp_ch, self.VacSpec)
+            net = loadPredictor(dirPath + "/GCNet.pt")
+            yPred = predict(net, self.state1List[:N_check], batch_size=16)
+
+        self.assertEqual(yPred.shape, y.shape)
+        self.assertTrue(np.allclose(yPred, y, rtol=0, atol=1e-12))
+
+        # the network of the caller is never moved to the CPU, only a copy of it is
+        params = [(p.data_ptr(), p.device, p.dtype) for p in gNet.parameters()]
+        with tempfile.TemporaryDirectory() as dirPath, \
+                mock.patch.object(GCNet, "cpu", autospec=True, side_effect=GCNet.cpu) as cpu:
+            exportNet(dirPath + "/GCNet.pt", gNet, sp_ch, self.VacSpec)
+        self.assertEqual(cpu.call_count, 1)
+        self.assertIsNot(cpu.call_args.args[0], gNet)
+        self.assertEqual([(p.data_ptr(), p.device, p.dtype) for p in gNet.parameters()], params)
+
+    @unittest.skipUnless(importlib.util.find_spec("onnx") is not None, "needs the onnx package")
+    def test_exportNet_onnx(self):
+        # An ONNX export must be a valid graph with a variable batch size, predicting the same vectors
+        import onnx
+        specsToTrain = [self.specCheck]
+        N_check = 20
+        State1_occs, _, sp_ch = makeStateTensors(self.state1List[:N_check], specsToTrain, self.VacSpec,
+                                                 self.JumpNewSites)
+        NSpec = len(sp_ch)
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        with pt.no_grad():
+            y = gNet(pt.tensor(State1_occs).double()).numpy()
+
+        with tempfile.TemporaryDirectory() as dirPath:
+            exportNet(dirPath + "/GCNet.onnx", gNet, sp_ch, self.VacSpec, onnx=True)
+            model = onnx.load(dirPath + "/GCNet.onnx")
+            onnx.checker.check_model(model)
+            self.assertEqual([inp.name for inp in model.graph.input], ["states"])
+            self.assertEqual([out.name for out in model.graph.output], ["y"])
+            self.assertEqual(model.graph.input[0].type.tensor_type.shape.dim[0].dim_param, "batch")
+
+            if importlib.util.find_spec("onnxruntime") is not None:
+                import onnxruntime
+                session = onnxruntime.InferenceSession(dirPath + "/GCNet.onnx")
+                yOnnx = session.run(None, {"states": self.state1List[:N_check].astype(np.int64)})[0]
+                self.assertTrue(np.allclose(yOnnx, y, rtol=0, atol=1e-10))
+
+    def test_PreprocCache(self):
+        # Preprocessed data read back from the cache must be the same as the data built directly
+        specsToTrain = [self.specCheck]
+        N_check = 100
+        args = (self.state1List, self.state2List, self.dispList, specsToTrain, self.VacSpec, self.rateList,
+                self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps, self.NNsiteList, N_check)
+
+        def assertSame(outputs, ref):
+            self.assertEqual(len(outputs), len(ref))
+            for out, r in zip(outputs, ref):
+                if r is None:
+                    self.assertTrue(out is None)
+                elif isinstance(r, dict):
+                    self.assertEqual(out, r)
+                elif isinstance(r, JumpExpandedStates):
+                    self.assertTrue(isinstance(out, JumpExpandedStates))
+                    self.assertTrue(pt.equal(out[:], r[:]))
+                else:
+                    self.assertEqual(out.dtype, r.dtype)
+                    self.assertTrue(np.array_equal(out, r))
+
+        with tempfile.TemporaryDirectory() as cacheDir:
+            cache = PreprocCache(cacheDir, self.DataPath)
+            for AllJumps in [False, True]:
+                ref = makeComputeData(*args, AllJumps=AllJumps, mode="train", tracers=True, lazy=True)
+                assertSame(cache(makeComputeData, *args, AllJumps=AllJumps, mode="train", tracers=True, lazy=True),
+                           ref)
+                # the second time, the data is memory-mapped from the cache
+                start = time.time()
+                cached = cache(makeComputeData, *args, AllJumps=AllJumps, mode="train", tracers=True, lazy=True)
+                print("AllJumps: {}. Read from cache in {:.4f} s".format(AllJumps, time.time() - start))
+                assertSame(cached, ref)
+                self.assertTrue(isinstance(cached[2], np.memmap))
+            self.assertEqual(len(cache.entries()), 2)
+
+            # other options and other data give new entries
+            cache(makeComputeData, *args, AllJumps=False, mode="train", tracers=False, lazy=True)
+            self.assertEqual(len(cache.entries()), 3)
+            argsShort = args[:-1] + (N_check // 2,)
+            assertSame(cache(makeComputeData, *argsShort, AllJumps=False, mode="train", tracers=False),
+                       makeComputeData(*argsShort, AllJumps=False, mode="train", tracers=False))
+            self.assertEqual(len(cache.entries()), 4)
+
+            # damaged entries are built again
+            ref = makeStateTensors(self.state1List[:N_check], specsToTrain, self.VacSpec, self.JumpNewSites)
+            assertSame(cache(makeStateTensors, self.state1List[:N_check], specsToTrain, self.VacSpec,
+                             self.JumpNewSites), ref)
+            entry = max(cache.entries())[2]
+            os.remove(os.path.join(entry, "arr_0.npy"))
+            for rep in range(2):
+                assertSame(cache(makeStateTensors, self.state1List[:N_check], specsToTrain, self.VacSpec,
+                                 self.JumpNewSites), ref)
+            self.assertTrue(os.path.isfile(os.path.join(entry, "arr_0.npy")))
+
+            # data rows are only read from the data file for entries that are not in the cache, and rows of the
+            # same size from another dataset or range give other entries
+            data = [DataRows(self.DataPath, name) for name in ("InitStates", "FinStates", "SpecDisps", "rates",
+                                                               "JumpSelects", "AllJumpRates_Init")]
+            dataArgs = tuple(data[:3]) + (specsToTrain, self.VacSpec, data[3], data[4], data[5]) + args[8:]
+            with mock.patch.object(DataRows, "load", autospec=True, side_effect=DataRows.load) as load:
+                assertSame(cache(makeComputeData, *dataArgs, AllJumps=False, mode="train"),
+                           makeComputeData(*args, AllJumps=False, mode="train"))
+                self.assertEqual(load.call_count, 6)
+                cache(makeComputeData, *dataArgs, AllJumps=False, mode="train")
+                self.assertEqual(load.call_count, 6)
+            Nentries = len(cache.entries())
+            for stateRows in [data[1][:N_check], data[0][1 : N_check + 1]]:
+                assertSame(cache(makeStateTensors, stateRows, specsToTrain, self.VacSpec, self.JumpNewSites),
+                           makeStateTensors(stateRows.load(), specsToTrain, self.VacSpec, self.JumpNewSites))
+            self.assertEqual(len(cache.entries()), Nentries + 2)
+            self.assertEqual(len(data[0][1 : N_check + 1]), N_check)
+
+            # once the cache gets too large, only the most recently used entries are kept
+            latest = max(cache.entries())[2]
+            sizes = {entry: size for _, size, entry in cache.entries()}
+            cache.maxBytes = sizes[latest]
+            cache.evict()
+            self.assertEqual([entry for _, _, entry in cache.entries()], [latest])
+
+    def test_PreprocCache_shared(self):
+        # Cached states are wrapped as tensors without copies, and training on them gives the same results
+        specsToTrain = [self.specCheck]
+        N_check = 100
+        args = (self.state1List, self.state2List, self.dispList, specsToTrain, self.VacSpec, self.rateList,
+                self.JumpSelects, self.AllJumpRates_st1, self.JumpNewSites, self.dxJumps, self.NNsiteList, N_check)
+        ref = makeComputeData(*args, AllJumps=False, mode="train")
+
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        sd = copy.deepcopy(gNet.state_dict())
+
+        def train(data):
+            gNet.load_state_dict(sd)
+            State1_occs, State2_occs, rates, disps, _, On_st1, On_st2, sp_ch = data
+            return Train(self.T, ".", State1_occs, State2_occs, On_st1, On_st2, rates, disps, None, None,
+                         specsToTrain, sp_ch, self.VacSpec, 0, 0, 100, N_check, gNet, batch_size=16,
+                         scratch_if_no_init=True, chkpt=False)
+
+        with tempfile.TemporaryDirectory() as cacheDir:
+            cache = PreprocCache(cacheDir, self.DataPath)
+            cache(makeComputeData, *args, AllJumps=False, mode="train")
+            cached = cache(makeComputeData, *args, AllJumps=False, mode="train")
+
+            State1_occs, State2_occs, rates, disps, _, On_st1, On_st2, sp_ch = cached
+            state1Data, state2Data, _, _, On1, On2 = makeDataTensors(State1_occs, State2_occs, rates, disps, On_st1,
+                                                                     On_st2, specsToTrain, self.VacSpec, sp_ch,
+                                                                     Ndim=self.Ndim)
+            self.assertTrue(np.shares_memory(state1Data.numpy(), State1_occs))
+            self.assertTrue(np.shares_memory(state2Data.numpy(), State2_occs))
+            self.assertTrue(np.shares_memory(On1.numpy(), On_st1))
+            self.assertTrue(pt.equal(On1, pt.tensor(ref[5], dtype=pt.bool)))
+
+            # the maps are copy-on-write, so changes made by one run never reach the cached files
+            state1Data[0] += 1
+            self.assertTrue(np.array_equal(cache(makeComputeData, *args, AllJumps=False, mode="train")[0], ref[0]))
+
+            outs = [train(ref), train(cache(makeComputeData, *args, AllJumps=False, mode="train"))]
+
+        for out, outCached in zip(*outs):
+            self.assertTrue(np.array_equal(out, outCached))
+
+    def test_Gather_Y_Exits(self):
+        # y vectors of states and their exits must be the same as those of the all-jump data
+        N_check = 20
+        batch_size = 7
+        specs = np.unique(self.state1List[0])
+        NSpec = specs.shape[0] - 1
+        for specsToTrain in [[self.specCheck], [self.VacSpec]]:
+            for labels in [False, True]:
+                pt.manual_seed(0)
+                gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                             mean=0.02, std=0.2, nl=2, nch=4, nchLast=1, labels=labels).double()
+                State1, State2, On_st1, On_st2, sp_ch = \
+                    makeStateTensors(self.state2List[:N_check], specsToTrain, self.VacSpec, self.JumpNewSites,
+                                     AllJumps=True, labels=labels, lazy=True)
+                y, yExits = Gather_Y(self.T, ".", State1, State2, On_st1, On_st2, None, None, sp_ch, specsToTrain,
+                                     self.VacSpec, gNet, self.Ndim, batch_size=batch_size * self.z)
+
+                # the exits built on the fly are the all-jump exit states
+                State, OnSites, _ = makeStateTensors(self.state2List[:N_check], specsToTrain, self.VacSpec,
+                                                     self.JumpNewSites, labels=labels)
+                self.assertTrue(pt.equal(exitStates(pt.tensor(State), pt.tensor(self.JumpNewSites)), State2[:]))
+                if OnSites is not None:
+                    self.assertTrue(np.array_equal(exitStates(pt.tensor(OnSites), pt.tensor(self.JumpNewSites)),
+                                                   On_st2))
+
+                dataStream = KMCDataset(self.DataPath, specsToTrain, self.VacSpec, self.JumpNewSites, self.dxJumps,
+                                        self.NNsiteList, batch_size, rowEnd=N_check, labels=labels,
+                                        InitStates="FinStates")
+                with tempfile.TemporaryDirectory() as dirPath:
+                    with h5py.File(dirPath + "/y.h5", "w") as out:
+                        Gather_Y_Exits(".", State, OnSites, sp_ch, specsToTrain, self.VacSpec, gNet,
+                                       self.JumpNewSites, out, "y", Ndim=self.Ndim, batch_size=batch_size)
+                        Gather_Y_Exits(".", State, OnSites, sp_ch, specsToTrain, self.VacSpec, gNet,
+                                       self.JumpNewSites, out, "y_cat", Ndim=self.Ndim, batch_size=batch_size,
+                                       concat=True)
+                        Gather_Y_Exits(".", None, None, sp_ch, specsToTrain, self.VacSpec, gNet, self.JumpNewSites,
+                                       out, "y_stream", Ndim=self.Ndim, dataStream=dataStream)
+                        Gather_Y_Exits(".", State, OnSites, sp_ch, specsToTrain, self.VacSpec, gNet,
+                                       self.JumpNewSites, out, "y_inc", Ndim=self.Ndim, batch_size=batch_size,
+                                       incremental=True)
+
+                    with h5py.File(dirPath + "/y.h5", "r") as fl:
+                        # the incremental exits are summed in a different order
+                        for key, atol in [("y", 1e-14), ("y_cat", 1e-14), ("y_stream", 1e-14), ("y_inc", 1e-11)]:
+                            self.assertEqual(fl[key].shape, (N_check, self.Ndim))
+                            self.assertEqual(fl[key + "_exits"].shape, (N_check * self.z, self.Ndim))
+                            self.assertTrue(np.allclose(fl[key][:], y[::self.z], rtol=1e-12, atol=1e-14))
+                            self.assertTrue(np.allclose(fl[key + "_exits"][:], yExits, rtol=1e-12, atol=atol))
+
+        # Benchmark against running the all-jump states
+        specsToTrain = [self.specCheck]
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=NSpec,
+                     mean=0.02, std=0.2, nl=2, nch=4, nchLast=1).double()
+        N_bench = 50
+        State1, State2, On_st1, On_st2, sp_ch = makeStateTensors(self.state1List[:N_bench], specsToTrain,
+                                                                 self.VacSpec, self.JumpNewSites, AllJumps=True,
+                                                                 lazy=True)
+        State, OnSites, _ = makeStateTensors(self.state1List[:N_bench], specsToTrain, self.VacSpec,
+                                             self.JumpNewSites)
+        start = time.time()
+        Gather_Y(self.T, ".", State1, State2, On_st1, On_st2, None, None, sp_ch, specsToTrain, self.VacSpec, gNet,
+                 self.Ndim, batch_size=16 * self.z)
+        tAllJumps = time.time() - start
+        with tempfile.TemporaryDirectory() as dirPath:
+            with h5py.File(dirPath + "/y.h5", "w") as out:
+                start = time.time()
+                Gather_Y_Exits(".", State, OnSites, sp_ch, specsToTrain, self.VacSpec, gNet, self.JumpNewSites,
+                               out, "y", Ndim=self.Ndim, batch_size=16)
+                tExits = time.time() - start
+                start = time.time()
+                Gather_Y_Exits(".", State, OnSites, sp_ch, specsToTrain, self.VacSpec, gNet, self.JumpNewSites,
+                               out, "y_inc", Ndim=self.Ndim, batch_size=16, incremental=True)
+                tIncremental = time.time() - start
+        print("y of {} states and their exits. All-jump data: {:.3f} s, exits built per batch: {:.3f} s, "
+              "incremental exits: {:.3f} s".format(N_bench, tAllJumps, tExits, tIncremental))
+
     def test_makeComputeData_AllJumps(self):
         specCheck = self.specCheck
         specsToTrain = [specCheck]
@@ -846,6 +1958,7 @@ class TestGCNetRun_HEA_collective_orthogonal(TestGCNetRun_HEA_collective):
         self.state1List, self.state2List, self.dispList, self.rateList, self.AllJumpRates_st1, \
         self.AllJumpRates_st2, self.JumpSelects = \
             Load_Data("Test_Data/testData_HEA_MEAM_orthogonal.h5")
+        self.DataPath = "Test_Data/testData_HEA_MEAM_orthogonal.h5"
 
         self.GpermNNIdx, self.NNsiteList, self.JumpNewSites, self.dxJumps =\
             Load_crysDats("../CrysDat_FCC/CrystData_ortho_5_cube.h5")
@@ -891,6 +2004,7 @@ class TestGCNetRun_binary_collective(TestGCNetRun_HEA_collective):
         self.state1List, self.state2List, self.dispList, self.rateList, self.AllJumpRates_st1, \
         self.AllJumpRates_st2, self.JumpSelects = \
             Load_Data(Data2)
+        self.DataPath = Data2
 
         self.GpermNNIdx, self.NNsiteList, self.JumpNewSites, self.dxJumps = Load_crysDats(CrysDatPath)
 
@@ -974,6 +2088,7 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
         N_check = 200
         N_train = 500
         AllJumps = False
+        source2Dest = makeSource2Dest(self.JumpNewSites)
 
         for m in ["train", "all"]:
             print("testing mode : {}".format(m))
@@ -988,14 +2103,14 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
                 self.assertTrue(State1_occs.shape[0] == self.state1List.shape[0] == State2_occs.shape[0])
                 self.assertTrue(rates.shape[0] == self.state1List.shape[0] == disps.shape[0])
                 self.assertTrue(OnSites_state1.shape[0] == self.state1List.shape[0] == OnSites_state2.shape[0])
-                self.assertTrue(GatherTensor_tracers.shape[0] == self.state1List.shape[0])
+                self.assertTrue(GatherTensor_tracers.shape == (self.state1List.shape[0],))
                 sampsCheck = np.random.randint(0, State1_occs.shape[0], N_check)
 
             else:
                 self.assertTrue(State1_occs.shape[0] == N_train == State2_occs.shape[0])
                 self.assertTrue(rates.shape[0] == N_train == disps.shape[0])
                 self.assertTrue(OnSites_state1.shape[0] == N_train == OnSites_state2.shape[0])
-                self.assertTrue(GatherTensor_tracers.shape[0] == N_train)
+                self.assertTrue(GatherTensor_tracers.shape == (N_train,))
                 sampsCheck = np.random.randint(0, N_train, N_check)
 
             for samp in tqdm(sampsCheck, position=0, leave=True):
@@ -1004,7 +2119,7 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
                         self.assertTrue(np.all(State1_occs[samp, :, site] == 0))
                         self.assertTrue(np.all(State2_occs[samp, :, site] == 0))
                         self.assertTrue(OnSites_state1[samp, site] == 0)
-                        self.assertTrue(np.all(GatherTensor_tracers[samp, :, site] == 0))
+                        self.assertEqual(source2Dest[GatherTensor_tracers[samp], site], 0)
                     else:
                         spec1 = self.state1List[samp, site]
                         self.assertEqual(State1_occs[samp, self.sp_ch[spec1], site], 1)
@@ -1018,11 +2133,12 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
                         if spec2 == self.specCheck:
                             self.assertTrue(np.all(OnSites_state2[samp, site] == 1))
 
-                        # check the Gather tensor
+                        # check the gathering permutation of the recorded jump
                         jSelect = self.JumpSelects[samp]
+                        self.assertEqual(GatherTensor_tracers[samp], jSelect)
                         sourceSite = self.JumpNewSites[jSelect, site]
-                        self.assertTrue(np.all(GatherTensor_tracers[samp, :, sourceSite] == site),
-                                        msg="\n{} {} {}".format(site, sourceSite, GatherTensor_tracers[samp, :, site]))
+                        self.assertEqual(source2Dest[GatherTensor_tracers[samp], sourceSite], site,
+                                         msg="\n{} {} {}".format(site, sourceSite, source2Dest[jSelect, site]))
 
                 # check the displacements
                 jSelect = None
@@ -1084,6 +2200,7 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
         N_check = 200
         N_train = 500
         AllJumps = True
+        source2Dest = makeSource2Dest(self.JumpNewSites)
 
         for m in ["train", "all"]:
             print("testing mode : {}".format(m))
@@ -1098,14 +2215,14 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
                 self.assertTrue(State1_occs.shape[0] == self.state1List.shape[0] * self.z == State2_occs.shape[0])
                 self.assertTrue(rates.shape[0] == self.state1List.shape[0] * self.z == disps.shape[0])
                 self.assertTrue(OnSites_state1.shape[0] == self.state1List.shape[0] * self.z == OnSites_state2.shape[0])
-                self.assertTrue(GatherTensor_tracers.shape[0] == self.state1List.shape[0] * self.z)
+                self.assertTrue(GatherTensor_tracers.shape == (self.state1List.shape[0] * self.z,))
                 sampsCheck = np.random.randint(0, self.state1List.shape[0], N_check)
 
             else:
                 self.assertTrue(State1_occs.shape[0] == N_train * self.z == State2_occs.shape[0])
                 self.assertTrue(rates.shape[0] == N_train * self.z == disps.shape[0])
                 self.assertTrue(OnSites_state1.shape[0] == N_train * self.z == OnSites_state2.shape[0])
-                self.assertTrue(GatherTensor_tracers.shape[0] == N_train * self.z)
+                self.assertTrue(GatherTensor_tracers.shape == (N_train * self.z,))
                 sampsCheck = np.random.randint(0, N_train, N_check)
 
             for stateInd in tqdm(sampsCheck, position=0, leave=True):
@@ -1133,7 +2250,7 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
                             self.assertTrue(np.all(State2_occs[stateInd * self.dxJumps.shape[0] + jInd, :, site] == 0))
                             self.assertEqual(OnSites_state1[stateInd * self.dxJumps.shape[0] + jInd, site], 0)
                             self.assertEqual(OnSites_state2[stateInd * self.dxJumps.shape[0] + jInd, site], 0)
-                            self.assertTrue(np.all(GatherTensor_tracers[stateInd * self.dxJumps.shape[0] + jInd, :, site] == 0))
+                            self.assertEqual(source2Dest[GatherTensor_tracers[stateInd * self.dxJumps.shape[0] + jInd], site], 0)
 
                         else:
                             self.assertNotEqual(spec2, self.VacSpec)
@@ -1151,9 +2268,10 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
                             else:
                                 self.assertEqual(OnSites_state2[stateInd * self.dxJumps.shape[0] + jInd, site], 0)
 
-                            # check the Gather tensor
+                            # check the gathering permutation of the recorded jump
+                            self.assertEqual(GatherTensor_tracers[stateInd * self.dxJumps.shape[0] + jInd], jInd)
                             sourceSite = self.JumpNewSites[jInd, site]
-                            self.assertTrue(np.all(GatherTensor_tracers[stateInd * self.dxJumps.shape[0] + jInd, :, sourceSite] == site))
+                            self.assertEqual(source2Dest[GatherTensor_tracers[stateInd * self.dxJumps.shape[0] + jInd], sourceSite], site)
 
                     # check the rate
                     self.assertTrue(np.math.isclose(rates[stateInd * self.dxJumps.shape[0] + jInd],
@@ -1234,7 +2352,7 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
         diff, y1, y2 = Train(self.T, dirPath, State1_occs, State2_occs, OnSites_state1, OnSites_state2, rates, disps,
                        jProbs_st1, jProbs_st2, specsToTrain, sp_ch, VacSpec, start_ep, end_ep, interval,
                        N_check, gNet, lRate=0.001, batch_size=N_check, scratch_if_no_init=True, chkpt=False,
-                       tracers=True, GatherTensor=GatherTensor_tracers)
+                       tracers=True, GatherTensor=GatherTensor_tracers, JumpNewSites=self.JumpNewSites)
 
         print("Max, min and avg values")
         print(np.max(y1), np.max(y2))
@@ -1321,7 +2439,8 @@ class TestGCNetRun_HEA_tracers(unittest.TestCase):
         diff, y1, y2 = Train(self.T, dirPath, State1_occs, State2_occs, OnSites_state1, OnSites_state2,
                              rates, disps, jProbs_st1, jProbs_st2, specsToTrain, sp_ch, VacSpec, start_ep,
                              end_ep, interval, N_check * self.z, gNet, lRate=0.001, batch_size=N_check * self.z,
-                             scratch_if_no_init=True, chkpt=False, tracers=True, GatherTensor=GatherTensor_tracers)
+                             scratch_if_no_init=True, chkpt=False, tracers=True, GatherTensor=GatherTensor_tracers,
+                             JumpNewSites=self.JumpNewSites)
 
         print(y1.shape, y2.shape)
 
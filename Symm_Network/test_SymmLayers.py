@@ -1,11 +1,12 @@
 import unittest
+import time
 
 import numpy as np
 import torch as pt
 import h5py
 from tqdm import tqdm
 from onsager import crystal, supercell
-from SymmLayers import GCNet, msgPassLayer, msgPassNet
+from SymmLayers import GCNet, GConv, msgPassLayer, msgPassNet, OneHot, FrozenGCNet, ReduceGroup
 import torch.nn.functional as F
 
 
@@ -93,6 +94,149 @@ class TestGConv(unittest.TestCase):
             self.assertTrue(pt.allclose(out_Gav, pt.mean(out_non_lin[:, :, :, :], dim=2)), msg="{} {}".format(out_Gav.shape, out_non_lin.shape))
             print("Gconv explicit symmetry test passed")
 
+    def test_GConv_fused(self):
+        # check that the fused convolution kernel gives the same outputs and gradients as the default one
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                     mean=0.02, std=0.2, nl=2, nch=8, nchLast=5).double()
+
+        gNetFused = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                          mean=0.02, std=0.2, nl=2, nch=8, nchLast=5, fused=True).double()
+        gNetFused.load_state_dict(gNet.state_dict())
+
+        In = self.StateTensors.clone().requires_grad_(True)
+        InFused = self.StateTensors.clone().requires_grad_(True)
+        gradOut = pt.rand(self.StateTensors.shape[0], 5, 3, self.Nsites, dtype=pt.double)
+
+        y = gNet(In)
+        yFused = gNetFused(InFused)
+        self.assertTrue(pt.allclose(y, yFused, rtol=0, atol=1e-10))
+
+        pt.sum(y * gradOut).backward()
+        pt.sum(yFused * gradOut).backward()
+        self.assertTrue(pt.allclose(In.grad, InFused.grad, rtol=0, atol=1e-10))
+        for (name, p), (_, pFused) in zip(gNet.named_parameters(), gNetFused.named_parameters()):
+            self.assertTrue(pt.allclose(p.grad, pFused.grad, rtol=1e-10, atol=1e-10), msg="{}".format(name))
+
+        # Then compare the time taken for a forward and backward pass
+        for net, label in [(gNet, "default"), (gNetFused, "fused")]:
+            start = time.time()
+            for rep in range(3):
+                net.zero_grad()
+                pt.sum(net(self.StateTensors) * gradOut).backward()
+            print("{} GConv: {:.4f} seconds per forward+backward pass".format(label, (time.time() - start) / 3))
+
+    def test_GConv_fused_autocast(self):
+        # under bf16 autocast, the fused convolution must run in bf16 like the default one, with gradients
+        # reaching the float32 parameters
+        conv = GConv(self.NspCh, 4, self.GnnPerms.long(), self.NNsites, self.N_ngb, mean=0.02, std=0.2)
+        convFused = GConv(self.NspCh, 4, self.GnnPerms.long(), self.NNsites, self.N_ngb, mean=0.02, std=0.2,
+                          fused=True)
+        convFused.load_state_dict(conv.state_dict())
+        In = self.StateTensors.float()
+        with pt.autocast(device_type="cpu", dtype=pt.bfloat16):
+            y = conv(In)
+            yFused = convFused(In)
+        self.assertEqual(yFused.dtype, pt.bfloat16)
+        # both deviate from float32 by a few bf16 roundings of the largest outputs
+        yRef = convFused(In)
+        tol = 8 * pt.finfo(pt.bfloat16).eps * yRef.abs().max().item()
+        self.assertLess((y.float() - yRef).abs().max().item(), tol)
+        self.assertLess((yFused.float() - yRef).abs().max().item(), tol)
+        self.assertGreater((yFused.float() - yRef).abs().max().item(), 1e-5)
+
+        pt.sum(yFused).backward()
+        self.assertEqual(convFused.Psi.grad.dtype, pt.float32)
+        self.assertEqual(convFused.bias.grad.dtype, pt.float32)
+
+    def test_GConv_rotation_cache(self):
+        # check that rotated weights are re-used until the parameters change, and that training steps
+        # with the cached weights match those of the fused kernel, which does not rotate the weights.
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+
+        gNetFused = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                          mean=0.02, std=0.2, nl=1, nch=4, nchLast=1, fused=True).double()
+        gNetFused.load_state_dict(gNet.state_dict())
+
+        with pt.no_grad():
+            gNet(self.StateTensors[:2])
+            GWeights = gNet.net[0].GWeights
+            gNet(self.StateTensors[2:4])
+            self.assertTrue(gNet.net[0].GWeights is GWeights)
+
+        opt = pt.optim.Adam(gNet.parameters(), lr=0.01)
+        optFused = pt.optim.Adam(gNetFused.parameters(), lr=0.01)
+        for step in range(3):
+            state1 = self.StateTensors[2 * step: 2 * step + 2]
+            state2 = self.StateTensors[2 * step + 2: 2 * step + 4]
+            for net, optimizer in [(gNet, opt), (gNetFused, optFused)]:
+                optimizer.zero_grad()
+                loss = pt.sum((net(state2) - net(state1))**2)
+                loss.backward()
+                optimizer.step()
+
+            for p, pFused in zip(gNet.parameters(), gNetFused.parameters()):
+                self.assertTrue(pt.allclose(p, pFused, rtol=0, atol=1e-10))
+
+        # Loading new parameters must rebuild the rotated weights
+        gNet.load_state_dict(gNetFused.state_dict())
+        with pt.no_grad():
+            y = gNet(self.StateTensors[:2])
+            gNet.net[0].ClearRotation()
+            self.assertTrue(pt.allclose(y, gNet(self.StateTensors[:2])))
+            self.assertFalse(gNet.net[0].GWeights is GWeights)
+
+    def test_RearrangeInput(self):
+        # check the neighbor gathers against explicitly repeated and gathered inputs
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        for Nbatch in [1, 3]:
+            In = self.StateTensors[:Nbatch]
+            Nch = In.shape[1]
+            NNRepeat = self.NNsites.unsqueeze(0).repeat(Nbatch, Nch, 1)
+            InRearranged = pt.gather(In.repeat_interleave(self.N_ngb, dim=1), 2, NNRepeat)
+            self.assertTrue(pt.equal(gNet.net[0].RearrangeInput(In, self.NNsites), InRearranged))
+
+            NNRepeat = self.NNsites[1:].unsqueeze(0).repeat(Nbatch, Nch, 1)
+            InRearranged = pt.gather(In.repeat_interleave(self.N_ngb - 1, dim=1), 2, NNRepeat)
+            self.assertTrue(pt.equal(gNet.RearrangeInput(In),
+                                     InRearranged.view(Nbatch, Nch, self.N_ngb - 1, self.Nsites)))
+
+    def test_GConvEmbed(self):
+        # a network taking species labels must match the one taking the one-hot occupancies of those labels
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        gNetLabels = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                           mean=0.02, std=0.2, nl=1, nch=4, nchLast=1, labels=True).double()
+        gNetLabels.load_state_dict(gNet.state_dict())
+
+        # label NspCh is the vacancy, which has no channel
+        labels = pt.randint(0, self.NspCh + 1, (4, self.Nsites), dtype=pt.int8)
+        occs = OneHot(labels, self.NspCh, pt.double)
+        self.assertEqual(occs.shape, (4, self.NspCh, self.Nsites))
+        for site in range(self.Nsites):
+            for samp in range(4):
+                if labels[samp, site] == self.NspCh:
+                    self.assertTrue(pt.all(occs[samp, :, site] == 0))
+                else:
+                    self.assertEqual(occs[samp, labels[samp, site], site], 1)
+                    self.assertEqual(pt.sum(occs[samp, :, site]), 1)
+
+        # the embedding path is used without gradients
+        with pt.no_grad():
+            self.assertTrue(pt.allclose(gNetLabels.net[0](labels), gNet.net[0](occs), rtol=0, atol=1e-12))
+            self.assertTrue(pt.allclose(gNetLabels(labels), gNet(occs), rtol=0, atol=1e-12))
+
+        # and the on-device one-hot expansion with gradients
+        y = gNet(occs)
+        yLabels = gNetLabels(labels)
+        self.assertTrue(pt.allclose(yLabels, y, rtol=0, atol=1e-12))
+        y.sum().backward()
+        yLabels.sum().backward()
+        for p, pLabels in zip(gNet.parameters(), gNetLabels.parameters()):
+            self.assertTrue(pt.allclose(pLabels.grad, p.grad, rtol=0, atol=1e-12))
+
     def test_GConv_noSym(self):
         GnnPerms = self.GnnPerms[:1].long()
         print(GnnPerms)
@@ -123,6 +267,75 @@ class TestGConv(unittest.TestCase):
 
             print("Non-symmetry explicit symmetry test passed")
 
+    def test_ReduceGroup(self):
+        # The FCC nearest neighbor permutations are all distinct, so the reduced network is the same
+        GnnPerms, multiplicity = ReduceGroup(self.GnnPerms)
+        self.assertTrue(pt.equal(GnnPerms, self.GnnPerms))
+        self.assertIsNone(multiplicity)
+        pt.manual_seed(0)
+        gNet = GCNet(self.GnnPerms, self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                     mean=0.02, std=0.2, nl=1, nch=4, nchLast=1, reduceGroup=True).double()
+        ref = GCNet(self.GnnPerms, self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                    mean=0.02, std=0.2, nl=1, nch=4, nchLast=1).double()
+        self.assertEqual({key: val.shape for key, val in gNet.state_dict().items()},
+                         {key: val.shape for key, val in ref.state_dict().items()})
+
+        # A group with operations that permute the neighbors in the same way, as from a list of operations
+        # with translations, is reduced to the distinct permutations, with the identity first
+        dupPerms = pt.cat((self.GnnPerms, self.GnnPerms[5:21], self.GnnPerms[:3], self.GnnPerms[5:7]))
+        GnnPerms, multiplicity = ReduceGroup(dupPerms)
+        self.assertTrue(pt.equal(GnnPerms, self.GnnPerms))
+        expected = pt.ones(48, dtype=pt.long)
+        expected[5:21] += 1
+        expected[:3] += 1
+        expected[5:7] += 1
+        self.assertTrue(pt.equal(multiplicity, expected))
+
+        states = pt.tensor(self.StateTensors[:8]).double()
+        for fused, labelNet in [(False, False), (True, False), (False, True)]:
+            nets = []
+            for reduceGroup in [False, True]:
+                pt.manual_seed(0)
+                nets.append(GCNet(dupPerms, self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                                  mean=0.02, std=0.2, nl=2, nch=4, nchLast=1, fused=fused, labels=labelNet,
+                                  reduceGroup=reduceGroup).double())
+            self.assertEqual(nets[1].net[0].GnnPerms.shape[0], 48)
+
+            In = pt.randint(0, self.NspCh + 1, (8, self.Nsites)) if labelNet else states
+            ys = []
+            for gNet in nets:
+                y = gNet(In)
+                y.sum().backward()
+                ys.append(y)
+            self.assertTrue(pt.allclose(ys[0], ys[1], rtol=0, atol=1e-12))
+            for pFull, pRed in zip(nets[0].parameters(), nets[1].parameters()):
+                self.assertTrue(pt.allclose(pFull.grad, pRed.grad, rtol=1e-10, atol=1e-12))
+
+        # the reduced network also works with the exit states and as a frozen network
+        plan = nets[1].ExitPlan(self.JumpNewSites)
+        with pt.no_grad():
+            _, yExits = nets[0].forwardExits(In[:2], plan)
+            _, yExitsRed = nets[1].forwardExits(In[:2], plan)
+        self.assertTrue(pt.allclose(yExits, yExitsRed, rtol=0, atol=1e-12))
+
+        chLabels = np.arange(self.NspCh + 1)
+        frozen = FrozenGCNet(nets[0], chLabels).eval()
+        scripted = pt.jit.script(FrozenGCNet(nets[1], chLabels).eval())
+        with pt.no_grad():
+            self.assertTrue(pt.allclose(scripted(In), frozen(In), rtol=0, atol=1e-12))
+
+        # the convolutions of the duplicated operations are not done again
+        with pt.no_grad():
+            times = []
+            for gNet in nets:
+                gNet(In)
+                start = time.time()
+                for rep in range(5):
+                    gNet(In)
+                times.append((time.time() - start) / 5)
+        print("Group of {} operations: {:.5f} s, reduced to {}: {:.5f} s".format(dupPerms.shape[0], times[0],
+                                                                                  GnnPerms.shape[0], times[1]))
+
     def test_Symmetry(self):
         # here, we'll check the full symmetry of the network with the batch of symmetry-related states
         gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
@@ -205,6 +418,93 @@ class TestGConv(unittest.TestCase):
                     assert np.allclose(np.dot(g.cartrot, y0[ch, :, site]), y_np[gInd, ch, :, siteNew])
 
 
+    def test_FrozenGCNet(self):
+        # The frozen inference network takes raw states and must match the trained network on their occupancies
+        # Species 0 is the vacancy, at site 0, and species 1 to NspCh have the channels NspCh-1 to 0.
+        chLabels = np.array([self.NspCh] + list(range(self.NspCh - 1, -1, -1)))
+        states = np.random.randint(1, self.NspCh + 1, (64, self.Nsites))
+        states[:, 0] = 0
+        labels = pt.tensor(chLabels[states])
+        occs = OneHot(labels, self.NspCh, pt.double)
+
+        for fused, labelNet in [(False, False), (True, False), (False, True)]:
+            pt.manual_seed(0)
+            gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                         mean=0.02, std=0.2, nl=2, nch=8, nchLast=1, fused=fused, labels=labelNet).double()
+            frozen = FrozenGCNet(gNet, chLabels).eval()
+            scripted = pt.jit.freeze(pt.jit.script(frozen))
+            with pt.no_grad():
+                y = gNet(labels if labelNet else occs)
+                self.assertTrue(pt.allclose(frozen(pt.tensor(states)), y, rtol=0, atol=1e-12))
+                self.assertTrue(pt.allclose(scripted(pt.tensor(states)), y, rtol=0, atol=1e-12))
+
+            # the frozen network does not change with the trained one
+            with pt.no_grad():
+                gNet.net[0].Psi.add_(1.0)
+                self.assertTrue(pt.allclose(scripted(pt.tensor(states)), y, rtol=0, atol=1e-12))
+
+        # Latency of the scripted frozen network against the eager one
+        Nrep = 5
+        for batch_size in [1, 8, 64]:
+            stateBatch = pt.tensor(states[:batch_size])
+            with pt.no_grad():
+                times = []
+                for f in [lambda: gNet(labels[:batch_size]), lambda: scripted(stateBatch)]:
+                    f()
+                    start = time.time()
+                    for rep in range(Nrep):
+                        f()
+                    times.append((time.time() - start) / Nrep)
+            print("Batch size {}. Eager: {:.5f} s, frozen: {:.5f} s per batch".format(batch_size, *times))
+
+    def test_forwardExits(self):
+        # Incrementally evaluated exit states must match running the network on each exit state
+        states = np.random.randint(1, self.NspCh + 1, (8, self.Nsites))
+        labels = pt.tensor(states) - 1
+        labels[:, 0] = self.NspCh
+        JumpNewSites = pt.tensor(self.JumpNewSites).long()
+        exitLabels = labels[:, JumpNewSites].reshape(-1, self.Nsites)
+        occs = OneHot(labels, self.NspCh, pt.double)
+        exitOccs = OneHot(exitLabels, self.NspCh, pt.double)
+
+        for nl, fused, labelNet in [(-1, False, False), (0, False, False), (2, False, False), (2, True, False),
+                                    (2, False, True)]:
+            pt.manual_seed(0)
+            gNet = GCNet(self.GnnPerms.long(), self.NNsites, self.JumpVecs, N_ngb=self.N_ngb, NSpec=self.NspCh,
+                         mean=0.02, std=0.2, nl=nl, nch=4, nchLast=1, fused=fused, labels=labelNet).double()
+            plan = gNet.ExitPlan(JumpNewSites)
+            In, exitIn = (labels, exitLabels) if labelNet else (occs, exitOccs)
+
+            y, yExits = gNet.forwardExits(In, plan)
+            self.assertEqual(yExits.shape, (In.shape[0] * self.z, 1, self.Ndim, self.Nsites))
+            self.assertTrue(pt.allclose(y, gNet(In), rtol=0, atol=1e-12))
+            self.assertTrue(pt.allclose(yExits, gNet(exitIn), rtol=0, atol=1e-12))
+
+            # and so must the gradients
+            if not labelNet:
+                (pt.sum(y) + pt.sum(yExits ** 2)).backward()
+                grads = [p.grad.clone() for p in gNet.parameters()]
+                gNet.zero_grad()
+                (pt.sum(gNet(In)) + pt.sum(gNet(exitIn) ** 2)).backward()
+                for grad, p in zip(grads, gNet.parameters()):
+                    self.assertTrue(pt.allclose(grad, p.grad, rtol=1e-10, atol=1e-10))
+
+        # a permutation that is not a jump followed by a translation is rejected
+        with self.assertRaises(ValueError):
+            gNet.ExitPlan(pt.randperm(self.Nsites).view(1, -1))
+
+        # Time against running the network on every exit state
+        Nrep = 3
+        with pt.no_grad():
+            times = []
+            for f in [lambda: (gNet(In), gNet(exitIn)), lambda: gNet.forwardExits(In, plan)]:
+                start = time.time()
+                for rep in range(Nrep):
+                    f()
+                times.append((time.time() - start) / Nrep)
+        print("Exits of {} states. Full: {:.4f} s, incremental: {:.4f} s".format(In.shape[0], *times))
+
+
 class TestGConv_orthogonal(TestGConv):
 
     def setUp(self):
@@ -429,4 +729,39 @@ class TestMsgPassing(unittest.TestCase):
                     yRot = np.dot(g.cartrot, outState0[:, siteInd])
                     self.assertTrue(np.allclose(yRot, yvecsG[:, siteIndNew]))
 
+    def test_msgPassNet_throughput(self):
+        # Compare the vectorized message passing layers with the neighbor loop, with and without
+        # chunking over the neighbors, and time them for different numbers of layers.
+        NChannels = 8
+        JumpVecs = pt.tensor(self.dxJumps.T, dtype=pt.float64)
+        for NLayers in [1, 2, 4, 8]:
+            msgNet = msgPassNet(NLayers=NLayers, NChannels=NChannels, NSpec=self.NspCh, VecsPerSite=1,
+                                NNsites=self.NNsites, JumpVecs=JumpVecs, mean=0.0, std=0.01).double()
+
+            msgNetChunked = msgPassNet(NLayers=NLayers, NChannels=NChannels, NSpec=self.NspCh, VecsPerSite=1,
+                                       NNsites=self.NNsites, JumpVecs=JumpVecs, mean=0.0, std=0.01,
+                                       NgbChunk=5).double()
+            msgNetChunked.load_state_dict(msgNet.state_dict())
 
+            with pt.no_grad():
+                start = time.time()
+                out = msgNet(self.StateTensors)
+                tVec = time.time() - start
+
+                start = time.time()
+                outChunked = msgNetChunked(self.StateTensors)
+                tChunked = time.time() - start
+
+                start = time.time()
+                outLoop = self.StateTensors
+                for layer in msgNet.net:
+                    outLoop = layer.forward_loop(outLoop)
+                outLoop = pt.matmul(msgNet.JumpVecs, msgNet.reshapeOut(outLoop))
+                tLoop = time.time() - start
+
+            self.assertTrue(pt.allclose(out, outLoop, rtol=0, atol=1e-8))
+            self.assertTrue(pt.allclose(out, outChunked, rtol=0, atol=1e-12))
+
+            Nsamples = self.StateTensors.shape[0]
+            print("Layers: {}. Samples/second - vectorized: {:.2f}, chunked: {:.2f}, loop: {:.2f}".format(
+                NLayers, Nsamples / tVec, Nsamples / tChunked, Nsamples / tLoop))
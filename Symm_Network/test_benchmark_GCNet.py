@@ -0,0 +1,59 @@
+import unittest
+import os
+import json
+import tempfile
+import argparse
+
+import numpy as np
+from benchmark_GCNet import benchConfigs, compare, randomStates, main, CrysDatDir
+from GCNetRun import Load_crysDats, makeStateTensors
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.CrysDatPath = os.path.join(CrysDatDir, "CrystData.h5")
+
+    def test_randomStates(self):
+        # the states after the jumps must be the jumped states, and every species must be in the first state
+        _, _, JumpNewSites, _ = Load_crysDats(self.CrysDatPath)
+        state1List, state2List = randomStates(10, JumpNewSites.shape[1], 5, JumpNewSites)
+        self.assertTrue(np.all(state1List[:, 0] == 5))
+        self.assertTrue(np.array_equal(np.unique(state1List[0]), np.arange(6)))
+        for state1, state2 in zip(state1List, state2List):
+            self.assertTrue(any(np.array_equal(state1[jump], state2) for jump in JumpNewSites))
+        occs, _, sp_ch = makeStateTensors(state1List, [5], 5, JumpNewSites)
+        self.assertEqual(occs.shape, (10, 5, JumpNewSites.shape[1]))
+
+    def test_benchConfigs(self):
+        records = benchConfigs(self.CrysDatPath, [2], [1, 2], [4], ["full", "none"], Nrep=1)
+        benches = [record["bench"] for record in records]
+        # single layers are timed once for each no. of channels and group
+        self.assertEqual(benches.count("makeStateTensors"), 1)
+        self.assertEqual(benches.count("GConv"), 2)
+        self.assertEqual(benches.count("GCNet.forward"), 4)
+        self.assertEqual(benches.count("Train.step"), 4)
+        self.assertEqual(benches.count("msgPassNet.forward"), 2)
+        self.assertEqual(sorted({record["Ng"] for record in records if "Ng" in record}), [1, 48])
+        for record in records:
+            self.assertGreater(record["median_s"], 0)
+            self.assertLessEqual(record["min_s"], record["median_s"])
+
+        # a run compared to itself is no slower, and only the settings in both runs are compared
+        ratios = compare(records, records[2:])
+        self.assertEqual(len(ratios), len(records) - 2)
+        self.assertTrue(all(ratio == 1.0 for _, ratio in ratios))
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as dirPath:
+            args = argparse.Namespace(CrysDats=["CrystData_ortho_5_cube.h5"], Nchannels=[2], Nlayers=[1],
+                                      Batch_sizes=[2], Symmetries=["none"], NSpec=5, Precision="fp32", Nrep=1,
+                                      Threads=None, NoMsgPass=True, OutPath=dirPath + "/bench.json", Compare=None,
+                                      Tolerance=0.1)
+            main(args)
+            args.Compare = args.OutPath
+            args.OutPath = dirPath + "/bench2.json"
+            main(args)
+            with open(args.OutPath, "r") as fl:
+                results = json.load(fl)
+            self.assertEqual(results["meta"]["precision"], "fp32")
+            self.assertEqual({record["crystal"] for record in results["results"]}, {"CrystData_ortho_5_cube.h5"})
+            self.assertEqual({record["Nsites"] for record in results["results"]}, {500})